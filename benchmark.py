@@ -0,0 +1,464 @@
+"""
+Benchmarks for `iTunesLibrary` and `MusicMover`, using synthetic iTunes
+libraries and a fake target device in a temporary directory.
+
+Each phase (library loading, track selection, partitioning, copying and
+freshening) runs in its own process, so that its peak memory use can be
+measured. Results are printed, and can be saved as JSON for comparison
+with a later run (e.g. of a different version).
+
+Example::
+
+    python benchmark.py --sizes 1000,100000 --latency 0.005 -o before.json
+    (make changes)
+    python benchmark.py --sizes 1000,100000 --latency 0.005 -c before.json
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+from urllib import quote
+from xml.sax.saxutils import escape
+
+from musicmover import iTunesLibrary, MusicMover
+from targets import SimulatedBackend
+
+#===============================================================================
+# Synthetic libraries
+#===============================================================================
+
+def makeLibrary(filename, numTracks, seed=0, sourceDir="/tmp/musicmover"):
+    """ Write a synthetic iTunes library XML file. Roughly 10 tracks per
+        album and 5 albums per artist, with 5% of tracks in compilations
+        and 2% non-music items (videos). The tracks' files needn't exist.
+
+        @param filename: The name of the XML file to write.
+        @param numTracks: The number of tracks in the library.
+        @keyword seed: The random seed, so libraries are reproducible.
+        @keyword sourceDir: The directory in which the tracks' files are
+            supposedly located.
+    """
+    rand = random.Random(seed)
+    genres = ["Rock", "Jazz", "Classical", "Electronic", "Folk", "Hip-Hop"]
+    ids = range(1000, 1000 + numTracks)
+
+    with open(filename, 'wb') as f:
+        w = f.write
+        w('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" '
+          '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+          '<plist version="1.0">\n<dict>\n'
+          '\t<key>Major Version</key><integer>1</integer>\n'
+          '\t<key>Minor Version</key><integer>1</integer>\n'
+          '\t<key>Application Version</key><string>12.0</string>\n'
+          '\t<key>Music Folder</key><string>file://localhost%s/</string>\n'
+          '\t<key>Tracks</key>\n\t<dict>\n' % quote(sourceDir))
+
+        for n, trackId in enumerate(ids):
+            album = n // 10
+            artist = album // 5
+            ext = ".m4v" if rand.random() < 0.02 else \
+                rand.choice([".mp3", ".m4a", ".m4a", ".aiff"])
+            name = "%02d Track %d%s" % (n % 10 + 1, trackId, ext)
+            location = "file://localhost%s/Artist %d/Album %d/%s" % \
+                (quote(sourceDir), artist, album, quote(name))
+            added = datetime(2005, 1, 1).toordinal() + rand.randint(0, 5000)
+            w('\t\t<key>%d</key>\n\t\t<dict>\n'
+              '\t\t\t<key>Track ID</key><integer>%d</integer>\n'
+              '\t\t\t<key>Name</key><string>Track %d</string>\n'
+              '\t\t\t<key>Artist</key><string>%s</string>\n'
+              '\t\t\t<key>Album</key><string>%s</string>\n'
+              '\t\t\t<key>Genre</key><string>%s</string>\n'
+              '\t\t\t<key>Kind</key><string>MPEG audio file</string>\n'
+              '\t\t\t<key>Size</key><integer>%d</integer>\n'
+              '\t\t\t<key>Total Time</key><integer>%d</integer>\n'
+              '\t\t\t<key>Date Added</key><date>%sT12:00:00Z</date>\n'
+              '\t\t\t<key>Play Count</key><integer>%d</integer>\n'
+              '\t\t\t<key>Rating</key><integer>%d</integer>\n'
+              '\t\t\t<key>Persistent ID</key><string>%016X</string>\n'
+              '\t\t\t<key>Track Type</key><string>File</string>\n' %
+              (trackId, trackId, trackId,
+               escape("Artist %d: \"Live\"/<%d>" % (artist, artist)),
+               escape("Album %d" % album), rand.choice(genres),
+               rand.randint(1000000, 15000000), rand.randint(60000, 600000),
+               datetime.fromordinal(added).strftime("%Y-%m-%d"),
+               rand.randint(0, 50), rand.randint(0, 5) * 20, trackId))
+            if n % 20 == 0:
+                w('\t\t\t<key>Compilation</key><true/>\n')
+            w('\t\t\t<key>Location</key><string>%s</string>\n'
+              '\t\t</dict>\n' % escape(location))
+
+        w('\t</dict>\n\t<key>Playlists</key>\n\t<array>\n')
+        playlists = [("Library", ids), ("Music", ids),
+                     ("Favorites", rand.sample(ids, numTracks // 10)),
+                     ("Recently Added", ids[-(numTracks // 20):])]
+        for plId, (name, items) in enumerate(playlists):
+            w('\t\t<dict>\n'
+              '\t\t\t<key>Name</key><string>%s</string>\n'
+              '\t\t\t<key>Playlist ID</key><integer>%d</integer>\n'
+              '\t\t\t<key>All Items</key><true/>\n'
+              '\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n' %
+              (name, plId + 1))
+            for trackId in items:
+                w('\t\t\t\t<dict>\n\t\t\t\t\t<key>Track ID</key>'
+                  '<integer>%d</integer>\n\t\t\t\t</dict>\n' % trackId)
+            w('\t\t\t</array>\n\t\t</dict>\n')
+        w('\t</array>\n</dict>\n</plist>\n')
+
+
+#===============================================================================
+# Fake target
+#===============================================================================
+
+class FakeBackend(SimulatedBackend):
+    """ A `SimulatedBackend` for a directory standing in for a device.
+        'Copied' files are sparse files of the right size, so the source
+        files needn't exist.
+    """
+
+    def __init__(self, root, sizes, **kwargs):
+        """ Constructor. Takes the same arguments as `SimulatedBackend`,
+            plus:
+
+            @param sizes: A dictionary of source filenames and their sizes.
+        """
+        SimulatedBackend.__init__(self, root, **kwargs)
+        self.sizes = sizes
+
+
+    def _getSourceSize(self, source):
+        return self.sizes.get(source, 0)
+
+
+    def _putFile(self, source, dest, bufferSize):
+        size = self.sizes.get(source, 0)
+        with open(dest, 'wb') as f:
+            f.truncate(size)
+        return size
+
+
+class FakeTargetMover(MusicMover):
+    """ A `MusicMover` that copies to a directory standing in for a device,
+        through a `FakeBackend`. Device I/O can be throttled to simulate a
+        slow or high-latency device.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """ Constructor. Takes the same arguments as `MusicMover`, plus:
+
+            @keyword capacity: The size of the fake device, in bytes.
+            @keyword latency: The delay (seconds) added to every device
+                request: each batch of files copied or deleted, each 
+                directory read, and each check of free space.
+            @keyword bandwidth: The simulated transfer rate (bytes/second),
+                or `None` for no limit.
+            @keyword blockSize: The fake device's block size.
+        """
+        self.capacity = kwargs.pop('capacity', 64 * 1024**3)
+        self.latency = kwargs.pop('latency', 0)
+        self.bandwidth = kwargs.pop('bandwidth', None)
+        self.blockSize = kwargs.pop('blockSize', 32768)
+        kwargs['backend'] = self._makeBackend
+        MusicMover.__init__(self, *args, **kwargs)
+        self.sizes = dict((self._getSourceFile(t['Location']), t.get('Size', 0))
+                          for t in self.library.tracks.itervalues()
+                          if 'Location' in t)
+
+
+    def _makeBackend(self, root):
+        return FakeBackend(root, self.sizes, capacity=self.capacity,
+                           latency=self.latency, bandwidth=self.bandwidth,
+                           blockSize=self.blockSize)
+
+
+    def copyCallback(self, num, total, orig, dupe):
+        pass
+
+
+    def deleteCallback(self, num, total, filename):
+        pass
+
+
+#===============================================================================
+# Phases
+#===============================================================================
+
+def _benchLoad(xml, **kwargs):
+    """ Load a library, optionally (if `cache` is given) priming the cache
+        first.
+    """
+    if kwargs.get('cache'):
+        iTunesLibrary(xml, **kwargs)
+    t0 = time.time()
+    lib = iTunesLibrary(xml, **kwargs)
+    return time.time() - t0, len(lib.tracks), {}
+
+
+def benchLoadFull(xml, workDir, options):
+    return _benchLoad(xml)
+
+
+def benchLoadStreaming(xml, workDir, options):
+    return _benchLoad(xml, streaming=True)
+
+
+def benchLoadCached(xml, workDir, options):
+    return _benchLoad(xml, streaming=True,
+                      cache=os.path.join(workDir, "cache"))
+
+
+def _makeMover(xml, workDir, options, name="device", **kwargs):
+    """ Create a `FakeTargetMover` with a new, empty target.
+    """
+    target = os.path.join(workDir, name)
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.makedirs(target)
+    lib = iTunesLibrary(xml, streaming=True)
+    capacity = options.get('capacity')
+    if capacity is None:
+        # Room for about a quarter of the library
+        capacity = sum(t.get('Size', 0) for t in lib.tracks.itervalues()) / 4
+    mover = FakeTargetMover(library=lib, target=target, capacity=capacity,
+                            latency=options.get('latency', 0),
+                            bandwidth=options.get('bandwidth'), **kwargs)
+    mover.copyWorkers = options.get('workers', mover.copyWorkers)
+    return mover
+
+
+def benchSelect(xml, workDir, options, fill=False):
+    mover = _makeMover(xml, workDir, options, seed=0)
+    t0 = time.time()
+    total, tracks = mover.getNewMusic(minFree=0, fill=fill)
+    elapsed = time.time() - t0
+    return elapsed, len(mover.library.tracks), {
+        'selected': len(tracks), 'unusedBytes': mover.unusedBytes}
+
+
+def benchSelectFill(xml, workDir, options):
+    return benchSelect(xml, workDir, options, fill=True)
+
+
+def benchPartition(xml, workDir, options):
+    mover = _makeMover(xml, workDir, options)
+    results = {}
+    elapsed = 0
+    for strategy in ("nextfit", "ffd", "bfd"):
+        t0 = time.time()
+        parts = mover.partition(strategy=strategy)
+        results[strategy] = time.time() - t0
+        elapsed += results[strategy]
+        results[strategy + "Discs"] = len(parts)
+    return elapsed, len(mover.library.tracks), results
+
+
+def benchCopy(xml, workDir, options):
+    mover = _makeMover(xml, workDir, options)
+    tracks = [t for t in mover.library.getTracks()
+              if mover.isMusicFile(t.get('Location', ''))]
+    tracks = tracks[:options.get('copyLimit', 2000)]
+    t0 = time.time()
+    mover.copyTracks(tracks)
+    elapsed = time.time() - t0
+    device = mover.getBackend()
+    return elapsed, device.filesWritten, {
+        'bytes': device.bytesWritten, 'requests': device.requests,
+        'MBps': device.bytesWritten / 1048576.0 / (elapsed or 1)}
+
+
+def benchFreshen(xml, workDir, options):
+    mover = _makeMover(xml, workDir, options)
+    # Fill the device first, then time replacing a third of it.
+    limit = options.get('copyLimit', 2000)
+    total, tracks = mover.getNewMusic(minFree=0)
+    mover.copyTracks(tracks[:limit])
+    device = mover.getBackend()
+    device.capacity = device.used + device.used // 3
+    device.filesWritten = device.bytesWritten = device.requests = 0
+    t0 = time.time()
+    mover.freshenMusic(minFree=0)
+    elapsed = time.time() - t0
+    return elapsed, device.filesWritten + device.filesDeleted, {
+        'copied': device.filesWritten, 'deleted': device.filesDeleted,
+        'requests': device.requests}
+
+
+PHASES = [
+    ("load-full", benchLoadFull),
+    ("load-streaming", benchLoadStreaming),
+    ("load-cached", benchLoadCached),
+    ("select", benchSelect),
+    ("select-fill", benchSelectFill),
+    ("partition", benchPartition),
+    ("copy", benchCopy),
+    ("freshen", benchFreshen),
+]
+
+
+#===============================================================================
+#
+#===============================================================================
+
+def _runInChild(func, args, results):
+    """ Run a phase, putting its results (and the process's peak memory use)
+        into a queue.
+    """
+    try:
+        elapsed, items, extra = func(*args)
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            # Reported in bytes rather than KB
+            rss /= 1024
+        results.put({'seconds': elapsed, 'items': items,
+                     'itemsPerSecond': items / elapsed if elapsed else None,
+                     'peakRssKB': rss, 'details': extra})
+    except Exception as err:
+        results.put({'error': "%s: %s" % (err.__class__.__name__, err)})
+
+
+def runPhase(func, xml, workDir, options):
+    """ Run one benchmark phase in a new process.
+
+        @return: A dictionary of results.
+    """
+    results = multiprocessing.Queue()
+    p = multiprocessing.Process(target=_runInChild,
+                                args=(func, (xml, workDir, options), results))
+    p.start()
+    result = results.get()
+    p.join()
+    return result
+
+
+def runBenchmarks(sizes, phases=None, workDir=None, options=None,
+                  verbose=True):
+    """ Run the benchmarks.
+
+        @param sizes: A list of library sizes (numbers of tracks).
+        @keyword phases: A list of phase names to run. Defaults to all.
+        @keyword workDir: The directory in which to create libraries and
+            fake devices, created if it doesn't exist. Defaults to a
+            temporary directory, deleted after.
+        @keyword options: A dictionary of options for the fake device:
+            'latency', 'bandwidth', 'capacity', 'workers' and 'copyLimit'.
+        @return: A dictionary of results, suitable for saving as JSON.
+    """
+    options = options or {}
+    phaseNames = [name for name, func in PHASES]
+    phases = phaseNames if phases is None else phases
+    for name in phases:
+        if name not in phaseNames:
+            raise ValueError("Unknown phase: %r" % name)
+
+    tempDir = workDir is None
+    if tempDir:
+        workDir = tempfile.mkdtemp(prefix="musicmover-bench-")
+    elif not os.path.exists(workDir):
+        os.makedirs(workDir)
+    report = {'created': datetime.utcnow().isoformat() + 'Z',
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'options': options,
+              'results': {}}
+    try:
+        for size in sizes:
+            xml = os.path.join(workDir, "library-%d.xml" % size)
+            if not os.path.exists(xml):
+                makeLibrary(xml, size)
+            sizeResults = report['results'][str(size)] = {}
+            for name, func in PHASES:
+                if name not in phases:
+                    continue
+                result = runPhase(func, xml, workDir, options)
+                sizeResults[name] = result
+                if verbose:
+                    print formatResult(size, name, result)
+    finally:
+        if tempDir:
+            shutil.rmtree(workDir, ignore_errors=True)
+    return report
+
+
+def formatResult(size, name, result, baseline=None):
+    """ Format one phase's results as a line of text.
+    """
+    if 'error' in result:
+        return "%8d %-15s ERROR %s" % (size, name, result['error'])
+    line = "%8d %-15s %9.3fs %12.1f/s %9.1fMB" % (size, name,
+        result['seconds'], result['itemsPerSecond'] or 0,
+        result['peakRssKB'] / 1024.0)
+    if baseline and 'seconds' in baseline and result['seconds']:
+        line += "  %5.2fx" % (baseline['seconds'] / result['seconds'])
+    return line
+
+
+def compareReports(old, new):
+    """ Print a comparison of two benchmark reports (speedup is relative to
+        the old report).
+    """
+    for size in sorted(new['results'], key=int):
+        for name, func in PHASES:
+            result = new['results'][size].get(name)
+            if result is None:
+                continue
+            baseline = old['results'].get(size, {}).get(name)
+            print formatResult(int(size), name, result, baseline)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(
+        description="Benchmark MusicMover with synthetic libraries.")
+    parser.add_argument("--sizes", "-s", default="1000,10000,100000",
+        help="Comma-separated library sizes (numbers of tracks).")
+    parser.add_argument("--phases", "-p", default=None,
+        help="Comma-separated phases to run (default: all). One or more of "
+            "%s." % ", ".join(name for name, func in PHASES))
+    parser.add_argument("--latency", "-l", type=float, default=0,
+        help="Simulated device latency per operation (seconds).")
+    parser.add_argument("--bandwidth", "-b", type=float, default=None,
+        help="Simulated device bandwidth (MB/s).")
+    parser.add_argument("--workers", "-w", type=int,
+        default=MusicMover.copyWorkers,
+        help="The number of copy workers.")
+    parser.add_argument("--copylimit", type=int, default=2000,
+        help="The maximum number of files to copy in the copy phases.")
+    parser.add_argument("--workdir", "-d", default=None,
+        help="Directory for libraries and fake devices (kept afterwards). "
+            "Defaults to a temporary directory.")
+    parser.add_argument("--output", "-o", default=None,
+        help="Save the results to this JSON file.")
+    parser.add_argument("--compare", "-c", default=None,
+        help="A previously saved JSON file to compare against.")
+
+    args = parser.parse_args()
+
+    options = {'latency': args.latency, 'workers': args.workers,
+               'copyLimit': args.copylimit}
+    if args.bandwidth:
+        options['bandwidth'] = args.bandwidth * 1048576
+    phases = args.phases.split(',') if args.phases else None
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    report = runBenchmarks(sizes, phases, args.workdir, options,
+                           verbose=args.compare is None)
+
+    if args.compare:
+        with open(args.compare, 'rb') as f:
+            compareReports(json.load(f), report)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
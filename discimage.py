@@ -0,0 +1,563 @@
+"""
+Disc images of the partitions made by ``MusicMover.partition()``, for
+backing a library up to DVD-R (or any other write-once disc).
+
+Images are ISO 9660 with Joliet extensions, written directly by Python: the
+primary (ISO 9660 level 1) names are 8.3 versions of the real ones, which
+are kept in the Joliet directories, as read by Windows, Mac OS X and Linux.
+Each image's layout (directories, and the position of every file) is worked
+out from the files' sizes before anything is written, so its exact size is
+known up front. The source files are then streamed into the image one after
+another, in large reads, with no staging copy; several images are written
+at once by ``writeImages()``.
+"""
+
+import multiprocessing
+import os
+import Queue
+import re
+import struct
+import sys
+import threading
+import time
+
+#===============================================================================
+#
+#===============================================================================
+
+SECTOR_SIZE = 2048
+
+# Characters not allowed in ISO 9660 (level 1) and Joliet names.
+_NOT_D_CHARS = re.compile(r'[^A-Z0-9_]')
+_NOT_JOLIET_CHARS = re.compile(u'[\x00-\x1f*/:;?\\\\\ud800-\udfff]'
+                               u'|[^\x00-\uffff]')
+
+
+class DiscImageError(Exception):
+    """ Raised when an image can't be laid out or written.
+    """
+    pass
+
+
+def _both16(n):
+    return struct.pack('<H', n) + struct.pack('>H', n)
+
+
+def _both32(n):
+    return struct.pack('<I', n) + struct.pack('>I', n)
+
+
+def _recordDate(t):
+    """ Build the 7 byte date used in directory records.
+    """
+    t = time.gmtime(t)
+    return struct.pack('7B', t.tm_year - 1900, t.tm_mon, t.tm_mday,
+                       t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+
+def _volumeDate(t):
+    """ Build the 17 byte date used in volume descriptors.
+    """
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(t)) + '00\0'
+
+
+def _dirRecord(ident, lba, size, isDir, date):
+    """ Build a directory record.
+    """
+    pad = '\0' if len(ident) % 2 == 0 else ''
+    return (chr(33 + len(ident) + len(pad)) + '\0' + _both32(lba) +
+            _both32(size) + date + chr(2 if isDir else 0) + '\0\0' +
+            _both16(1) + chr(len(ident)) + ident + pad)
+
+
+def _pack(records):
+    """ Lay out directory records in sectors; a record may not cross a
+        sector boundary.
+    """
+    sectors = []
+    current = ''
+    for r in records:
+        if len(current) + len(r) > SECTOR_SIZE:
+            sectors.append(current.ljust(SECTOR_SIZE, '\0'))
+            current = ''
+        current += r
+    sectors.append(current.ljust(SECTOR_SIZE, '\0'))
+    return ''.join(sectors)
+
+
+def _packedSize(lengths):
+    """ Get the size of the directory records ``_pack()`` would produce,
+        from their lengths.
+    """
+    sectors, used = 1, 0
+    for n in lengths:
+        if used + n > SECTOR_SIZE:
+            sectors += 1
+            used = 0
+        used += n
+    return sectors * SECTOR_SIZE
+
+
+def _sectors(size):
+    return -(-size // SECTOR_SIZE)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class _Entry(object):
+    """ A file or directory in an image.
+    """
+    isDir = False
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.iso = None
+        self.joliet = None
+
+
+class _File(_Entry):
+    def __init__(self, name, parent, source, size, mtime):
+        _Entry.__init__(self, name, parent)
+        self.source = source
+        self.size = size
+        self.date = _recordDate(mtime)
+        self.lba = 0
+
+
+class _Directory(_Entry):
+    isDir = True
+
+    def __init__(self, name, parent):
+        _Entry.__init__(self, name, parent)
+        self.children = {}
+        self.lba = {}
+        self.size = {}
+
+
+    def getDir(self, name):
+        d = self.children.get(name)
+        if d is None:
+            d = self.children[name] = _Directory(name, self)
+        elif not d.isDir:
+            raise DiscImageError("%r is both a file and a directory" % name)
+        return d
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class DiscImage(object):
+    """ An ISO 9660 disc image, with Joliet names, of a set of local files.
+        Files are added with ``addFile()``; the image is laid out when
+        first needed (e.g. by ``getSize()``), and streamed to disk by
+        ``write()``.
+
+        @cvar jolietMaxLength: The maximum length of a Joliet name. The
+            standard allows 64 characters; longer names are shortened,
+            keeping the extension.
+        @cvar bufferSize: The size of each read from a source file.
+        @ivar volumeId: The name of the volume.
+    """
+
+    jolietMaxLength = 64
+    bufferSize = 4 * 1024 * 1024
+
+    def __init__(self, volumeId="MUSIC"):
+        """ Constructor.
+            @keyword volumeId: The name of the volume. Converted to
+                uppercase letters, digits and underscores, as ISO 9660
+                requires (the Joliet volume name is left as given).
+        """
+        self.volumeId = volumeId
+        self.created = time.time()
+        self.root = _Directory(u'', None)
+        self.root.parent = self.root
+        self.files = []
+        self._size = None
+
+
+    def __repr__(self):
+        return "<%s %r: %d files>" % (self.__class__.__name__, self.volumeId,
+                                      len(self.files))
+
+
+    def addFile(self, path, source, size=None, mtime=None):
+        """ Add a file to the image. If a file with the same path has
+            already been added, it is kept, and the new one is ignored.
+
+            @param path: The file's path within the image, relative to its
+                root, e.g. "Artist/Album/Track.mp3".
+            @param source: The name of the local file to put in the image.
+            @keyword size: The size of the source file, if already known.
+            @keyword mtime: The modification time of the source file, if
+                already known.
+            @return: `True` if the file was added.
+        """
+        if isinstance(path, str):
+            path = path.decode('utf-8', 'replace')
+        parts = [p for p in path.split(os.sep) if p]
+        if not parts:
+            raise DiscImageError("Bad path in image: %r" % path)
+        d = self.root
+        for p in parts[:-1]:
+            d = d.getDir(p)
+        if parts[-1] in d.children:
+            if d.children[parts[-1]].isDir:
+                raise DiscImageError("%r is both a file and a directory" % \
+                                     path)
+            return False
+        if size is None or mtime is None:
+            st = os.stat(source)
+            size = st.st_size if size is None else size
+            mtime = st.st_mtime if mtime is None else mtime
+        if size >= 2**32:
+            raise DiscImageError("%s is too big for ISO 9660" % source)
+        f = _File(parts[-1], d, source, size, mtime)
+        d.children[parts[-1]] = f
+        self.files.append(f)
+        self._size = None
+        return True
+
+
+    def getDataSize(self):
+        """ Get the total size of the files in the image, each rounded up to
+            whole sectors.
+        """
+        return sum(_sectors(f.size) for f in self.files) * SECTOR_SIZE
+
+
+    def getSize(self):
+        """ Get the size of the image: the files, plus the volume
+            descriptors, path tables and directories.
+        """
+        if self._size is None:
+            self._layout()
+        return self._size
+
+
+    #===========================================================================
+    # Layout
+    #===========================================================================
+
+    def _isoName(self, entry, used):
+        """ Make a unique ISO 9660 level 1 (8.3) name for an entry.
+        """
+        if entry.isDir:
+            base, ext = entry.name, u''
+        else:
+            base, ext = os.path.splitext(entry.name)
+        base = _NOT_D_CHARS.sub('_', base.upper())[:8] or '_'
+        ext = _NOT_D_CHARS.sub('_', ext[1:].upper())[:3]
+        name = base
+        n = 0
+        while (name, ext) in used:
+            n += 1
+            suffix = "_%d" % n
+            name = base[:8 - len(suffix)] + suffix
+        used.add((name, ext))
+        if entry.isDir:
+            return str(name)
+        return str("%s.%s;1" % (name, ext))
+
+
+    def _jolietName(self, entry, used):
+        """ Make a unique Joliet name for an entry. Names are compared
+            without regard to case, as Windows does.
+        """
+        name = _NOT_JOLIET_CHARS.sub(u'_', entry.name)
+        base, ext = (name, u'') if entry.isDir else os.path.splitext(name)
+        maxLength = self.jolietMaxLength
+        if len(ext) > maxLength // 2:
+            base, ext = name, u''
+        name = base[:maxLength - len(ext)] + ext
+        n = 0
+        while name.lower() in used:
+            n += 1
+            suffix = u"~%d" % n
+            name = base[:maxLength - len(ext) - len(suffix)] + suffix + ext
+        used.add(name.lower())
+        return name.encode('utf-16-be')
+
+
+    def _getDirs(self, view):
+        """ Get all the directories, in path table order: breadth first,
+            sorted by name within each parent.
+        """
+        dirs = [self.root]
+        for d in dirs:
+            children = [e for e in d.children.itervalues() if e.isDir]
+            children.sort(key=lambda e: getattr(e, view))
+            dirs.extend(children)
+        return dirs
+
+
+    def _getRecords(self, d, view):
+        """ Get the directory records of a directory, in the given view
+            ('iso' or 'joliet').
+        """
+        date = _recordDate(self.created)
+        records = [_dirRecord('\0', d.lba[view], d.size[view], True, date),
+                   _dirRecord('\1', d.parent.lba[view], d.parent.size[view],
+                              True, date)]
+        children = sorted(d.children.itervalues(),
+                          key=lambda e: getattr(e, view))
+        for e in children:
+            if e.isDir:
+                records.append(_dirRecord(getattr(e, view), e.lba[view],
+                                          e.size[view], True, date))
+            else:
+                records.append(_dirRecord(getattr(e, view), e.lba, e.size,
+                                          False, e.date))
+        return records
+
+
+    def _getPathTable(self, dirs, view, fmt):
+        """ Build a path table. `fmt` is the `struct` byte order: "<" for
+            the little-endian table, ">" for the big-endian one.
+        """
+        numbers = dict((id(d), n) for n, d in enumerate(dirs, 1))
+        table = []
+        for d in dirs:
+            ident = '\0' if d is self.root else getattr(d, view)
+            table.append(chr(len(ident)) + '\0' +
+                         struct.pack(fmt + 'IH', d.lba[view],
+                                     numbers[id(d.parent)]) +
+                         ident + ('\0' * (len(ident) % 2)))
+        return ''.join(table)
+
+
+    def _layout(self):
+        """ Name every entry, and work out where each directory and file
+            goes in the image. Sectors 16-18 hold the volume descriptors,
+            followed by the path tables, the directories, and the files (in
+            path order).
+        """
+        views = ('iso', 'joliet')
+        allDirs = self._getDirs('name')
+        for d in allDirs:
+            # Named in a fixed order, so names don't depend on the order
+            # in which files were added.
+            entries = sorted(d.children.itervalues(), key=lambda e: e.name)
+            isoNames, jolietNames = set(), set()
+            for e in entries:
+                e.iso = self._isoName(e, isoNames)
+                e.joliet = self._jolietName(e, jolietNames)
+
+        self._dirs = {}
+        self._pathTables = {}
+        lba = 19
+        for view in views:
+            dirs = self._dirs[view] = self._getDirs(view)
+            for d in dirs:
+                d.lba[view] = 0
+                d.size[view] = 0
+            # Only the lengths matter for now; the real tables come later.
+            size = len(self._getPathTable(dirs, view, '<'))
+            self._pathTables[view] = (lba, lba + _sectors(size), size)
+            lba += _sectors(size) * 2
+
+        for view in views:
+            for d in self._dirs[view]:
+                size = _packedSize(len(r) for r in self._getRecords(d, view))
+                d.size[view] = size
+                d.lba[view] = lba
+                lba += size // SECTOR_SIZE
+
+        self.files.sort(key=lambda f: self._getPath(f))
+        for f in self.files:
+            f.lba = lba
+            lba += _sectors(f.size)
+        self._sectorCount = lba
+        self._size = lba * SECTOR_SIZE
+
+
+    def _getPath(self, entry):
+        path = []
+        while entry is not self.root:
+            path.append(entry.name)
+            entry = entry.parent
+        return path[::-1]
+
+
+    def _text(self, s, length, joliet):
+        """ Build a fixed-length text field of a volume descriptor.
+        """
+        if joliet:
+            s = s.encode('utf-16-be')[:length & ~1]
+            s += u' '.encode('utf-16-be') * ((length - len(s)) // 2)
+            return s.ljust(length, ' ')
+        return str(s[:length]).ljust(length, ' ')
+
+
+    def _volumeDescriptor(self, view):
+        """ Build the primary (ISO 9660) or supplementary (Joliet) volume
+            descriptor.
+        """
+        joliet = view == 'joliet'
+        if joliet:
+            volumeId = self.volumeId
+            if isinstance(volumeId, str):
+                volumeId = volumeId.decode('utf-8', 'replace')
+            volumeId = volumeId[:16]
+        else:
+            volumeId = _NOT_D_CHARS.sub('_', self.volumeId.upper())
+        lTable, mTable, tableSize = self._pathTables[view]
+        date = _volumeDate(self.created)
+        noDate = '0' * 16 + '\0'
+        root = _dirRecord('\0', self.root.lba[view], self.root.size[view],
+                          True, _recordDate(self.created))
+        d = ''.join([
+            chr(2 if joliet else 1), 'CD001\1\0',
+            self._text(u'', 32, joliet),
+            self._text(volumeId, 32, joliet),
+            '\0' * 8,
+            _both32(self._sectorCount),
+            # Escape sequence for UCS-2 level 3
+            ('%/E' if joliet else '').ljust(32, '\0'),
+            _both16(1), _both16(1), _both16(SECTOR_SIZE),
+            _both32(tableSize),
+            struct.pack('<II', lTable, 0),
+            struct.pack('>II', mTable, 0),
+            root,
+            self._text(u'', 128, joliet),
+            self._text(u'', 128, joliet),
+            self._text(u'', 128, joliet),
+            self._text(u'MUSICMOVER', 128, joliet),
+            self._text(u'', 37, joliet),
+            self._text(u'', 37, joliet),
+            self._text(u'', 37, joliet),
+            date, date, noDate, noDate,
+            '\1'])
+        return d.ljust(SECTOR_SIZE, '\0')
+
+
+    def _getHeader(self):
+        """ Build everything in the image before the first file.
+        """
+        parts = ['\0' * (16 * SECTOR_SIZE),
+                 self._volumeDescriptor('iso'),
+                 self._volumeDescriptor('joliet'),
+                 ('\xffCD001\1').ljust(SECTOR_SIZE, '\0')]
+        for view in ('iso', 'joliet'):
+            for fmt in '<>':
+                table = self._getPathTable(self._dirs[view], view, fmt)
+                parts.append(table.ljust(_sectors(len(table)) * SECTOR_SIZE,
+                                         '\0'))
+        for view in ('iso', 'joliet'):
+            for d in self._dirs[view]:
+                parts.append(_pack(self._getRecords(d, view)))
+        return ''.join(parts)
+
+
+    #===========================================================================
+    #
+    #===========================================================================
+
+    def write(self, filename, canceled=None):
+        """ Write the image. The source files are read in order, each from
+            start to end in reads of `bufferSize`. The image is written to
+            a temporary file and renamed once complete.
+
+            @param filename: The name of the image file.
+            @keyword canceled: A function returning `True` if the work
+                should stop; checked before each file is read.
+            @return: The size of the image, or `None` if canceled.
+        """
+        size = self.getSize()
+        temp = "%s.tmp" % filename
+        try:
+            with open(temp, 'wb') as out:
+                out.write(self._getHeader())
+                for f in self.files:
+                    if canceled is not None and canceled():
+                        return None
+                    self._writeFile(f, out)
+                if out.tell() != size:
+                    raise DiscImageError("%s is %d bytes, not %d" % \
+                                         (filename, out.tell(), size))
+            os.rename(temp, filename)
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+        return size
+
+
+    def _writeFile(self, f, out):
+        """ Copy one source file into the image, padded to a whole sector.
+        """
+        remaining = f.size
+        with open(f.source, 'rb') as src:
+            while remaining > 0:
+                data = src.read(min(self.bufferSize, remaining))
+                if not data:
+                    raise DiscImageError("%s got smaller after the image "
+                                         "was laid out" % f.source)
+                out.write(data)
+                remaining -= len(data)
+        out.write('\0' * (-f.size % SECTOR_SIZE))
+
+
+#===============================================================================
+#
+#===============================================================================
+
+def writeImages(images, workers=None, canceled=None):
+    """ Write several disc images at once, each by its own thread. Writing
+        an image is mostly waiting on the disk, so `workers` should be about
+        the number of disks being read and written.
+
+        @param images: A list of (<`DiscImage`>, <filename>) tuples.
+        @keyword workers: The number of images to write at once. Defaults to
+            the number of CPU cores.
+        @keyword canceled: A function returning `True` if the work should
+            stop.
+        @return: A generator of (<filename>, <size>, <elapsed time>) tuples,
+            in the order the images are finished.
+    """
+    if not images:
+        return
+    workers = min(workers or multiprocessing.cpu_count(), len(images))
+    todo = Queue.Queue()
+    for job in images:
+        todo.put(job)
+    done = Queue.Queue()
+    stopped = []
+
+    def isCanceled():
+        return bool(stopped) or (canceled is not None and canceled())
+
+    def work():
+        while True:
+            try:
+                image, filename = todo.get_nowait()
+            except Queue.Empty:
+                return
+            if isCanceled():
+                done.put((filename, None, None, None))
+                continue
+            started = time.time()
+            try:
+                size = image.write(filename, isCanceled)
+                done.put((filename, size, time.time() - started, None))
+            except Exception:
+                done.put((filename, None, None, sys.exc_info()))
+
+    threads = [threading.Thread(target=work) for _ in xrange(workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for _ in images:
+            filename, size, elapsed, exc = done.get()
+            if exc is not None:
+                raise exc[0], exc[1], exc[2]
+            if size is not None:
+                yield filename, size, elapsed
+    finally:
+        stopped.append(True)
+        for t in threads:
+            t.join()
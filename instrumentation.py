@@ -0,0 +1,267 @@
+"""
+Observers for monitoring `MusicMover` operations: the time taken by each
+phase (loading the library, walking the target, selecting music, deleting
+and copying), the size and duration of each file copied or deleted, and the
+rate of copying.
+
+An observer is any object with the methods of `Observer`. Add it to a
+`MusicMover`'s `observers` list, or pass it to the constructor. All
+notifications are made on the thread that called the `MusicMover` method,
+so observers needn't be thread-safe.
+"""
+
+import json
+import sys
+import time
+from collections import deque
+
+#===============================================================================
+#
+#===============================================================================
+
+class Observer(object):
+    """ The notifications sent to an observer. This version ignores them
+        all; subclass it and override the interesting ones.
+    """
+
+    def phaseStarted(self, name):
+        """ Called when a phase of an operation starts.
+
+            @param name: The phase: 'load', 'walk', 'select', 'delete',
+                'rename', 'transcode', 'copy' or 'image'.
+        """
+        pass
+
+
+    def phaseFinished(self, name, elapsed):
+        """ Called when a phase of an operation ends.
+
+            @param name: The phase.
+            @param elapsed: The duration of the phase, in seconds.
+        """
+        pass
+
+
+    def copyStarted(self, totalFiles, totalBytes):
+        """ Called before a set of files is copied.
+
+            @param totalFiles: The number of files to be copied.
+            @param totalBytes: The total size of the files.
+        """
+        pass
+
+
+    def fileCopied(self, filename, size, elapsed):
+        """ Called after each file is copied.
+
+            @param filename: The name of the copy.
+            @param size: The size of the file, in bytes.
+            @param elapsed: The time taken to copy the file, in seconds.
+                Several files may be copied at once, so this can add up to
+                more than the duration of the 'copy' phase.
+        """
+        pass
+
+
+    def fileDeleted(self, filename, size, elapsed):
+        """ Called after each file is deleted.
+
+            @param filename: The name of the deleted file.
+            @param size: The size of the file, in bytes, or `None` if it
+                wasn't known.
+            @param elapsed: The time taken to delete the file, in seconds.
+        """
+        pass
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class ThroughputMonitor(Observer):
+    """ Keeps totals of the time spent in each phase and of the files copied
+        and deleted, and measures the current rate of copying.
+
+        @ivar window: The period (seconds) over which the copy rate is
+            measured.
+        @ivar phases: The total time (seconds) spent in each phase, by name.
+        @ivar totalFiles: The number of files to be copied.
+        @ivar totalBytes: The total size of the files to be copied.
+        @ivar filesCopied: The number of files copied so far.
+        @ivar bytesCopied: The total size of the files copied so far.
+        @ivar filesDeleted: The number of files deleted so far.
+        @ivar bytesDeleted: The total size of the files deleted so far (if
+            known).
+    """
+
+    def __init__(self, window=10.0):
+        """ Constructor.
+            @keyword window: The period (seconds) over which the copy rate
+                is measured.
+        """
+        self.window = window
+        self.reset()
+
+
+    def reset(self):
+        """ Clear all totals.
+        """
+        self.phases = {}
+        self.totalFiles = 0
+        self.totalBytes = 0
+        self.filesCopied = 0
+        self.bytesCopied = 0
+        self.copyTime = 0.0
+        self.filesDeleted = 0
+        self.bytesDeleted = 0
+        self.deleteTime = 0.0
+        # (time, bytes) for each file copied within the window. The first
+        # entry marks the start of the period measured.
+        self._recent = deque()
+        self._recentBytes = 0
+
+
+    def phaseFinished(self, name, elapsed):
+        self.phases[name] = self.phases.get(name, 0) + elapsed
+
+
+    def copyStarted(self, totalFiles, totalBytes):
+        self.totalFiles += totalFiles
+        self.totalBytes += totalBytes
+        if not self._recent:
+            self._recent.append((time.time(), 0))
+
+
+    def fileCopied(self, filename, size, elapsed):
+        self.filesCopied += 1
+        self.bytesCopied += size
+        self.copyTime += elapsed
+        now = time.time()
+        recent = self._recent
+        recent.append((now, size))
+        self._recentBytes += size
+        while len(recent) > 2 and recent[1][0] < now - self.window:
+            self._recentBytes -= recent.popleft()[1]
+
+
+    def fileDeleted(self, filename, size, elapsed):
+        self.filesDeleted += 1
+        self.bytesDeleted += size or 0
+        self.deleteTime += elapsed
+
+
+    def getRate(self):
+        """ Get the recent copy rate.
+            @return: The rate in bytes per second, or `None` if nothing has
+                been copied yet.
+        """
+        recent = self._recent
+        if len(recent) < 2:
+            return None
+        span = recent[-1][0] - recent[0][0]
+        if span <= 0:
+            return None
+        return (self._recentBytes - recent[0][1]) / span
+
+
+    def getEta(self):
+        """ Estimate the time remaining to copy the rest of the files, at
+            the recent rate.
+            @return: The time remaining (seconds), or `None` if it can't be
+                estimated yet.
+        """
+        rate = self.getRate()
+        if not rate:
+            return None
+        return max(self.totalBytes - self.bytesCopied, 0) / rate
+
+
+    def getSummary(self):
+        """ Get all the totals as a dictionary (suitable for JSON).
+        """
+        rate = self.getRate()
+        return {'phases': dict(self.phases),
+                'totalFiles': self.totalFiles,
+                'totalBytes': self.totalBytes,
+                'filesCopied': self.filesCopied,
+                'bytesCopied': self.bytesCopied,
+                'copyTime': self.copyTime,
+                'filesDeleted': self.filesDeleted,
+                'bytesDeleted': self.bytesDeleted,
+                'deleteTime': self.deleteTime,
+                'rate': None if rate is None else rate / 1048576.0,
+                'eta': self.getEta()}
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class JsonLogger(ThroughputMonitor):
+    """ Writes every notification to a stream as a line of JSON, for
+        feeding to a monitoring system. Each line is an object with the keys
+        'event' (the name of the notification), 'time' (seconds since the
+        epoch) and the notification's arguments. Lines for copied files also
+        include the recent copy rate ('rate', in MB/s) and the estimated
+        time remaining ('eta', in seconds).
+    """
+
+    def __init__(self, stream=None, window=10.0):
+        """ Constructor.
+            @keyword stream: The file-like object to which to write.
+                Defaults to `sys.stdout`.
+            @keyword window: The period (seconds) over which the copy rate
+                is measured.
+        """
+        self.stream = sys.stdout if stream is None else stream
+        ThroughputMonitor.__init__(self, window)
+
+
+    def write(self, event, **data):
+        """ Write one line of JSON. Byte strings (e.g. filenames) that
+            aren't valid UTF-8 have the bad bytes replaced, rather than
+            failing partway through a copy.
+        """
+        for k, v in data.items():
+            if isinstance(v, str):
+                data[k] = v.decode('utf-8', 'replace')
+        data['event'] = event
+        data['time'] = time.time()
+        self.stream.write(json.dumps(data, sort_keys=True) + "\n")
+        self.stream.flush()
+
+
+    def phaseStarted(self, name):
+        ThroughputMonitor.phaseStarted(self, name)
+        self.write('phaseStarted', phase=name)
+
+
+    def phaseFinished(self, name, elapsed):
+        ThroughputMonitor.phaseFinished(self, name, elapsed)
+        self.write('phaseFinished', phase=name, elapsed=elapsed)
+
+
+    def copyStarted(self, totalFiles, totalBytes):
+        ThroughputMonitor.copyStarted(self, totalFiles, totalBytes)
+        self.write('copyStarted', totalFiles=totalFiles,
+                   totalBytes=totalBytes)
+
+
+    def fileCopied(self, filename, size, elapsed):
+        ThroughputMonitor.fileCopied(self, filename, size, elapsed)
+        rate = self.getRate()
+        self.write('fileCopied', filename=filename, size=size,
+                   elapsed=elapsed, eta=self.getEta(),
+                   rate=None if rate is None else rate / 1048576.0)
+
+
+    def fileDeleted(self, filename, size, elapsed):
+        ThroughputMonitor.fileDeleted(self, filename, size, elapsed)
+        self.write('fileDeleted', filename=filename, size=size,
+                   elapsed=elapsed)
+
+
+    def writeSummary(self):
+        """ Write the totals (see ``getSummary()``) as a 'summary' event.
+        """
+        self.write('summary', **self.getSummary())
@@ -9,16 +9,50 @@ Requires Python 2.6/7 and MacOS X.
     any places that could spend the generator unexpectedly.
 @todo: Consider removing target directory from method arguments, using only
     the target specified when the MusicMover object was created.
-@todo: See about burning DVD-R from Python, for use with MusicMover.partition().
-    Can probably be done with osascript, albeit slowly.
+@todo: See about burning DVD-R from Python, using the images written by
+    ``MusicMover.writeDiscImages()``. Can probably be done with osascript
+    (or ``hdiutil burn``).
 """
 
+import calendar
+import errno
+import gzip
+import hashlib
+import marshal
+import mmap
 import os
 import plistlib
+import Queue
 import random
 import shutil
+import sqlite3
+import string
+import struct
+import sys
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import chain, takewhile
 from urllib import url2pathname, unquote
 from urlparse import urlparse
+from xml.etree.cElementTree import iterparse
+
+import discimage
+import packing
+import sampling
+import targets
+from transcode import quickHash
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Path components that os.path.abspath() would alter or remove.
+_specialNames = frozenset(('', os.curdir, os.pardir))
+
 
 #===============================================================================
 # 
@@ -28,15 +62,456 @@ class iTunesLibrary(object):
     """ A class wrapping the iTunes Library XML data. Abstracted for possibly
         implementing as a real database or something more directly in
         communication with iTunes.
+
+        @cvar trackFields: The track fields kept when loading in streaming
+            mode; these are the only ones `MusicMover` actually uses.
+        @cvar cacheVersion: The version of the snapshot cache format. Caches
+            with a different version are ignored.
+        @ivar cacheFile: The name of the snapshot cache file, or `None` if
+            caching is disabled.
+        @ivar cached: `True` if the library was loaded from the cache.
+        @ivar extras: A dictionary of additional data derived from the
+            library, saved in the snapshot cache along with it. Values must
+            be things `marshal` can store. Discarded when the XML changes,
+            except for those named in `keptExtras`.
+        @cvar keptExtras: The keys of `extras` that remain valid when the
+            XML changes (their entries check themselves against the tracks).
+        @ivar changes: A `LibraryChanges` listing the differences between
+            the library and the snapshot made before the XML last changed,
+            or `None` if there was no such snapshot.
     """
+
+    trackFields = ('Track ID', 'Location', 'Size', 'Artist', 'Album',
+                   'Compilation')
+
+    cacheVersion = 2
+    cacheExt = ".mmcache"
+    keptExtras = ('targetNames',)
     
-    def __init__(self, library="~/Music/iTunes/iTunes Music Library.xml"):
+    # Cache file header: magic, format version, marshal version, XML mtime,
+    # XML size, hash of the XML's head and tail, sizes of the index and the
+    # kept extras (which precede the rest of the snapshot).
+    _cacheHeader = struct.Struct("<4sHHdQ16sQQ")
+    _cacheMagic = "MMLC"
+    _hashChunk = 65536
+
+    def __init__(self, library="~/Music/iTunes/iTunes Music Library.xml",
+                 streaming=False, fields=None, cache=None):
+        """ Constructor.
+            @keyword library: The path and name of the iTunes music library
+                XML file.
+            @keyword streaming: If `True`, parse the XML incrementally and
+                keep only the track fields named in `fields`, rather than
+                reading the entire plist into memory. Much faster and
+                smaller for large libraries.
+            @keyword fields: A list of track fields to keep when streaming.
+                Defaults to `trackFields`.
+            @keyword cache: Where to keep a snapshot of the parsed library,
+                which is used instead of the XML as long as the XML hasn't
+                changed. `True` puts the snapshot next to the XML file; a
+                string is the path of a directory in which to keep it. 
+                `None` or `False` disables the cache.
+        """
         self.filename = os.path.realpath(os.path.expanduser(library))
-        self.libdata = plistlib.readPlist(self.filename)
+        self.streaming = streaming
+        self.fields = frozenset(self.trackFields if fields is None else fields)
+        self.cacheFile = self._getCacheFilename(cache)
+        self.cached = False
+        self.cacheKey = None
         self.playlists = {}
+        self.playlistIds = {}
+        self.extras = {}
+        self.changes = None
+        
+        if self.cacheFile:
+            self.cacheKey = self._getCacheKey()
+            self.cached = self._loadCache(self.cacheKey)
+        if self.cached:
+            return
+        
+        if streaming:
+            self._loadStreaming()
+        else:
+            self._loadPlist()
+        
+        if self.cacheFile:
+            previous = self._readCache(index=True)
+            if previous is not None:
+                self._compareSnapshot(previous)
+            self.saveCache()
+
+
+    #===========================================================================
+    # Snapshot cache
+    #===========================================================================
+
+    def _getCacheFilename(self, cache):
+        """ Get the name of the snapshot cache file.
+        
+            @param cache: `True`, a directory name, or `None`/`False`. See
+                ``__init__()``.
+        """
+        if not cache:
+            return None
+        if cache is True:
+            path, name = os.path.split(self.filename)
+            return os.path.join(path, ".%s%s" % (name, self.cacheExt))
+        cache = os.path.realpath(os.path.expanduser(cache))
+        return os.path.join(cache, hashlib.md5(self.filename).hexdigest() \
+                            + self.cacheExt)
+
+
+    def _getCacheKey(self):
+        """ Get the values identifying the current state of the library XML
+            file: its modification time, its size, and an MD5 hash of its
+            first and last 64KB (iTunes rewrites the whole file, so the
+            head and tail both contain recent changes).
+            
+            @return: A tuple containing (<mtime>, <size>, <hash>)
+        """
+        st = os.stat(self.filename)
+        return (st.st_mtime, st.st_size, 
+                quickHash(self.filename, st.st_size, self._hashChunk))
+
+
+    @classmethod
+    def _encode(cls, v):
+        """ Convert a plist value into something `marshal` can store.
+            Dates and data are converted to tagged tuples (plists have no
+            tuples of their own).
+        """
+        if isinstance(v, datetime):
+            return ('date', calendar.timegm(v.utctimetuple()))
+        elif isinstance(v, plistlib.Data):
+            return ('data', v.data)
+        elif isinstance(v, dict):
+            return dict((k, cls._encode(x)) for k, x in v.iteritems())
+        elif isinstance(v, list):
+            return [cls._encode(x) for x in v]
+        return v
+
+
+    @classmethod
+    def _decode(cls, v):
+        """ Restore a value converted by ``_encode()``.
+        """
+        if isinstance(v, tuple):
+            if v[0] == 'date':
+                return datetime.utcfromtimestamp(v[1])
+            return plistlib.Data(v[1])
+        elif isinstance(v, dict):
+            return dict((k, cls._decode(x)) for k, x in v.iteritems())
+        elif isinstance(v, list):
+            return [cls._decode(x) for x in v]
+        return v
+
+
+    def _getCacheData(self):
+        """ Build the snapshot stored in the cache. Tracks are stored as-is
+            (after encoding any values `marshal` can't handle), so loading
+            them is done entirely in C. The names of track fields that 
+            need decoding are kept so that only those get touched on load.
+        """
+        tracks = {}
+        encodedFields = set()
+        for k, t in self.tracks.iteritems():
+            for v in t.itervalues():
+                if isinstance(v, (datetime, plistlib.Data)):
+                    t = self._encode(t)
+                    encodedFields.update(f for f, x in t.iteritems()
+                                         if isinstance(x, tuple))
+                    break
+            tracks[k] = t
+        
+        libdata = dict((k, v) for k, v in self.libdata.iteritems()
+                       if k not in ('Tracks', 'Playlists'))
+        extras = dict((k, v) for k, v in self.extras.iteritems()
+                      if k not in self.keptExtras)
+        playlistIds = dict((k, v.tostring()) 
+                           for k, v in self.playlistIds.iteritems())
+        
+        return {'streaming': self.streaming,
+                'fields': tuple(sorted(self.fields)),
+                'libdata': self._encode(libdata),
+                'tracks': tracks,
+                'encodedFields': tuple(encodedFields),
+                'playlists': self._encode(self.libdata['Playlists']),
+                'playlistIds': playlistIds,
+                'extras': extras,
+                'changes': None if self.changes is None \
+                    else self.changes.toCache()}
+
+
+    def _getCacheIndex(self):
+        """ Build the part of the snapshot needed to compare it with a later
+            version of the library: the `LibraryChanges.fields` of each 
+            track. It is stored separately, so an out-of-date snapshot can
+            be compared without loading all of it.
+        """
+        fields = LibraryChanges.fields
+        return dict((k, dict((f, t[f]) for f in fields if f in t))
+                    for k, t in self.tracks.iteritems())
+
+
+    def saveCache(self, cacheKey=None):
+        """ Write a snapshot of the library to the cache file. The file is
+            written under a temporary name and then renamed, so a reader
+            never sees a partial snapshot. Failure to write the cache is
+            not an error.
+            
+            @keyword cacheKey: The XML's (mtime, size, hash), as returned by
+                ``_getCacheKey()``. Defaults to that of the XML as it was 
+                when the library was loaded.
+        """
+        if not self.cacheFile:
+            return False
+        if cacheKey is None:
+            cacheKey = self.cacheKey or self._getCacheKey()
+        mtime, size, digest = cacheKey
+        tempName = "%s.%d.tmp" % (self.cacheFile, os.getpid())
+        try:
+            cacheDir = os.path.dirname(self.cacheFile)
+            if not os.path.exists(cacheDir):
+                os.makedirs(cacheDir)
+            index = marshal.dumps(self._getCacheIndex(), marshal.version)
+            kept = marshal.dumps(dict((k, self.extras[k]) 
+                                      for k in self.keptExtras
+                                      if k in self.extras), marshal.version)
+            with open(tempName, 'wb') as f:
+                f.write(self._cacheHeader.pack(self._cacheMagic, 
+                                               self.cacheVersion,
+                                               marshal.version,
+                                               mtime, size, digest,
+                                               len(index), len(kept)))
+                f.write(index)
+                f.write(kept)
+                marshal.dump(self._getCacheData(), f, marshal.version)
+            os.rename(tempName, self.cacheFile)
+        except (IOError, OSError):
+            if os.path.exists(tempName):
+                os.remove(tempName)
+            return False
+        return True
+
+
+    def _readCache(self, cacheKey=None, index=False):
+        """ Read the snapshot from the cache file, if it is current. The
+            file is memory-mapped, so an out-of-date snapshot is rejected
+            after reading only its header, and only the parts of it that
+            are wanted get unmarshaled.
+            
+            @keyword cacheKey: The XML's (mtime, size, hash). If `None`, the
+                snapshot is returned regardless of whether it is current.
+            @keyword index: If `True`, read only the snapshot's index (see
+                ``_getCacheIndex()``), as its `tracks`, and its kept 
+                `extras`.
+            @return: The cached data (a dictionary), or `None`.
+        """
+        if not self.cacheFile or not os.path.exists(self.cacheFile):
+            return None
+        hsize = self._cacheHeader.size
+        try:
+            with open(self.cacheFile, 'rb') as f:
+                if os.fstat(f.fileno()).st_size <= hsize:
+                    return None
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    header = self._cacheHeader.unpack(mm[:hsize])
+                    if header[:3] != (self._cacheMagic, self.cacheVersion,
+                                      marshal.version):
+                        return None
+                    if cacheKey is not None \
+                            and header[3:6] != tuple(cacheKey):
+                        return None
+                    indexSize, keptSize = header[6:]
+                    start = hsize + indexSize
+                    end = start + keptSize
+                    if index:
+                        data = {'tracks': marshal.loads(mm[hsize:start])}
+                    else:
+                        data = marshal.loads(mm[end:])
+                    data.setdefault('extras', {}).update(
+                        marshal.loads(mm[start:end]))
+                    return data
+                finally:
+                    mm.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+
+
+    def _loadCache(self, cacheKey):
+        """ Load the library from the cache file, if the cache is current
+            and was made with the same loader settings.
+            
+            @param cacheKey: The XML's (mtime, size, hash).
+            @return: `True` if the library was loaded from the cache.
+        """
+        data = self._readCache(cacheKey)
+        if data is None:
+            return False
+        if data['streaming'] != self.streaming:
+            return False
+        if self.streaming and frozenset(data['fields']) != self.fields:
+            return False
+        
+        tracks = data['tracks']
+        encodedFields = data['encodedFields']
+        if encodedFields:
+            decode = self._decode
+            for t in tracks.itervalues():
+                for field in encodedFields:
+                    v = t.get(field)
+                    if isinstance(v, tuple):
+                        t[field] = decode(v)
+        
+        libdata = self._decode(data['libdata'])
+        libdata['Tracks'] = tracks
+        libdata['Playlists'] = self._decode(data['playlists'])
+        self.libdata = libdata
+        self.tracks = tracks
+        for pl in libdata['Playlists']:
+            self.playlists[pl.get('Name')] = pl
+        for name, ids in data['playlistIds'].iteritems():
+            self.playlistIds[name] = array('l', ids)
+        self.extras = data.get('extras', {})
+        self.changes = LibraryChanges.fromCache(data.get('changes'))
+        return True
+
+
+    def _compareSnapshot(self, data):
+        """ Find the changes between the library and an out-of-date 
+            snapshot of it, and keep any of the snapshot's `extras` that 
+            are still valid.
+            
+            @param data: The snapshot's index, as read by 
+                ``_readCache(index=True)``.
+        """
+        self.changes = LibraryChanges.compare(data['tracks'], self.tracks)
+        extras = data.get('extras', {})
+        for k in self.keptExtras:
+            if k in extras:
+                self.extras[k] = extras[k]
+
+
+    #===========================================================================
+    # XML parsing
+    #===========================================================================
+
+
+    def _loadPlist(self):
+        """ Read the entire library XML with `plistlib`.
+        """
+        self.libdata = plistlib.readPlist(self.filename)
+        self.tracks = self.libdata['Tracks']
         for pl in self.libdata['Playlists']:
             self.playlists[pl['Name']] = pl
+            self.playlistIds[pl['Name']] = array('l',
+                (p['Track ID'] for p in pl.get('Playlist Items', ())
+                 if 'Track ID' in p))
+
+
+    @classmethod
+    def _plistValue(cls, elem):
+        """ Convert a simple plist XML element to the corresponding Python
+            value, the same way `plistlib` does. Containers (``dict`` and
+            ``array``) aren't converted; `None` is returned instead.
+        """
+        tag = elem.tag
+        if tag == 'string':
+            return elem.text or ''
+        elif tag == 'integer':
+            return int(elem.text)
+        elif tag == 'true':
+            return True
+        elif tag == 'false':
+            return False
+        elif tag == 'real':
+            return float(elem.text)
+        elif tag == 'date':
+            return datetime.strptime(elem.text, "%Y-%m-%dT%H:%M:%SZ")
+        elif tag == 'data':
+            return plistlib.Data.fromBase64(elem.text or '')
+        return None
+
+
+    def _loadStreaming(self):
+        """ Incrementally parse the library XML, keeping only the track
+            fields named in `fields` and the IDs of each playlist's items.
+            Elements are discarded as soon as they have been read, so the
+            full XML tree never exists in memory.
+
+            The plist nests predictably: the top-level ``dict`` holds the
+            ``Tracks`` dict (track dicts at depth 4, their fields at depth 5)
+            and the ``Playlists`` array (playlist dicts at depth 4, their
+            fields at 5, ``Playlist Items`` entries at 6, and the item
+            fields at 7).
+        """
+        fields = self.fields
+        value = self._plistValue
+        libdata = {}
+        tracks = {}
+        playlists = []
+        
+        parents = [None] * 8
+        keys = [None] * 8
+        depth = 0
+        track = {}
+        playlist = {}
+        items = array('l')
+        
+        for event, elem in iterparse(self.filename, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                if depth < 8:
+                    parents[depth] = elem
+                continue
+
+            tag = elem.tag
+            section = keys[3]
+            if tag == 'key':
+                keys[depth] = elem.text
+            
+            elif depth == 3:
+                if tag != 'dict' and tag != 'array':
+                    libdata[section] = value(elem)
+
+            elif section == 'Tracks':
+                if depth == 5:
+                    if keys[5] in fields:
+                        track[keys[5]] = value(elem)
+                elif depth == 4:
+                    tracks[keys[4]] = track
+                    track = {}
+
+            elif section == 'Playlists':
+                if depth == 7:
+                    if keys[7] == 'Track ID':
+                        items.append(int(elem.text))
+                elif depth == 5:
+                    if tag != 'dict' and tag != 'array':
+                        playlist[keys[5]] = value(elem)
+                elif depth == 4:
+                    playlists.append(playlist)
+                    self.playlists[playlist.get('Name')] = playlist
+                    self.playlistIds[playlist.get('Name')] = items
+                    playlist = {}
+                    items = array('l')
+            
+            # Discard finished elements: clearing the parent of a completed
+            # track, playlist or playlist item drops everything read so far.
+            if depth == 4 or depth == 6:
+                parents[depth-1].clear()
+            depth -= 1
+        
+        libdata['Tracks'] = tracks
+        libdata['Playlists'] = playlists
+        self.libdata = libdata
+        self.tracks = tracks
+
 
+    #===========================================================================
+    # 
+    #===========================================================================
 
     def __repr__(self):
         return "<iTunes Library: %r>" % self.filename
@@ -54,11 +529,8 @@ class iTunesLibrary(object):
         """ Retrieve a list of all track IDs within a given playlist.
         
         """
-        playlist = self.playlists[name]
-        for p in playlist['Playlist Items']:
-            i = p.get('Track ID')
-            if i is not None:
-                yield i
+        for i in self.playlistIds[name]:
+            yield i
     
 
     def getTrackById(self, trackId):
@@ -67,7 +539,7 @@ class iTunesLibrary(object):
             @param trackId: The ID of the given track. 
             @return: The given Track, a dict-like object.
         """
-        return self.libdata['Tracks'].get(str(trackId))
+        return self.tracks.get(str(trackId))
     
 
     def getTracks(self, playlist="Music", filterFunc=None):
@@ -87,6 +559,941 @@ class iTunesLibrary(object):
                 yield t
 
 
+#===============================================================================
+# 
+#===============================================================================
+
+class LibraryChanges(object):
+    """ The differences between two versions of a library's tracks, as 
+        found by comparing the library with the last snapshot in its cache.
+        Tracks are identified by their keys in `iTunesLibrary.tracks` (i.e.
+        their Track IDs, as strings). A track can be both moved and 
+        retagged.
+        
+        @cvar fields: The fields kept from the previous version of each 
+            changed or removed track: those needed to find its old name on
+            a target.
+        @ivar added: Tracks new to the library.
+        @ivar removed: Tracks no longer in the library.
+        @ivar moved: Tracks whose Location changed.
+        @ivar retagged: Tracks whose Artist, Album or Compilation changed.
+        @ivar modified: Tracks whose Size changed, i.e. the file itself was
+            rewritten.
+        @ivar previous: The previous versions of the removed, moved,
+            retagged and modified tracks (only their `fields`), keyed by 
+            Track ID.
+    """
+    
+    fields = ('Track ID', 'Location', 'Size', 'Artist', 'Album', 
+              'Compilation')
+    
+    def __init__(self, added=(), removed=(), moved=(), retagged=(), 
+                 modified=(), previous=None):
+        self.added = list(added)
+        self.removed = list(removed)
+        self.moved = list(moved)
+        self.retagged = list(retagged)
+        self.modified = list(modified)
+        self.previous = {} if previous is None else previous
+
+
+    def __repr__(self):
+        return "<%s: %d added, %d removed, %d moved, %d retagged, " \
+            "%d modified>" % (self.__class__.__name__, len(self.added), 
+                              len(self.removed), len(self.moved), 
+                              len(self.retagged), len(self.modified))
+
+
+    def __len__(self):
+        return len(self.added) + len(self.previous)
+
+
+    @classmethod
+    def compare(cls, old, new):
+        """ Compare two versions of a library's tracks.
+        
+            @param old: The previous tracks, a dictionary keyed by Track ID.
+                Only their `fields` are used.
+            @param new: The current tracks, a dictionary keyed by Track ID.
+            @return: A new `LibraryChanges`.
+        """
+        changes = cls()
+        fields = cls.fields
+        for k, t in new.iteritems():
+            o = old.get(k)
+            if o is None:
+                changes.added.append(k)
+                continue
+            changed = False
+            if o.get('Location') != t.get('Location'):
+                changes.moved.append(k)
+                changed = True
+            if o.get('Artist') != t.get('Artist') \
+                    or o.get('Album') != t.get('Album') \
+                    or o.get('Compilation') != t.get('Compilation'):
+                changes.retagged.append(k)
+                changed = True
+            if o.get('Size') != t.get('Size'):
+                changes.modified.append(k)
+                changed = True
+            if changed:
+                changes.previous[k] = dict((f, o[f]) for f in fields 
+                                           if f in o)
+        for k, o in old.iteritems():
+            if k not in new:
+                changes.removed.append(k)
+                changes.previous[k] = dict((f, o[f]) for f in fields 
+                                           if f in o)
+        return changes
+
+
+    def getChanged(self):
+        """ Get the tracks that were moved, retagged or modified, each 
+            once.
+        """
+        removed = set(self.removed)
+        return [k for k in self.previous if k not in removed]
+
+
+    def toCache(self):
+        """ Get the changes as something `marshal` can store.
+        """
+        return {'added': self.added,
+                'removed': self.removed,
+                'moved': self.moved,
+                'retagged': self.retagged,
+                'modified': self.modified,
+                'previous': self.previous}
+
+
+    @classmethod
+    def fromCache(cls, data):
+        """ Restore changes stored by ``toCache()``. 
+        
+            @return: A new `LibraryChanges`, or `None` if `data` is `None`.
+        """
+        if data is None:
+            return None
+        return cls(**data)
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+class DestinationIndex(object):
+    """ An index of the music files on a destination device, for fast 
+        membership testing. Paths are normalized the same way
+        ``MusicMover.targetName()`` builds them (absolute, case-normalized),
+        so a generated name can be looked up directly. Also holds each
+        file's size once it is known, so the destination only needs to be
+        scanned once per run.
+        
+        @ivar backend: The `targets.TargetBackend` from which sizes not yet
+            known are got, or `None` to get them from the filesystem.
+    """
+    
+    def __init__(self, files=(), backend=None):
+        """ Constructor.
+            @keyword files: An iterable of filenames with which to populate
+                the index.
+            @keyword backend: The `targets.TargetBackend` of the files' 
+                target.
+        """
+        self.files = {}
+        self.backend = backend
+        for f in files:
+            self.add(f)
+
+
+    def __repr__(self):
+        return "<%s: %d files>" % (self.__class__.__name__, len(self.files))
+
+
+    @staticmethod
+    def normalize(filename):
+        """ Get the key used to index a filename.
+        """
+        return os.path.normcase(os.path.abspath(filename))
+
+
+    def add(self, filename, size=None):
+        """ Add a file to the index.
+        
+            @param filename: The full path and name of the file.
+            @keyword size: The size of the file in bytes, if known.
+        """
+        self.files[self.normalize(filename)] = size
+
+
+    def discard(self, filename):
+        """ Remove a file from the index, if present.
+        """
+        self.files.pop(self.normalize(filename), None)
+
+
+    def getSize(self, filename):
+        """ Get the size of an indexed file, getting it from the `backend`
+            (and remembering it) if it isn't already known.
+        """
+        key = self.normalize(filename)
+        size = self.files.get(key)
+        if size is None:
+            if self.backend is not None:
+                size = self.backend.getSize(key)
+            else:
+                size = os.path.getsize(key)
+            self.files[key] = size
+        return size
+
+
+    def getUnsized(self):
+        """ Get a list of the indexed files whose sizes aren't yet known.
+        """
+        return [f for f, size in self.files.iteritems() if size is None]
+
+
+    def getSizes(self):
+        """ Get the sizes of all indexed files. Note that the sizes of any 
+            files not yet known will be `None`.
+        """
+        return self.files.values()
+
+
+    def __contains__(self, filename):
+        return self.normalize(filename) in self.files
+
+
+    def __iter__(self):
+        return iter(self.files)
+
+
+    def __len__(self):
+        return len(self.files)
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+class SpaceLedger(object):
+    """ A running account of the free space on a device, for copying files
+        to it while others are still being deleted. Every size is rounded up
+        to the device's block size, and the space for a copy is claimed 
+        before the copy starts, so the device never overfills.
+        
+        @ivar free: The number of bytes free, less any claimed.
+        @ivar blockSize: The device's block size.
+    """
+
+    def __init__(self, free, blockSize):
+        """ Constructor.
+            @param free: The number of bytes currently free on the device.
+            @param blockSize: The device's block size.
+        """
+        self.free = free
+        self.blockSize = blockSize
+
+
+    def __repr__(self):
+        return "<%s: %d bytes free>" % (self.__class__.__name__, self.free)
+
+
+    def roundUp(self, size):
+        """ Round a size up to a whole number of blocks.
+        """
+        return -(-(size or 0) // self.blockSize) * self.blockSize
+
+
+    def release(self, size):
+        """ Return the space used by a deleted file of the given size.
+        """
+        self.free += self.roundUp(size)
+
+
+    def take(self, size):
+        """ Unconditionally deduct space, e.g. for new directories. The 
+            free space may become negative, in which case nothing can be 
+            claimed until enough has been released.
+        """
+        self.free -= self.roundUp(size)
+
+
+    def claim(self, size):
+        """ Claim space for a file of the given size, if there is room.
+            @return: `True` if the space was claimed, `False` if not.
+        """
+        size = self.roundUp(size)
+        if size > self.free:
+            return False
+        self.free -= size
+        return True
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+class DeviceManifest(object):
+    """ A record of the music files on a destination device: each file's 
+        size, the ID of the track it came from, and when it was copied,
+        plus the modification time of every directory. Kept in a file on
+        the device itself, so that later runs needn't walk the whole
+        device; only directories whose modification times have changed
+        are re-read.
+        
+        Changes are appended to a journal as they happen, and folded into
+        the manifest by ``save()``, so an interrupted run loses nothing. Both
+        are kept in a hidden directory (`metaDir`) so that writing them
+        doesn't change the modification time of the device's root.
+        
+        @ivar files: A dictionary of (<size>, <Track ID>, <time copied>)
+            tuples, keyed by path relative to the device root.
+        @ivar dirs: A dictionary of directory modification times, keyed by
+            path relative to the device root (the root itself is '').
+        @ivar modified: `True` if the manifest has changed since it was
+            last saved.
+        @cvar metaDir: The name of the directory, in the device root, in
+            which to keep the manifest.
+        @cvar filename: The name of the manifest file.
+        @cvar journalName: The name of the journal file.
+    """
+    
+    metaDir = ".musicmover"
+    filename = "manifest"
+    journalName = "journal"
+    version = 1
+    
+    def __init__(self, root, isMusicFile=None):
+        """ Constructor. Note that this does not read the manifest; see
+            ``load()`` and ``scan()``.
+            
+            @param root: The root directory of the device.
+            @keyword isMusicFile: A function that determines whether a file
+                (by name) should be included. Defaults to all files.
+        """
+        self.root = os.path.abspath(root)
+        self.isMusicFile = (lambda f: True) if isMusicFile is None \
+                           else isMusicFile
+        self.files = {}
+        self.dirs = {}
+        self.modified = False
+        self._dirty = set()
+        self._journal = None
+
+
+    def __repr__(self):
+        return "<%s %r: %d files>" % (self.__class__.__name__, self.root,
+                                      len(self.files))
+
+
+    @staticmethod
+    def _escape(path):
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return path.encode('string_escape')
+
+
+    @staticmethod
+    def _unescape(path):
+        return path.decode('string_escape')
+
+
+    def _relpath(self, filename):
+        """ Get a filename's path relative to the device root.
+        """
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+
+    def _fullpath(self, rel):
+        return os.path.join(self.root, rel) if rel else self.root
+
+
+    def _metaPath(self, name, create=False):
+        """ Get the full path of a file in the metadata directory.
+        
+            @keyword create: If `True`, create the metadata directory if it
+                doesn't exist.
+        """
+        path = os.path.join(self.root, self.metaDir)
+        if create and not os.path.isdir(path):
+            os.makedirs(path)
+            # Creating the directory changes the root's modification time.
+            self._dirty.add('')
+        return os.path.join(path, name)
+
+
+    def _parseFileRecord(self, fields):
+        """ Parse the parts of a file line: path, size, Track ID, time.
+        """
+        trackId = int(fields[2]) if fields[2] else None
+        copied = float(fields[3]) if fields[3] else None
+        return (self._unescape(fields[0]), (int(fields[1]), trackId, copied))
+
+
+    def load(self):
+        """ Read the manifest from the device, applying any changes left in
+            the journal by an interrupted run. Does not check whether the
+            device's contents have changed; see ``verify()``.
+            
+            @return: `True` if the device had a manifest.
+        """
+        manifestFile = self._metaPath(self.filename)
+        if not os.path.exists(manifestFile):
+            return False
+        with open(manifestFile, 'rb') as f:
+            header = f.readline().split()
+            if header[-1:] != [str(self.version)]:
+                return False
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == 'D':
+                    self.dirs[self._unescape(fields[1])] = float(fields[2])
+                elif fields[0] == 'F':
+                    rel, entry = self._parseFileRecord(fields[1:])
+                    self.files[rel] = entry
+        
+        journalFile = self._metaPath(self.journalName)
+        if os.path.exists(journalFile):
+            with open(journalFile, 'rb') as f:
+                for line in f:
+                    if not line.endswith('\n'):
+                        # Partially-written record
+                        break
+                    fields = line.rstrip('\n').split('\t')
+                    if fields[0] == '+':
+                        rel, entry = self._parseFileRecord(fields[1:])
+                        self.files[rel] = entry
+                    elif fields[0] == '-':
+                        rel = self._unescape(fields[1])
+                        self.files.pop(rel, None)
+                    else:
+                        continue
+                    self._dirty.add(os.path.dirname(rel))
+                    self.modified = True
+        return True
+
+
+    def _scanTree(self, rel):
+        """ Walk a directory (relative to the device root), adding all its
+            directories and music files.
+        """
+        for root, dirs, files in os.walk(self._fullpath(rel)):
+            reldir = self._relpath(root)
+            if reldir == os.curdir:
+                reldir = ''
+                if self.metaDir in dirs:
+                    dirs.remove(self.metaDir)
+            self.dirs[reldir] = os.stat(root).st_mtime
+            for name in files:
+                if self.isMusicFile(name):
+                    f = os.path.join(reldir, name)
+                    size = os.path.getsize(self._fullpath(f))
+                    self.files[f] = (size, None, None)
+
+
+    def scan(self):
+        """ Build the manifest from scratch by walking the whole device.
+            Any Track IDs and copy times already known are kept for files
+            whose sizes haven't changed.
+        """
+        old = self.files
+        self.files = {}
+        self.dirs = {}
+        self._scanTree('')
+        for rel, entry in self.files.iteritems():
+            oldEntry = old.get(rel)
+            if oldEntry is not None and oldEntry[0] == entry[0]:
+                self.files[rel] = oldEntry
+        self._dirty.clear()
+        self.modified = True
+
+
+    def verify(self):
+        """ Bring the manifest up to date with the device, re-reading only
+            directories whose modification times differ from the ones 
+            recorded. New subdirectories are scanned in full; missing ones
+            are dropped along with their contents.
+        
+            @return: The number of directories that were re-read.
+        """
+        byDir = {}
+        for rel in self.files:
+            byDir.setdefault(os.path.dirname(rel), []).append(rel)
+        
+        changed = 0
+        for reldir in sorted(self.dirs):
+            if reldir not in self.dirs:
+                # Dropped along with a missing parent
+                continue
+            try:
+                mtime = os.stat(self._fullpath(reldir)).st_mtime
+            except OSError:
+                self._dropDir(reldir)
+                continue
+            if mtime == self.dirs[reldir]:
+                continue
+            
+            changed += 1
+            self.dirs[reldir] = mtime
+            present = set()
+            for name in os.listdir(self._fullpath(reldir)):
+                if not reldir and name == self.metaDir:
+                    continue
+                rel = os.path.join(reldir, name)
+                full = self._fullpath(rel)
+                if os.path.isdir(full):
+                    if rel not in self.dirs:
+                        self._scanTree(rel)
+                elif self.isMusicFile(name):
+                    present.add(rel)
+                    size = os.path.getsize(full)
+                    entry = self.files.get(rel)
+                    if entry is None or entry[0] != size:
+                        self.files[rel] = (size, None, None)
+            for rel in byDir.get(reldir, ()):
+                if rel not in present:
+                    self.files.pop(rel, None)
+        self._dirty.clear()
+        self.modified = self.modified or changed > 0
+        return changed
+    
+
+    def _dropDir(self, reldir):
+        """ Remove a directory, its subdirectories, and all their files.
+        """
+        prefix = os.path.join(reldir, '')
+        for d in [d for d in self.dirs if d == reldir or d.startswith(prefix)]:
+            del self.dirs[d]
+        for f in [f for f in self.files if f.startswith(prefix)]:
+            del self.files[f]
+
+
+    def _writeJournal(self, record):
+        """ Append a record to the journal, making sure it reaches the 
+            device before returning.
+        """
+        if self._journal is None:
+            self._journal = open(self._metaPath(self.journalName, True), 'ab')
+        self._journal.write("\t".join(record) + "\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+
+
+    def add(self, filename, size, trackId=None, copied=None):
+        """ Record a file copied to the device.
+        
+            @param filename: The full path and name of the file.
+            @param size: The size of the file in bytes.
+            @keyword trackId: The ID of the track from which the file was
+                copied, if any.
+            @keyword copied: The time at which it was copied (seconds since
+                the epoch). Defaults to now.
+        """
+        rel = self._relpath(filename)
+        copied = time.time() if copied is None else copied
+        self.files[rel] = (size, trackId, copied)
+        self._dirty.add(os.path.dirname(rel))
+        self.modified = True
+        self._writeJournal(('+', self._escape(rel), str(size),
+                            '' if trackId is None else str(trackId),
+                            repr(copied)))
+
+
+    def remove(self, filename):
+        """ Record a file deleted from the device.
+        """
+        rel = self._relpath(filename)
+        self.files.pop(rel, None)
+        self._dirty.add(os.path.dirname(rel))
+        self.modified = True
+        self._writeJournal(('-', self._escape(rel)))
+
+
+    def __contains__(self, filename):
+        return self._relpath(filename) in self.files
+
+
+    def save(self):
+        """ Write the complete manifest to the device and discard the 
+            journal. Directories changed since the manifest was loaded (and
+            their parents) have their modification times updated first. The
+            manifest is written under a temporary name and renamed, so it
+            is always either the old version or the new one.
+        """
+        manifestFile = self._metaPath(self.filename, True)
+        for reldir in self._dirty:
+            while True:
+                try:
+                    self.dirs[reldir] = os.stat(self._fullpath(reldir)).st_mtime
+                except OSError:
+                    self._dropDir(reldir)
+                if not reldir:
+                    break
+                reldir = os.path.dirname(reldir)
+        self._dirty.clear()
+        
+        tempName = manifestFile + ".tmp"
+        with open(tempName, 'wb') as f:
+            f.write("musicmover-manifest %d\n" % self.version)
+            for reldir, mtime in sorted(self.dirs.iteritems()):
+                f.write("D\t%s\t%r\n" % (self._escape(reldir), mtime))
+            for rel, (size, trackId, copied) in sorted(self.files.iteritems()):
+                f.write("F\t%s\t%d\t%s\t%s\n" % (self._escape(rel), size,
+                        '' if trackId is None else trackId,
+                        '' if copied is None else repr(copied)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tempName, manifestFile)
+        self.modified = False
+        
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        journalFile = self._metaPath(self.journalName)
+        if os.path.exists(journalFile):
+            os.remove(journalFile)
+
+
+    def getIndex(self):
+        """ Get a `DestinationIndex` of the files in the manifest, with their
+            sizes.
+        """
+        index = DestinationIndex()
+        # The paths are already normalized, so skip DestinationIndex.add().
+        normcase = os.path.normcase
+        join = os.path.join
+        root = self.root
+        files = index.files
+        for rel, entry in self.files.iteritems():
+            files[normcase(join(root, rel))] = entry[0]
+        return index
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+class CopyHistory(object):
+    """ A record of every track copied to, and deleted from, a device, kept
+        in an SQLite database. The time each track was last on the device is
+        also kept in memory, so checking a track's history is a dictionary
+        lookup, however long the history.
+        
+        Paths are stored relative to the device root, so the history stays
+        valid if the device is mounted somewhere else.
+        
+        @ivar lastSeen: A dictionary of the last time (seconds since the
+            epoch) each track was copied or deleted, keyed by Track ID.
+        @cvar filename: The default name of the history database, in the
+            device's metadata directory (see `DeviceManifest.metaDir`).
+    """
+    
+    filename = "history.sqlite"
+    
+    def __init__(self, filename, root):
+        """ Constructor.
+        
+            @param filename: The name of the SQLite database file. Created if
+                it doesn't exist.
+            @param root: The root directory of the device.
+        """
+        self.root = os.path.abspath(root)
+        path = os.path.dirname(os.path.abspath(filename))
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.db = sqlite3.connect(filename)
+        # Paths are byte strings, not necessarily UTF-8.
+        self.db.text_factory = str
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS events (
+                trackId INTEGER, path TEXT, action TEXT, time REAL);
+            CREATE INDEX IF NOT EXISTS eventsByTrack ON events (trackId);
+            CREATE INDEX IF NOT EXISTS eventsByPath ON events (path);
+        """)
+        self.lastSeen = dict(self.db.execute(
+            "SELECT trackId, MAX(time) FROM events "
+            "WHERE trackId IS NOT NULL GROUP BY trackId"))
+
+
+    def __repr__(self):
+        return "<%s %r: %d tracks>" % (self.__class__.__name__, self.root,
+                                       len(self.lastSeen))
+
+
+    def _relpath(self, filename):
+        filename = os.path.abspath(filename)
+        if filename.startswith(os.path.join(self.root, '')):
+            return os.path.relpath(filename, self.root)
+        return filename
+
+
+    def recordCopy(self, filename, trackId, when=None):
+        """ Record a track being copied to the device. Changes aren't saved
+            until ``commit()`` is called.
+            
+            @param filename: The full path and name of the copy.
+            @param trackId: The ID of the track copied.
+            @keyword when: The time of the copy. Defaults to now.
+        """
+        when = time.time() if when is None else when
+        self.db.execute("INSERT INTO events VALUES (?, ?, 'copy', ?)",
+                        (trackId, self._relpath(filename), when))
+        if trackId is not None:
+            self.lastSeen[trackId] = when
+
+
+    def recordDelete(self, filename, trackId=None, when=None):
+        """ Record a file being deleted from the device. Changes aren't 
+            saved until ``commit()`` is called.
+        
+            @param filename: The full path and name of the deleted file.
+            @keyword trackId: The ID of the track the file was copied from.
+                If `None`, it is looked up from the file's last copy.
+            @keyword when: The time of the deletion. Defaults to now.
+        """
+        when = time.time() if when is None else when
+        path = self._relpath(filename)
+        if trackId is None:
+            row = self.db.execute("SELECT trackId FROM events "
+                                  "WHERE path=? AND action='copy' "
+                                  "ORDER BY time DESC LIMIT 1", 
+                                  (path,)).fetchone()
+            trackId = row[0] if row else None
+        self.db.execute("INSERT INTO events VALUES (?, ?, 'delete', ?)",
+                        (trackId, path, when))
+        if trackId is not None:
+            self.lastSeen[trackId] = when
+
+
+    def getAge(self, trackId, now=None):
+        """ Get the time since a track was last on the device, in seconds,
+            or `None` if it never has been.
+        """
+        seen = self.lastSeen.get(trackId)
+        if seen is None:
+            return None
+        return (time.time() if now is None else now) - seen
+
+
+    def commit(self):
+        """ Save recorded changes to the database.
+        """
+        self.db.commit()
+
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+#===============================================================================
+# 
+#===============================================================================
+
+class SyncPlan(object):
+    """ The changes that would freshen a target: the files to delete from 
+        it and the tracks to copy to it, worked out by 
+        ``MusicMover.planFreshen()`` without changing anything, so they can
+        be reviewed and carried out later by ``MusicMover.executePlan()``.
+        
+        Plans are saved as gzipped text, one line per file, much like a 
+        `DeviceManifest`. Paths are stored relative to the target's root, 
+        so a plan stays valid if the device is mounted somewhere else.
+        
+        @ivar root: The root directory of the target.
+        @ivar free: The space free on the target when the plan was made,
+            in bytes.
+        @ivar blockSize: The target's block size, in bytes.
+        @ivar newDirs: The number of directories the copies will create.
+        @ivar created: The time the plan was made (seconds since the 
+            epoch).
+        @ivar deletes: A list of (<path>, <size>) tuples, one for each file
+            to delete. Paths are relative to `root`.
+        @ivar copies: A list of (<source URL>, <path>, <Track ID>, <size>)
+            tuples, one for each track to copy. Paths are relative to 
+            `root`; sizes are those of the files to be written.
+    """
+    
+    version = 1
+    
+    def __init__(self, root, free, blockSize, newDirs=0, created=None):
+        """ Constructor.
+        
+            @param root: The root directory of the target.
+            @param free: The space free on the target, in bytes.
+            @param blockSize: The target's block size, in bytes.
+            @keyword newDirs: The number of directories to be created.
+            @keyword created: The time the plan was made. Defaults to now.
+        """
+        self.root = os.path.abspath(root)
+        self._prefix = os.path.join(self.root, '')
+        self.free = free
+        self.blockSize = blockSize
+        self.newDirs = newDirs
+        self.created = time.time() if created is None else created
+        self.deletes = []
+        self.copies = []
+
+
+    def __repr__(self):
+        return "<%s %r: %d deletes, %d copies>" % (self.__class__.__name__,
+            self.root, len(self.deletes), len(self.copies))
+
+
+    def _relpath(self, filename):
+        if filename.startswith(self._prefix) and os.sep + '.' not in filename:
+            # Already normalized (as target names are); much faster.
+            return filename[len(self._prefix):]
+        return os.path.relpath(os.path.abspath(filename), self.root)
+
+
+    def addDelete(self, filename, size):
+        """ Add a file to delete.
+        
+            @param filename: The full path and name of the file.
+            @param size: The size of the file, in bytes.
+        """
+        self.deletes.append((self._relpath(filename), size))
+
+
+    def addCopy(self, source, filename, trackId, size):
+        """ Add a track to copy.
+        
+            @param source: The URL of the track's file.
+            @param filename: The full path and name of the copy.
+            @param trackId: The ID of the track.
+            @param size: The (expected) size of the copy, in bytes.
+        """
+        self.copies.append((source, self._relpath(filename), trackId, size))
+
+
+    def _roundUp(self, size):
+        blocks = -(-size // self.blockSize)
+        return blocks * self.blockSize
+
+
+    def getDeleteSize(self, roundUp=False):
+        """ Get the total size of the files to delete.
+        
+            @keyword roundUp: If `True`, round each file's size up to the
+                target's block size, giving the space freed.
+        """
+        if roundUp:
+            return sum(self._roundUp(size) for f, size in self.deletes)
+        return sum(size for f, size in self.deletes)
+
+
+    def getCopySize(self, roundUp=False):
+        """ Get the total size of the tracks to copy.
+        
+            @keyword roundUp: If `True`, round each file's size up to the
+                target's block size, giving the space used.
+        """
+        if roundUp:
+            return sum(self._roundUp(c[3]) for c in self.copies)
+        return sum(c[3] for c in self.copies)
+
+
+    def getFreeAfter(self):
+        """ Get the space expected to be free on the target once the plan 
+            has been carried out, allowing a block for each new directory.
+        """
+        return self.free + self.getDeleteSize(True) \
+            - self.getCopySize(True) - self.newDirs * self.blockSize
+
+
+    def getSummary(self):
+        """ Get the plan's totals as a dictionary (suitable for JSON).
+        """
+        return {'root': self.root,
+                'created': self.created,
+                'deletes': len(self.deletes),
+                'deleteBytes': self.getDeleteSize(),
+                'copies': len(self.copies),
+                'copyBytes': self.getCopySize(),
+                'freeBefore': self.free,
+                'freeAfter': self.getFreeAfter(),
+                'blockSize': self.blockSize}
+
+
+    def getDeletes(self, root=None):
+        """ Get the files to delete, sorted so those in the same directory
+            are deleted together.
+        
+            @keyword root: The target's root directory, if it has moved
+                since the plan was made.
+            @return: A list of (<filename>, <size>) tuples.
+        """
+        root = self.root if root is None else os.path.abspath(root)
+        return [(os.path.join(root, f), size) 
+                for f, size in sorted(self.deletes)]
+
+
+    def getCopies(self, root=None):
+        """ Get the tracks to copy, sorted by destination directory and 
+            then by source, so each directory is written all at once and 
+            the sources are read in order.
+        
+            @keyword root: The target's root directory, if it has moved
+                since the plan was made.
+            @return: A list of (<source URL>, <filename>, <Track ID>, 
+                <size>) tuples.
+        """
+        root = self.root if root is None else os.path.abspath(root)
+        copies = sorted(self.copies, 
+                        key=lambda c: (os.path.dirname(c[1]), c[0]))
+        return [(source, os.path.join(root, f), trackId, size)
+                for source, f, trackId, size in copies]
+
+
+    def save(self, filename):
+        """ Write the plan to a file. The file is written under a temporary
+            name and renamed, so it is always complete.
+        """
+        escape = DeviceManifest._escape
+        tempName = "%s.%d.tmp" % (filename, os.getpid())
+        with gzip.open(tempName, 'wb') as f:
+            f.write("musicmover-plan %d\n" % self.version)
+            f.write("R\t%s\t%d\t%d\t%d\t%r\n" % (escape(self.root), 
+                    self.free, self.blockSize, self.newDirs, self.created))
+            for rel, size in self.deletes:
+                f.write("-\t%s\t%d\n" % (escape(rel), size))
+            for source, rel, trackId, size in self.copies:
+                f.write("+\t%s\t%s\t%s\t%d\n" % (escape(source), 
+                        escape(rel), '' if trackId is None else trackId, 
+                        size))
+        os.rename(tempName, filename)
+
+
+    @classmethod
+    def load(cls, filename):
+        """ Read a plan written by ``save()``.
+        
+            @return: A new `SyncPlan`.
+        """
+        unescape = DeviceManifest._unescape
+        with gzip.open(filename, 'rb') as f:
+            header = f.readline().split()
+            if header != ["musicmover-plan", str(cls.version)]:
+                raise ValueError("%s is not a sync plan (version %d)" % \
+                                 (filename, cls.version))
+            fields = f.readline().rstrip('\n').split('\t')
+            plan = cls(unescape(fields[1]), int(fields[2]), int(fields[3]),
+                       int(fields[4]), float(fields[5]))
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if fields[0] == '-':
+                    plan.deletes.append((unescape(fields[1]), 
+                                         int(fields[2])))
+                elif fields[0] == '+':
+                    plan.copies.append((unescape(fields[1]), 
+                                        unescape(fields[2]),
+                                        int(fields[3]) if fields[3] else None,
+                                        int(fields[4])))
+        return plan
+
+
 #===============================================================================
 # 
 #===============================================================================
@@ -101,27 +1508,160 @@ class MusicMover(object):
         @cvar musicExt: The filename extensions of valid music files.
         @cvar minFreeSpace: The default amount of free space to leave when
             freshening music (MB).
+        @cvar copyWorkers: The number of files to copy simultaneously. 
+            Setting this to 1 copies files one at a time, without threads.
+        @cvar copyQueueSize: The maximum number of copies waiting for a
+            worker at any time.
+        @cvar copyBufferSize: The size of the buffer used when copying.
+        @cvar statWorkers: The number of directories to read (or files to
+            stat) simultaneously when scanning the target. Higher values
+            help on high-latency devices.
+        @ivar backends: The `targets.TargetBackend` for each target used,
+            keyed by root directory.
+        @cvar fillCandidates: The maximum number of tracks considered when
+            filling leftover space (see ``getNewMusic()``).
+        @cvar fillMaxUnits: The largest total (in units of the block size, 
+            or larger) considered when filling leftover space; limits the
+            memory and time used by ``getNewMusic()``.
+        @cvar historyHalfLife: When a copy history is kept, a track that
+            was on the device this many days ago is half as likely to be
+            chosen as one that never was.
+        @cvar partialExt: The extension of partially-copied files, when
+            copying resumably or to several targets at once.
+        @cvar pendingName: The name of the list of tracks still to be 
+            copied, when copying resumably. Kept in the target's metadata
+            directory (see `DeviceManifest.metaDir`).
+        @cvar mtimeTolerance: The maximum difference (in seconds) between
+            the modification times of two otherwise identical files. FAT
+            filesystems only store times to within two seconds.
+        @cvar imageOverhead: The space (MB) to leave on each disc for the
+            image's directories, when partitioning for 
+            ``writeDiscImages()``.
+        @ivar unusedBytes: The space left unused by the last call to
+            ``getNewMusic()``, in bytes.
     """
 
     musicExt = [".mp3", ".aiff", ".m4a", ".aac", ".wav", ".ogg"]
     minFreeSpace = 100
+    
+    copyWorkers = 4
+    copyQueueSize = 32
+    copyBufferSize = 1048576
+    statWorkers = 4
+    fillCandidates = 500
+    fillMaxUnits = 65536
+    historyHalfLife = 90
+    
+    partialExt = ".mmpart"
+    pendingName = "pending"
+    mtimeTolerance = 2
+    imageOverhead = 16
 
     badCharacters = """/~\\"':;<>\x7f\n*"""
 
     def __init__(self, libraryFile="~/Music/iTunes/iTunes Music Library.xml",
-                 target=None, library=None):
+                 target=None, library=None, streaming=False, cache=None,
+                 manifest=False, history=False, resume=False, observers=None,
+                 weights=None, seed=None, transcoder=None, backend=None):
         """ Constructor.
             @keyword libraryFile: The path and name of the iTunes music library
                 XML file.
             @keyword target: The destination directory to which to copy music.
             @keyword library: An `iTunesLibrary` object, as a convenience to
                 prevent having to parse the XML unnecessarily.
+            @keyword streaming: If `True`, load the library in streaming mode,
+                keeping only the track fields `MusicMover` uses. Note that
+                filter functions will only see those fields.
+            @keyword cache: Where to keep a snapshot of the parsed library,
+                to avoid re-parsing the XML if it hasn't changed. See
+                `iTunesLibrary`.
+            @keyword manifest: If `True`, keep a `DeviceManifest` on the
+                target, and use it rather than walking the target's entire
+                directory tree on every run.
+            @keyword history: Keep a `CopyHistory` of the tracks copied to
+                and deleted from the target, and prefer tracks that haven't 
+                been on it recently when choosing new music. `True` keeps
+                the history on the target; a string is the name of the
+                database file to use instead.
+            @keyword resume: If `True`, copy resumably: files already on the
+                target are skipped, files are copied under temporary names
+                and renamed when complete, and a copy interrupted by a crash
+                or cancellation is continued by the next run.
+            @keyword observers: A list of objects to be notified of the 
+                progress of operations. See `instrumentation.Observer`.
+            @keyword weights: A function returning the weight of a track,
+                e.g. a `sampling.TrackWeights`. Tracks with more weight are
+                more likely to be copied to the target and less likely to
+                be removed from it. By default, all tracks are equally 
+                likely. If it has a `fields` attribute, those fields are
+                kept when loading the library in streaming mode.
+            @keyword seed: A seed for the random choice of tracks, to make
+                runs repeatable.
+            @keyword transcoder: A `transcode.Transcoder`, for converting
+                lossless tracks to a smaller format as they are copied. 
+                Space on the target is budgeted by the transcoded files'
+                estimated sizes.
+            @keyword backend: A function returning the 
+                `targets.TargetBackend` for a target's root directory, e.g.
+                a backend class. Defaults to `targets.LocalBackend`.
         """
+        self.observers = list(observers or ())
         if library is None:
-            library = iTunesLibrary(libraryFile)
+            fields = None
+            if streaming and (weights is not None or transcoder is not None):
+                fields = set(iTunesLibrary.trackFields)
+                fields.update(getattr(weights, 'fields', ()))
+                fields.update(getattr(transcoder, 'fields', ()))
+            with self._phase('load'):
+                library = iTunesLibrary(libraryFile, streaming=streaming,
+                                        fields=fields, cache=cache)
         self.library = library
         self.target = target
         self.canceled = False
+        self.useManifest = manifest
+        self.manifests = {}
+        self.useHistory = history
+        self.histories = {}
+        self.resume = resume
+        self.weights = weights
+        self.random = random.Random(seed)
+        self.transcoder = transcoder
+        self._backendFactory = targets.LocalBackend if backend is None \
+            else backend
+        self.backends = {}
+        self._madeDirs = set()
+        self._blockSizes = {}
+        self.unusedBytes = None
+        self._sanitizeTable = string.maketrans(self.badCharacters, 
+                                               '_' * len(self.badCharacters))
+        self._sanitized = {}
+        self._targetRoots = {}
+        self._targetNames = library.extras.setdefault('targetNames', {})
+        self._targetNamesChanged = False
+        self._libraryIndexes = library.extras.setdefault('libraryIndexes', {})
+
+
+    def _notify(self, event, *args):
+        """ Send a notification to all the observers.
+        
+            @param event: The name of the `instrumentation.Observer` method 
+                to call.
+        """
+        for observer in self.observers:
+            getattr(observer, event)(*args)
+
+
+    @contextmanager
+    def _phase(self, name):
+        """ Notify the observers of the start and end of a phase of an
+            operation, for use with a ``with`` statement.
+        """
+        self._notify('phaseStarted', name)
+        started = time.time()
+        try:
+            yield
+        finally:
+            self._notify('phaseFinished', name, time.time() - started)
 
 
     def _sanitize(self, filename, target):
@@ -131,26 +1671,160 @@ class MusicMover(object):
         # TODO: Should probably do this based on character code.
         filename = filename.encode('ascii','replace')
         name, ext = os.path.splitext(filename)
-        for c in self.badCharacters:
-            name = name.replace(c, '_')
-        return name + ext
+        return name.translate(self._sanitizeTable) + ext
         
 
-    def targetName(self, track, target=None):
-        """ Get the path and name to which a file will be copied, performing
-            any sort of conversion of the name required by the target
-            filesystem.
+    def _sanitizeCached(self, filename, target):
+        """ Memoized version of ``_sanitize()``; artist and album names are
+            repeated across many tracks.
+        """
+        key = (filename, target)
+        result = self._sanitized.get(key)
+        if result is None:
+            result = self._sanitized[key] = self._sanitize(filename, target)
+        return result
+
+
+    def _getTargetRoot(self, target):
+        """ Get the absolute path of a target, as used in its files' names 
+            and as the key of anything remembered about it, so that (for
+            example) "dev" and "dev/" are the same target.
+        """
+        root = self._targetRoots.get(target)
+        if root is None:
+            root = self._targetRoots[target] = os.path.abspath(target)
+        return root
+
+
+    def _makeTargetName(self, track, target):
+        """ Build the name to which a track will be copied. See 
+            ``targetName()``.
+        """
+        location = track.get('Location', '')
+        if location.startswith(('file:///', 'file://localhost/')) \
+                and ';' not in location and '?' not in location \
+                and '#' not in location:
+            # Simple local file URL (almost always the case); the filename
+            # is the same as urlparse would find, without the overhead.
+            trackName = os.path.basename(unquote(location))
+        else:
+            trackName = os.path.basename(unquote(urlparse(location).path))
+        album = self._sanitizeCached(track.get('Album', 'Unknown Album'), 
+                                     target)
+        if track.get('Compilation', False):
+            artist = "Compilations"
+        else:
+            artist = self._sanitizeCached(track.get('Artist', 
+                                                    'Unknown Artist'), target)
+        
+        root = self._getTargetRoot(target)
+        if trackName in _specialNames or artist in _specialNames \
+                or album in _specialNames:
+            return os.path.abspath(os.path.join(root, artist, album, 
+                                                trackName))
+        return os.path.join(root, artist, album, trackName)
+
+
+    def targetName(self, track, target=None):
+        """ Get the path and name to which a file will be copied, performing
+            any sort of conversion of the name required by the target
+            filesystem. Tracks that will be transcoded get the extension of
+            the transcoded format.
+            
+            Names are remembered by Track ID and target (and the characters
+            the target doesn't allow), and are only rebuilt if the track's 
+            Location, Artist, Album or Compilation changes. They are saved
+            in the library's snapshot cache by ``saveTargetNames()``.
+        """
+        target = self.target if target is None else target
+        name = self._getTargetName(track, target)
+        if self.transcoder is not None and self.transcoder.handles(track):
+            return self.transcoder.getTargetName(name)
+        return name
+
+
+    def _getTargetName(self, track, target):
+        """ Get a track's name on the target, before any change of 
+            extension for transcoding. See ``targetName()``.
+        """
+        trackId = track.get('Track ID')
+        if trackId is None:
+            return self._makeTargetName(track, target)
+        
+        key = (self._getTargetRoot(target), self.badCharacters)
+        names = self._targetNames.get(key)
+        if names is None:
+            names = self._targetNames[key] = {}
+        
+        location = track.get('Location')
+        artist = track.get('Artist')
+        album = track.get('Album')
+        compilation = track.get('Compilation')
+        cached = names.get(trackId)
+        if cached is not None and cached[0] == location \
+                and cached[1] == artist and cached[2] == album \
+                and cached[3] == compilation:
+            return cached[4]
+        
+        name = self._makeTargetName(track, target)
+        names[trackId] = (location, artist, album, compilation, name)
+        self._targetNamesChanged = True
+        return name
+
+
+    def saveTargetNames(self):
+        """ Save any newly-generated target names in the library's snapshot
+            cache, if it has one, so later runs needn't generate them again.
+        """
+        if self._targetNamesChanged and self.library.cacheFile:
+            self.library.saveCache()
+            self._targetNamesChanged = False
+
+
+    def getLibraryIndex(self, target=None):
+        """ Get an index of the names every track in the library would have
+            on a target (see ``targetName()``), for finding the tracks that
+            files on the target came from. Built once per target (and set of
+            characters the target doesn't allow), and saved in the 
+            library's snapshot cache by ``saveTargetNames()``.
+            
+            @keyword target: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+            @return: A dictionary of Track IDs, keyed by target filename 
+                (normalized like those in a `DestinationIndex`).
         """
         target = self.target if target is None else target
-        trackName = os.path.basename(unquote(urlparse(track.get('Location', '')).path))
-        album = self._sanitize(track.get('Album', 'Unknown Album'), target)
-        if track.get('Compilation', False):
-            artist = "Compilations"
-        else:
-            artist = self._sanitize(track.get('Artist', 'Unknown Artist'),
-                                    target)
-        
-        return os.path.abspath(os.path.join(target, artist, album, trackName))
+        key = (self._getTargetRoot(target), self.badCharacters)
+        if self.transcoder is not None:
+            key += (self.transcoder.ext,)
+        index = self._libraryIndexes.get(key)
+        if index is None:
+            targetName = self.targetName
+            normcase = os.path.normcase
+            index = {}
+            for track in self.library.tracks.itervalues():
+                index[normcase(targetName(track, target))] = \
+                    track.get('Track ID')
+            self._libraryIndexes[key] = index
+            self._targetNamesChanged = True
+        return index
+
+
+    def isInLibrary(self, f, target=None):
+        """ Determine if a file on the target was copied from a track in
+            the library. Can be used as a filter for ``getRemovalList()``.
+        """
+        return DestinationIndex.normalize(f) in self.getLibraryIndex(target)
+
+
+    def getTrackSize(self, track):
+        """ Get the number of bytes a track will occupy on the target: its
+            size, or if it will be transcoded, the transcoded file's 
+            estimated size.
+        """
+        if self.transcoder is not None and self.transcoder.handles(track):
+            return self.transcoder.estimateSize(track)
+        return track.get('Size', -1)
 
 
     def canBeDeleted(self, f):
@@ -169,16 +1843,32 @@ class MusicMover(object):
 
 
     def getStats(self, drive):
-        """ Return (free space, block size) for a given drive. Replace if
-            the target device isn't really a normal filesystem. Note that the
-            path must exist.
+        """ Return (free space, block size) for a given drive, from its
+            backend. Note that the path must exist.
 
             @param drive: The path of the drive to check (e.g.
                 /Volumes/MYDRIVE/)
             @return: A tuple containing (<bytes free>, <block size>)
         """
-        s = os.statvfs(drive)
-        return (s.f_frsize * s.f_bavail, s.f_frsize)
+        return self._getBackendFor(drive, isRoot=True).getStats()
+
+
+    def getBlockSize(self, drive):
+        """ Get the block size of a given drive. The result of 
+            ``getStats()`` is cached per device, so this is cheap to call
+            repeatedly.
+
+            @param drive: Any existing path on the drive.
+        """
+        try:
+            device = os.stat(drive).st_dev
+        except OSError:
+            # Possibly not a normal filesystem.
+            device = drive
+        blocksize = self._blockSizes.get(device)
+        if blocksize is None:
+            blocksize = self._blockSizes[device] = self.getStats(drive)[1]
+        return blocksize
 
 
     def roundUpTo(self, num, blocksize):
@@ -191,59 +1881,290 @@ class MusicMover(object):
         return int(blocksize * d + .5)
 
 
+    def roundUpTotal(self, sizes, blocksize):
+        """ Get the total of several file sizes, each rounded up to a given
+            block size. Equivalent to summing ``roundUpTo()`` over all the
+            sizes, but done in one pass (vectorized, if NumPy is available).
+            
+            @param sizes: A list of file sizes, in bytes.
+            @param blocksize: The size of a block, in bytes.
+        """
+        if numpy is not None and len(sizes) > 1000:
+            a = numpy.asarray(sizes, dtype=numpy.int64)
+            return int((((a + (blocksize - 1)) // blocksize) * blocksize).sum())
+        b = blocksize - 1
+        return sum((s + b) // blocksize for s in sizes) * blocksize
+
+
     def getMusicFiles(self, path=None):
         """ Recursively get all music files from a given path.
         
             @keyword path: The destination path. Defaults to the 'target'
                 specified when constructing the MusicMover object.
         """
+        for filename, size in self.getMusicFileSizes(path):
+            yield filename
+
+
+    def getMusicFileSizes(self, path=None):
+        """ Recursively get all music files from a given path, along with
+            their sizes, as listed by the target's backend. Directories are
+            read in parallel by a pool of `statWorkers` threads.
+        
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+            @return: A generator of (<filename>, <size>) tuples.
+        """
         path = self.target if path is None else path
-        for root, dirs, files in os.walk(path):
-            files = filter(self.isMusicFile, files)
-            for name in files:
-                yield os.path.join(root, name)
+        backend = self._getBackendFor(path, isRoot=True)
+        return backend.listFiles(path, self.isMusicFile, self.statWorkers)
+
+
+    def _getSizes(self, files):
+        """ Get the sizes of several files, using a pool of `statWorkers`
+            threads.
+        
+            @param files: A list of filenames.
+            @return: A list of sizes, in the same order as `files`.
+        """
+        if not files:
+            return []
+        return self._getBackendFor(files[0]).getSizes(files, 
+                                                      self.statWorkers)
+
+
+    def getDestinationIndex(self, path=None):
+        """ Scan a destination directory and build an index of the music
+            files it contains. Intended to be done once per run and shared
+            by ``getNewMusic()``, ``getRemovalList()`` and 
+            ``getMusicSize()``.
+        
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+            @return: A `DestinationIndex`.
+        """
+        backend = self._getBackendFor(self.target if path is None else path,
+                                      isRoot=True)
+        with self._phase('walk'):
+            if self.useManifest:
+                index = self.getManifest(path).getIndex()
+                index.backend = backend
+                return index
+            index = DestinationIndex(backend=backend)
+            for filename, size in self.getMusicFileSizes(path):
+                index.add(filename, size)
+            return index
+
+
+    def getBackend(self, path=None):
+        """ Get the `targets.TargetBackend` for a destination directory,
+            creating it the first time it is requested.
+        
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+        """
+        path = os.path.abspath(self.target if path is None else path)
+        backend = self.backends.get(path)
+        if backend is None:
+            backend = self.backends[path] = self._backendFactory(path)
+        return backend
+
+
+    def _getBackendFor(self, filename, isRoot=False):
+        """ Get the backend for the target containing a file (or 
+            directory): one already created by ``getBackend()``, or the
+            default target. The root of a target is never guessed from
+            the files in it, since each backend keeps track of the space
+            on its whole target; a file that isn't within a known target
+            (e.g. one passed to ``copyFile()`` by other code) is handled as
+            a local file, by a `targets.LocalBackend` of its own.
+            
+            @param filename: The file or directory.
+            @keyword isRoot: If `True`, `filename` is a target directory,
+                for which a backend is created if it isn't within a target
+                already known.
+        """
+        filename = os.path.abspath(filename)
+        roots = list(self.backends)
+        if self.target:
+            roots.append(os.path.abspath(self.target))
+        for root in roots:
+            if filename == root or filename.startswith(os.path.join(root, 
+                                                                    '')):
+                return self.getBackend(root)
+        if isRoot:
+            return self.getBackend(filename)
+        return targets.LocalBackend(os.path.dirname(filename))
+
+
+    def _isReplaced(self, name):
+        """ Determine if a method has been replaced, in a subclass or on
+            the instance itself.
+        """
+        method = getattr(self, name)
+        return getattr(method, '__func__', None) is not \
+            getattr(MusicMover, name).__func__
+
+
+    def getManifest(self, path=None):
+        """ Get the `DeviceManifest` for a destination directory, loading
+            and verifying it (or creating it, if the destination doesn't have
+            one yet) the first time it is requested.
+        
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+        """
+        path = os.path.abspath(self.target if path is None else path)
+        manifest = self.manifests.get(path)
+        if manifest is None:
+            manifest = DeviceManifest(path, self.isMusicFile)
+            if manifest.load():
+                manifest.verify()
+            else:
+                manifest.scan()
+            if manifest.modified:
+                manifest.save()
+            self.manifests[path] = manifest
+        return manifest
+
+
+    def getHistory(self, path=None):
+        """ Get the `CopyHistory` for a destination directory, opening it the
+            first time it is requested.
+        
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+        """
+        path = os.path.abspath(self.target if path is None else path)
+        history = self.histories.get(path)
+        if history is None:
+            if self.useHistory is True:
+                filename = os.path.join(path, DeviceManifest.metaDir,
+                                        CopyHistory.filename)
+            else:
+                filename = os.path.expanduser(self.useHistory)
+            history = self.histories[path] = CopyHistory(filename, path)
+        return history
+
+
+    def _getHistoryFor(self, filename):
+        """ Get the open `CopyHistory`, if any, for a file on a destination.
+        """
+        filename = os.path.abspath(filename)
+        for root, history in self.histories.iteritems():
+            if filename.startswith(os.path.join(root, '')):
+                return history
+        return None
+
+
+    def _getManifestFor(self, filename):
+        """ Get the loaded `DeviceManifest`, if any, containing a file.
+        """
+        filename = os.path.abspath(filename)
+        for root, manifest in self.manifests.iteritems():
+            if filename.startswith(os.path.join(root, '')):
+                return manifest
+        return None
 
 
-    def getMusicSize(self, files, roundUp=True):
+    def getMusicSize(self, files, roundUp=True, path=None):
         """ Calculate the size of a set of files.
+        
+            @param files: A list of filenames, or a `DestinationIndex`. Sizes
+                already known to the index are used instead of the
+                filesystem's.
+            @keyword roundUp: If `True`, round each file's size up to the
+                drive's block size.
+            @keyword path: The drive containing the files, for getting the
+                block size. Defaults to the 'target' specified when
+                constructing the MusicMover object, or the first file.
         """
-        files = list(files)
-        if len(files) == 0:
+        if path is not None:
+            # The files are then sized through the drive's backend.
+            self._getBackendFor(path, isRoot=True)
+        if isinstance(files, DestinationIndex):
+            unsized = files.getUnsized()
+            for f, size in zip(unsized, self._getSizes(unsized)):
+                files.add(f, size)
+            sizes = files.getSizes()
+        else:
+            files = list(files)
+            sizes = self._getSizes(files)
+        if len(sizes) == 0:
             return 0
         if roundUp:
-            blocksize = self.getStats(files[0])[1]
-            return sum(map(lambda x: self.roundUpTo(os.path.getsize(x), 
-                                                    blocksize), files))
-        return sum(map(os.path.getsize, files))
+            if path is None:
+                path = self.target or iter(files).next()
+            return self.roundUpTotal(sizes, self.getBlockSize(path))
+        return sum(sizes)
         
 
-    def getRemovalList(self, path=None, percent=33, filterFunc=canBeDeleted,
-                       files=None):
+    def getRemovalList(self, path=None, percent=33, filterFunc=None,
+                       files=None, libraryOnly=False, weightFunc=None):
         """ Get a list of music files to remove, based on a percentage of all
             music files in a given directory.
 
             @param path: The root directory from which to get the files.
             @keyword percent: The percentage (0-100) of filenames to return.
             @keyword filterFunc: A function that determines whether a given
-                file is eligible for deletion.
-            @keyword files: A list of files from which to do the removal. If
-                none is supplied, it defaults to all music files in the
-                specified path.
+                file is eligible for deletion. Defaults to 
+                ``canBeDeleted()``.
+            @keyword files: A list of files (or a `DestinationIndex`) from 
+                which to do the removal. If none is supplied, it defaults to 
+                all music files in the specified path.
+            @keyword libraryOnly: If `True`, only remove files copied from
+                tracks in the library, leaving any that came from elsewhere.
+            @keyword weightFunc: A function returning the weight of a file;
+                files with more weight are more likely to be removed. 
+                Defaults to the inverse of the `weights` given to the
+                constructor (see ``getRemovalWeights()``), if any.
         """
         path = self.target if path is None else path
+        filterFunc = self.canBeDeleted if filterFunc is None else filterFunc
         if files is None:
-	       files = filter(filterFunc, self.getMusicFiles(path))
-        else:
-            files = list(files)
-        random.shuffle(files)
+            files = self.getMusicFiles(path)
+        if libraryOnly:
+            index = self.getLibraryIndex(path)
+            if isinstance(files, DestinationIndex):
+                # Already normalized
+                files = [f for f in files if f in index]
+            else:
+                normalize = DestinationIndex.normalize
+                files = [f for f in files if normalize(f) in index]
+        files = filter(filterFunc, files)
+        if weightFunc is None and self.weights is not None:
+            weightFunc = self.getRemovalWeights(path)
         idx = int(len(files) * percent * 0.01 + 0.5)
-        toDelete = files[:idx]
+        toDelete = sampling.sample(files, idx, weightFunc, self.random)
         toDelete.sort()
         return toDelete
 
 
+    def getRemovalWeights(self, path=None):
+        """ Get a function giving the weights of files on the target for 
+            removal: the inverse of the weights of the tracks they came 
+            from (see `weights`). Files that didn't come from the library
+            have a weight of 1.
+            
+            @keyword path: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+        """
+        index = self.getLibraryIndex(path)
+        getTrackById = self.library.getTrackById
+        normalize = DestinationIndex.normalize
+        weights = self.weights
+        def removalWeight(f):
+            trackId = index.get(normalize(f))
+            track = None if trackId is None else getTrackById(trackId)
+            if track is None:
+                return 1.0
+            return 1.0 / max(weights(track), 1e-6)
+        return removalWeight
+
+
     def getNewMusic(self, dest=None, maxSize=None, minFree=minFreeSpace,
-                    playlist="Music", oldFiles=None, filterFunc=None):
+                    playlist="Music", oldFiles=None, filterFunc=None,
+                    fill=False, freeSpace=None, trackIds=None):
         """ Create a list of files to copy to the target drive.
 
             @keyword dest: The destination path. Defaults to the 'target'
@@ -257,12 +2178,29 @@ class MusicMover(object):
             @keyword oldFiles: A set of filenames (on the destination) to
                 exclude from the set of new music; this is presumably a list
                 of files that were on the drive prior to any deletion done to
-                freshen the music. Defaults to the contents of the destination
+                freshen the music. Either a `DestinationIndex` or an iterable
+                of filenames. Defaults to the contents of the destination
                 directory tree.
+            @keyword filterFunc: A function that determines if a track can be 
+                copied to the target.
+            @keyword fill: If `True`, keep going after a track doesn't fit,
+                adding any later tracks that do, then rearrange the smallest
+                tracks to use up as much of the remaining space as possible.
+                Otherwise, selection stops at the first track that doesn't
+                fit.
+            @keyword freeSpace: The number of bytes free on the destination,
+                used with `minFree`. Defaults to the space currently free;
+                supply it to select music for space that is still being
+                freed (see ``freshenMusic()``).
+            @keyword trackIds: The IDs of the tracks from which to choose,
+                e.g. from ``TrackTable.select()``, used instead of the 
+                `playlist`. Any `filterFunc` is still applied.
             @returns: (<total bytes to be copied>, [<track1>, <track2>, ...]) 
         """
         dest = self.target if dest is None else dest
         targetFree, targetBlockSize = self.getStats(dest)
+        if freeSpace is not None:
+            targetFree = freeSpace
 
         if minFree is None and maxSize is None:
             raise ValueError, "Either minFree or maxSize must be supplied."
@@ -276,19 +2214,28 @@ class MusicMover(object):
         total = 0
         tracks = []
         if oldFiles is None:
-            existingFiles = self.getMusicFiles(dest)
-        else:
+            existingFiles = self.getDestinationIndex(dest)
+        elif isinstance(oldFiles, DestinationIndex):
             existingFiles = oldFiles
+        else:
+            existingFiles = DestinationIndex(oldFiles)
             
         # By default, iTunes mixes formats in it 'Music' playlist, so remove
-        # non-music items explicitly.
-        tracks = filter(lambda t: self.isMusicFile(t.get('Location','')),
-                        self.library.getTracks(playlist, filterFunc=filterFunc))
+        # non-music items explicitly. They are skipped as the tracks are 
+        # taken, so only the tracks actually considered get checked.
+        tracks = list(self._getTracks(playlist, filterFunc, trackIds))
+        isMusicFile = self.isMusicFile
+        tracks = (t for t in self._orderTracks(tracks, dest)
+                  if isMusicFile(t.get('Location', '')))
+        if fill:
+            total, newTracks = self._fillSpace(tracks, dest, maxSize, 
+                                               targetBlockSize, existingFiles)
+            self.unusedBytes = maxSize - total
+            return (total, newTracks)
 
-        random.shuffle(tracks)
         newTracks = []
         for track in tracks:
-            filesize = track.get('Size',-1)
+            filesize = self.getTrackSize(track)
             newTotal = total + self.roundUpTo(filesize, targetBlockSize)
             if newTotal >= maxSize:
                 break
@@ -297,26 +2244,476 @@ class MusicMover(object):
                 continue
             newTracks.append(track)
             total = newTotal
+        self.unusedBytes = maxSize - total
+        return (total, newTracks)
+
+
+    def _getTracks(self, playlist, filterFunc=None, trackIds=None):
+        """ Get the tracks in a playlist, or with the given IDs.
+        """
+        if trackIds is None:
+            return self.library.getTracks(playlist, filterFunc=filterFunc)
+        getTrackById = self.library.getTrackById
+        return (t for t in (getTrackById(i) for i in trackIds)
+                if t is not None and (filterFunc is None or filterFunc(t)))
+
+
+    def _orderTracks(self, tracks, dest):
+        """ Randomly order tracks, taking into account the `weights` given
+            to the constructor and the device's history (if kept). The 
+            order is a weighted random sample without replacement, produced
+            lazily, so only as many tracks as are used are ordered.
+            
+            @param tracks: A list of tracks.
+            @param dest: The destination path.
+            @return: A generator of tracks.
+        """
+        weights = self.weights
+        if self.useHistory:
+            historyWeight = self._getHistoryWeights(self.getHistory(dest))
+            if weights is None:
+                weights = historyWeight
+            else:
+                userWeight = weights
+                weights = lambda t: userWeight(t) * historyWeight(t)
+        if weights is None:
+            return sampling.randomOrder(tracks, self.random)
+        return sampling.weightedOrder(tracks, map(weights, tracks), 
+                                      self.random)
+
+
+    def _getHistoryWeights(self, history):
+        """ Get a function giving the weights of tracks according to the
+            device's history, favoring those that haven't been on the device
+            recently. A track last on the device `historyHalfLife` days ago
+            has half the weight of one never on it.
+            
+            @param history: The device's `CopyHistory`.
+        """
+        now = time.time()
+        halfLife = self.historyHalfLife * 86400.0
+        lastSeen = history.lastSeen
+        def historyWeight(track):
+            seen = lastSeen.get(track.get('Track ID'))
+            if seen is None:
+                return 1.0
+            return 1 - 0.5 ** (max(now - seen, 0) / halfLife)
+        return historyWeight
+
+
+    def _fillSpace(self, tracks, dest, maxSize, blocksize, existingFiles):
+        """ Select tracks to fill the available space as completely as 
+            possible. First, tracks are taken in order, skipping any that 
+            don't fit. Then, the smallest of the selected tracks and some of
+            the skipped ones that could fit in their place are repacked by
+            solving a subset-sum problem (in whole blocks) over the remaining
+            space. The result is never worse than the first pass.
+            
+            @param tracks: The candidate tracks, in order of preference.
+            @param dest: The destination path.
+            @param maxSize: The total size, in bytes, which the selected 
+                tracks must stay below.
+            @param blocksize: The destination's block size.
+            @param existingFiles: A `DestinationIndex` of files to exclude.
+            @returns: (<total bytes to be copied>, [<track1>, <track2>, ...]) 
+        """
+        if maxSize <= 0:
+            return (0, [])
+        roundUpTo = self.roundUpTo
+        selected = []
+        skipped = []
+        total = 0
+        for track in tracks:
+            size = roundUpTo(self.getTrackSize(track), blocksize)
+            if total + size >= maxSize:
+                skipped.append((size, track))
+                continue
+            if self.targetName(track, dest) in existingFiles:
+                continue
+            selected.append((size, track))
+            total += size
+        
+        if not skipped or maxSize - 1 - total <= 0:
+            return (total, [track for size, track in selected])
+        
+        # Release the smallest selected tracks back into the pool, so they
+        # can be swapped for combinations of skipped ones that fit better.
+        budget = maxSize - 1 - total
+        release = sorted(selected, key=lambda x: x[0])
+        release = release[:self.fillCandidates / 2]
+        budget += sum(size for size, track in release)
+        
+        pool = list(release)
+        for size, track in skipped:
+            if len(pool) >= self.fillCandidates:
+                break
+            if size <= budget and \
+                    self.targetName(track, dest) not in existingFiles:
+                pool.append((size, track))
+        
+        # Subset-sum over whole units (normally blocks). Each bit of `reach`
+        # marks a total (in units) that some subset of the pool adds up to.
+        # Units are made larger if need be, so there are no more than
+        # `fillMaxUnits` bits; sizes are rounded up, so the result still
+        # fits.
+        unit = blocksize
+        limit = min(budget, sum(size for size, track in pool)) // unit
+        if limit > self.fillMaxUnits:
+            unit *= -(-limit // self.fillMaxUnits)
+        weights = [-(-size // unit) for size, track in pool]
+        capacity = min(budget // unit, sum(weights))
+        mask = (1 << (capacity + 1)) - 1
+        reach = 1
+        history = []
+        for w in weights:
+            history.append(reach)
+            reach = (reach | (reach << w)) & mask
+        
+        best = reach.bit_length() - 1
+        chosen = set()
+        for i in xrange(len(pool) - 1, -1, -1):
+            if not (history[i] >> best) & 1:
+                chosen.add(i)
+                best -= weights[i]
+        
+        if sum(pool[i][0] for i in chosen) < \
+                sum(size for size, track in release):
+            # Possible if the units were made larger; keep the first pass.
+            return (total, [track for size, track in selected])
+        
+        released = set(id(track) for size, track in release)
+        newTracks = [track for size, track in selected 
+                     if id(track) not in released]
+        total -= sum(size for size, track in release)
+        for i in sorted(chosen):
+            size, track = pool[i]
+            newTracks.append(track)
+            total += size
         return (total, newTracks)
 
 
     def copyFile(self, source, dest):
         """ Copy a file, creating the destination subdirectory if required.
-            Replace this for debugging purposes, or if the target device isn't
-            really a normal filesystem.
+            Replace this for debugging purposes; to copy to a device that
+            isn't really a normal filesystem, supply a backend (see 
+            `targets`) instead. Note that while this isn't replaced, 
+            ``copyTracks()`` hands files to the backend in batches rather
+            than calling it.
         """
         destPath = os.path.dirname(dest)
-        if not os.path.exists(destPath):
-            os.makedirs(destPath)
-            
+        if destPath not in self._madeDirs:
+            self.makeDirs([destPath])
+        sourceFile = self._getSourceFile(source)
+        if self.resume:
+            return self._copyResumable(sourceFile, dest)
+        for f in self._getBackendFor(dest).putFiles([(sourceFile, dest)],
+                                                    self.copyBufferSize):
+            pass
+
+
+    def _getSourceFile(self, source):
+        """ Get the local filename of a track's URL.
+        """
         p = urlparse(source)
-        scheme = p.scheme.lower()
+        if p.scheme.lower() != "file":
+            raise NotImplementedError("Unknown scheme for %r" % source)
+        return os.path.abspath(url2pathname(p.path))
+
+
+    def _putFiles(self, jobs, sizes=None):
+        """ Copy a batch of files (see ``_copyFiles()``). They are handed
+            to the target's backend all at once, unless copying resumably
+            or ``copyFile()`` has been replaced, in which case that is 
+            called for each file.
+        
+            @param jobs: A list of (<source>, <destination>, <item>) tuples,
+                all on the same target.
+            @keyword sizes: The expected size of each job's file. Reported
+                instead if a replaced ``copyFile()`` didn't write the file;
+                defaults to the size of the source file.
+            @return: A generator of (<item>, <destination>, <seconds>,
+                <size>) tuples, as each copy completes. The size is that of
+                the file written, as reported by the backend.
+        """
+        started = time.time()
+        backend = self._getBackendFor(jobs[0][1])
+        if self.resume or self._isReplaced('copyFile'):
+            for n, (source, dupe, item) in enumerate(jobs):
+                self.copyFile(source, dupe)
+                try:
+                    size = backend.getSize(dupe)
+                except OSError as err:
+                    if err.errno != errno.ENOENT:
+                        raise
+                    # e.g. a replacement that only logs what it would copy
+                    if sizes is not None:
+                        size = sizes[n]
+                    else:
+                        size = os.path.getsize(self._getSourceFile(source))
+                now = time.time()
+                yield item, dupe, now - started, size
+                started = now
+            return
+        
+        self.makeDirs(os.path.dirname(dupe) for source, dupe, item in jobs)
+        items = dict((dupe, item) for source, dupe, item in jobs)
+        puts = [(self._getSourceFile(source), dupe) 
+                for source, dupe, item in jobs]
+        for dupe, size in backend.putFiles(puts, self.copyBufferSize):
+            now = time.time()
+            yield items[dupe], dupe, now - started, size
+            started = now
+
+
+    def isSameFile(self, sourceFile, dest, sourceStat=None):
+        """ Determine if a destination file is already a copy of a source
+            file: the sizes must match, and either the modification times
+            must match (within `mtimeTolerance`) or the files' first and
+            last 64KB must be identical.
+        
+            @param sourceFile: The source file's name.
+            @param dest: The destination file's name.
+            @keyword sourceStat: The result of ``os.stat()`` on the source
+                file, if already known.
+        """
+        try:
+            destStat = self._getBackendFor(dest).stat(dest)
+        except OSError:
+            return False
+        sourceStat = os.stat(sourceFile) if sourceStat is None else sourceStat
+        if destStat.st_size != sourceStat.st_size:
+            return False
+        if abs(destStat.st_mtime - sourceStat.st_mtime) <= self.mtimeTolerance:
+            return True
+        return quickHash(sourceFile, sourceStat.st_size) == \
+            quickHash(dest, destStat.st_size)
+
+
+    def _copyResumable(self, sourceFile, dest):
+        """ Copy a file so that it can be resumed if interrupted. The copy
+            is skipped entirely if the destination already matches the 
+            source (see ``isSameFile()``). Otherwise, the data is written to
+            a hidden temporary file named for the source's size and 
+            modification time, then renamed to the destination. If that 
+            temporary file already exists, copying continues from near its
+            end (the last buffer's worth is rewritten, in case it wasn't
+            completely written).
+        """
+        st = os.stat(sourceFile)
+        if self.isSameFile(sourceFile, dest, st):
+            return
         
-        if scheme == "file":
-            sourceFile = os.path.abspath(url2pathname(p.path))
-            return shutil.copy2(sourceFile, dest)
+        destPath, destName = os.path.split(dest)
+        partial = os.path.join(destPath, ".%s.%d-%d%s" % (destName, 
+            st.st_size, int(st.st_mtime), self.partialExt))
+        offset = 0
+        try:
+            written = self._getBackendFor(partial).stat(partial).st_size
+        except OSError:
+            pass
         else:
-            raise NotImplementedError("Unknown scheme for %r" % source)
+            offset = max(0, min(written, st.st_size) - self.copyBufferSize)
+        
+        with open(sourceFile, 'rb') as fsrc:
+            with open(partial, 'r+b' if offset else 'wb') as fdst:
+                fsrc.seek(offset)
+                fdst.seek(offset)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, self.copyBufferSize)
+                fdst.flush()
+                os.fsync(fdst.fileno())
+        shutil.copystat(sourceFile, partial)
+        os.rename(partial, dest)
+
+
+    def _getPendingFile(self, dest):
+        return os.path.join(dest, DeviceManifest.metaDir, self.pendingName)
+
+
+    def _writePending(self, tracks, dest):
+        """ Record the IDs of the tracks about to be copied, so an 
+            interrupted copy can be resumed (see ``getPendingTracks()``).
+        """
+        filename = self._getPendingFile(dest)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename + ".tmp", 'wb') as f:
+            for track in tracks:
+                if track.get('Track ID') is not None:
+                    f.write("%d\n" % track['Track ID'])
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(filename + ".tmp", filename)
+
+
+    def getPendingTracks(self, dest=None):
+        """ Get the tracks from an interrupted resumable copy, if any.
+
+            @keyword dest: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+            @return: A list of tracks, or `None` if there was no unfinished
+                copy.
+        """
+        dest = self.target if dest is None else dest
+        filename = self._getPendingFile(dest)
+        if not os.path.exists(filename):
+            return None
+        tracks = []
+        with open(filename, 'rb') as f:
+            for line in f:
+                track = self.library.getTrackById(line.strip())
+                if track is not None:
+                    tracks.append(track)
+        return tracks
+
+
+    def makeDirs(self, dirs):
+        """ Create a set of directories (and any missing parents) on the
+            target, if they don't already exist. Directories are only 
+            checked once per `MusicMover`; it is assumed nothing else will
+            remove them mid-run. The new directories are created by the
+            target's backend, all at once.
+
+            @param dirs: An iterable of directory names. Duplicates are 
+                ignored.
+        """
+        dirs = sorted(set(dirs).difference(self._madeDirs))
+        if dirs:
+            self._getBackendFor(dirs[0]).makeDirs(dirs)
+            self._madeDirs.update(dirs)
+
+
+    def _copyFiles(self, jobs, ledger=None, sizes=None, idle=None):
+        """ Copy files using a pool of worker threads (see `copyWorkers`).
+            Jobs are fed to the workers through a bounded queue; each worker
+            takes as many as are waiting, up to the backend's `batchSize`,
+            and copies them together (see ``_putFiles()``). No new jobs are
+            started once `canceled` is set, although copies already in 
+            progress are allowed to finish. With only one worker, or if
+            ``copyFile()`` has been replaced (it needn't be thread-safe), 
+            files are copied one at a time, on the calling thread.
+
+            This is a generator, yielding as each copy completes. It runs
+            on the calling thread, so anything done between iterations 
+            (e.g. ``copyCallback()``) needn't be thread-safe. If any copy
+            fails, the first exception is raised once the workers stop.
+
+            @param jobs: A list of (<source>, <destination>, <item>) tuples.
+                The `item` is arbitrary, e.g. the track being copied.
+            @keyword ledger: A `SpaceLedger`. If supplied, each copy is 
+                started only once the ledger has room for it.
+            @keyword sizes: The size of each job's file, for the `ledger`.
+            @keyword idle: An iterator to advance, on the calling thread,
+                while copies are running or waiting for space; e.g. one that
+                deletes files and returns their space to the `ledger`.
+                Copies that still don't fit once it is exhausted are 
+                skipped.
+            @return: A generator of (<item>, <destination>, <seconds>, 
+                <size>) tuples: the time taken by the copy, and the size of
+                the file written.
+        """
+        exhausted = object()
+        workers = min(self.copyWorkers, len(jobs))
+        if workers <= 1 or self._isReplaced('copyFile'):
+            for n, (source, dupe, item) in enumerate(jobs):
+                if self.canceled:
+                    break
+                while ledger is not None and not ledger.claim(sizes[n]):
+                    if next(idle, exhausted) is exhausted:
+                        break
+                else:
+                    job = [(source, dupe, item)]
+                    size = [sizes[n]] if sizes is not None else None
+                    for result in self._putFiles(job, size):
+                        yield result
+            return
+        
+        todo = Queue.Queue(self.copyQueueSize)
+        done = Queue.Queue()
+        batchSize = self._getBackendFor(jobs[0][1]).batchSize
+        
+        def work():
+            while True:
+                job = todo.get()
+                if job is None:
+                    return
+                batch = [job]
+                while len(batch) < batchSize:
+                    try:
+                        job = todo.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if job is None:
+                        # Another worker's signal to stop; leave it.
+                        todo.put(None)
+                        break
+                    batch.append(job)
+                finished = 0
+                try:
+                    for item, dupe, elapsed, size in self._putFiles(batch):
+                        done.put((item, dupe, elapsed, size, None))
+                        finished += 1
+                except Exception:
+                    exc = sys.exc_info()
+                    for source, dupe, item in batch[finished:]:
+                        done.put((item, dupe, None, None, exc))
+        
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        
+        remaining = list(reversed(jobs))
+        if ledger is not None:
+            remainingSizes = list(reversed(sizes))
+        idling = idle is not None
+        pending = 0
+        error = None
+        try:
+            while True:
+                if self.canceled or error is not None:
+                    # Drop copies that haven't been started yet.
+                    try:
+                        while True:
+                            todo.get_nowait()
+                            pending -= 1
+                    except Queue.Empty:
+                        pass
+                else:
+                    while remaining and not todo.full():
+                        if ledger is not None:
+                            if not ledger.claim(remainingSizes[-1]):
+                                break
+                            remainingSizes.pop()
+                        todo.put(remaining.pop())
+                        pending += 1
+                if idling and error is None:
+                    idling = next(idle, exhausted) is not exhausted
+                    finished = []
+                    try:
+                        while True:
+                            finished.append(done.get_nowait())
+                    except Queue.Empty:
+                        pass
+                elif pending == 0:
+                    # Anything left over won't fit.
+                    break
+                else:
+                    finished = [done.get()]
+                for item, dupe, elapsed, size, exc in finished:
+                    pending -= 1
+                    if exc is not None:
+                        error = error or exc
+                    elif error is None:
+                        yield item, dupe, elapsed, size
+        finally:
+            for t in threads:
+                todo.put(None)
+            for t in threads:
+                t.join()
+        
+        if error is not None:
+            raise error[0], error[1], error[2]
 
 
     def copyCallback(self, num, total, orig, dupe):
@@ -327,10 +2724,45 @@ class MusicMover(object):
 
 
     def deleteFile(self, filename):
-        """ Delete a file. Replace this for debugging purposes, or if the
-            target device isn't really a normal filesystem.
+        """ Delete a file. Replace this for debugging purposes; to delete
+            from a device that isn't really a normal filesystem, supply a 
+            backend (see `targets`) instead. Note that while this isn't 
+            replaced, files are deleted in batches by ``deleteFiles()``
+            rather than by calling it.
+        """
+        for f in self.deleteFiles([filename]):
+            pass
+
+
+    def deleteFiles(self, files):
+        """ Delete files from a target, handing them to its backend in 
+            batches.
+        
+            @param files: An iterable of filenames, all on the same target.
+                Files are taken from it only as each batch is needed.
+            @return: A generator, yielding each filename once deleted.
+        """
+        files = iter(files)
+        for first in files:
+            backend = self._getBackendFor(first)
+            for f in backend.deleteFiles(chain([first], files)):
+                self._forgetFile(f)
+                yield f
+
+
+    def _forgetFile(self, filename):
+        """ Remove a deleted file from the target's manifest and record its
+            deletion in the target's history (if they are kept).
         """
-        return os.remove(filename)
+        trackId = None
+        manifest = self._getManifestFor(filename)
+        if manifest is not None:
+            entry = manifest.files.get(manifest._relpath(filename))
+            trackId = entry[1] if entry else None
+            manifest.remove(filename)
+        history = self._getHistoryFor(filename)
+        if history is not None:
+            history.recordDelete(filename, trackId)
 
 
     def deleteCallback(self, num, total, filename):
@@ -340,6 +2772,32 @@ class MusicMover(object):
         print "deleting %d of %d: %s" % (num, total, filename)
     
 
+    def renameFile(self, source, dest):
+        """ Rename a file on the target, creating the destination 
+            subdirectory if required.
+        """
+        destPath = os.path.dirname(dest)
+        if destPath not in self._madeDirs:
+            self.makeDirs([destPath])
+        backend = self._getBackendFor(dest)
+        backend.rename(source, dest)
+        manifest = self._getManifestFor(source)
+        if manifest is not None:
+            entry = manifest.files.get(manifest._relpath(source))
+            manifest.remove(source)
+            if entry is not None:
+                manifest.add(dest, *entry)
+            else:
+                manifest.add(dest, backend.getSize(dest))
+
+
+    def renameCallback(self, num, total, source, dest):
+        """ Called after every file is renamed. This one is placeholder, and
+            is meant to be replaced by something more interesting (GUI, etc.).
+        """
+        print "renaming %d of %d: %s" % (num, total, dest)
+
+
     def copyMusic(self, totalSize, files):
         """ Copy music files. Uses the ``copyFile`` method (to keep things 
             slightly abstract and flexible). 
@@ -350,13 +2808,23 @@ class MusicMover(object):
                 The original filenames are relative to `sourceRoot`.
         """
         totalFiles = len(files)
-        c = 1
-        for original, dupe in files:
-            if self.canceled:
-                break
-            self.copyCallback(c, totalFiles, original, dupe)
-            self.copyFile(original, dupe)
-            c+=1
+        self.makeDirs(os.path.dirname(dupe) for original, dupe in files)
+        jobs = [(original, dupe, original) for original, dupe in files]
+        manifest = None
+        if self.useManifest and files:
+            manifest = self._getManifestFor(files[0][1])
+        self._notify('copyStarted', totalFiles, totalSize)
+        try:
+            with self._phase('copy'):
+                copies = self._copyFiles(jobs)
+                for c, (original, dupe, elapsed, size) in enumerate(copies, 1):
+                    if manifest is not None:
+                        manifest.add(dupe, size)
+                    self._notify('fileCopied', dupe, size, elapsed)
+                    self.copyCallback(c, totalFiles, original, dupe)
+        finally:
+            if manifest is not None:
+                manifest.save()
 
 
     def preCopyTracks(self):
@@ -379,7 +2847,8 @@ class MusicMover(object):
 
     def freshenMusic(self, dest=None, playlist="Music", percent=33,
                      maxSize=None, minFree=minFreeSpace,
-                     deleteFilter=None, newFilter=None):
+                     deleteFilter=None, newFilter=None, fill=False,
+                     overlap=False, libraryOnly=False):
         """ Remove some portion of the music on the target device, then copy
             over new music. The amount of new material is determined by either
             a maximum size of copied material or by a minimum amount of free
@@ -403,33 +2872,587 @@ class MusicMover(object):
                 can be deleted.
             @keyword newFilter: A function that determines if a track can be 
                 copied to the target. Defaults to any audio track.
+            @keyword fill: If `True`, pack new tracks to use as much of the
+                available space as possible. See ``getNewMusic()``.
+            @keyword overlap: If `True`, select and copy new music while the
+                old music is still being deleted. See 
+                ``_freshenOverlapped()``.
+            @keyword libraryOnly: If `True`, only delete music copied from
+                the library, leaving any put on the target by other means.
         """
         
         dest = self.target if dest is None else dest
-        oldFiles = list(self.getMusicFiles(dest))
-        toDelete = self.getRemovalList(dest, percent=percent,
-                                       filterFunc=deleteFilter, files=oldFiles)
+        self.getBackend(dest)
+        
+        if self.resume:
+            pending = self.getPendingTracks(dest)
+            if pending is not None:
+                # The last run was interrupted; finish it instead.
+                self.copyTracks(pending, dest=dest)
+                return
         
+        oldFiles, toDelete, maxSize = self._planRemoval(dest, percent, 
+            maxSize, deleteFilter, libraryOnly)
+        if overlap:
+            self._freshenOverlapped(dest, toDelete, oldFiles, maxSize, 
+                                    minFree, playlist, newFilter, fill)
+        else:
+            tracks = self._deleteAndSelect(dest, toDelete, oldFiles, maxSize,
+                                           minFree, playlist, newFilter, fill)
+            self.copyTracks(tracks, dest=dest)
+        self.saveTargetNames()
+        self.postCopyTracks()
+
+
+    def _planRemoval(self, dest, percent, maxSize, deleteFilter, libraryOnly):
+        """ Index a target and choose the files to remove from it (see 
+            ``freshenMusic()``).
+            
+            @return: The target's `DestinationIndex`, the list of files to
+                remove, and the space (in MB) for new music within `maxSize`
+                (or `None`).
+        """
+        oldFiles = self.getDestinationIndex(dest)
+        toDelete = self.getRemovalList(dest, percent=percent,
+                                       filterFunc=deleteFilter, files=oldFiles,
+                                       libraryOnly=libraryOnly)
         if maxSize is not None:
-            maxSize -= self.getMusicSize(oldFiles) / 1048576
+            maxSize -= self.getMusicSize(oldFiles, path=dest) / 1048576
+        return oldFiles, toDelete, maxSize
+
+
+    def _deleteAndSelect(self, dest, toDelete, oldFiles, maxSize, minFree,
+                         playlist, newFilter, fill):
+        """ Remove files from a target, then choose the new music for it
+            (see ``freshenMusic()``).
+            
+            @return: A list of tracks to copy.
+        """
+        history = self.getHistory(dest) if self.useHistory else None
+        for size in self._deleteFiles(toDelete):
+            pass
+        if history is not None:
+            history.commit()
+        
+        with self._phase('select'):
+            m = self.getNewMusic(dest, maxSize, minFree, playlist,
+                                 oldFiles=oldFiles, filterFunc=newFilter,
+                                 fill=fill)
+        return m[1]
+
+
+    def freshenDevices(self, dests, playlist="Music", percent=33,
+                       maxSize=None, minFree=minFreeSpace, deleteFilter=None,
+                       newFilter=None, fill=False, libraryOnly=False):
+        """ Freshen the music on several target devices at once. Old music
+            is removed and new music chosen for each device in turn, then 
+            the new music is copied to all of them together by 
+            ``copyToDevices()``. Takes the same arguments as 
+            ``freshenMusic()``, which apply to every device.
             
-        totalToDelete = len(toDelete)
-        for i in xrange(totalToDelete):
+            @param dests: A list of destination paths.
+        """
+        plans = []
+        for dest in dests:
             if self.canceled:
                 break
-            f = toDelete.pop()
-            self.deleteFile(f)
-            self.deleteCallback(i, totalToDelete, f)
+            self.getBackend(dest)
+            if self.resume:
+                pending = self.getPendingTracks(dest)
+                if pending is not None:
+                    # Only finish the last run's copying on this target.
+                    plans.append((dest, pending))
+                    continue
+            oldFiles, toDelete, size = self._planRemoval(dest, percent, 
+                maxSize, deleteFilter, libraryOnly)
+            tracks = self._deleteAndSelect(dest, toDelete, oldFiles, size,
+                                           minFree, playlist, newFilter, fill)
+            plans.append((dest, tracks))
+        self.copyToDevices(plans)
+        self.saveTargetNames()
+
+
+    def copyToDevices(self, plans):
+        """ Copy tracks to several targets at once. Each source file is 
+            read once, by a single reader thread, and its data is passed to
+            a writer thread for each target that needs it, so every target
+            is written in parallel. Each writer's queue holds at most
+            `copyQueueSize` blocks of `copyBufferSize` bytes, so the reader
+            can't get too far ahead of the slowest target. 
+            
+            Files are written a block at a time through each target's 
+            backend (see ``targets.TargetBackend.openFile()``) rather than
+            by ``copyFile()``, each under a temporary name (see 
+            `partialExt`) until the copy is complete, so a failed copy 
+            never leaves a truncated file behind. In resume mode, copies already on a target are skipped, but 
+            partial copies are started over. Bookkeeping (manifests, 
+            history, callbacks and observers) is done on the calling 
+            thread.
+            
+            @param plans: A list of (<destination path>, <list of tracks>)
+                tuples.
+        """
+        self.preCopyTracks()
+        allTracks = {}
+        backends = {}
+        for dest, tracks in plans:
+            backends[dest] = self.getBackend(dest)
+            if self.resume:
+                self._writePending(tracks, dest)
+            for track in tracks:
+                allTracks[id(track)] = track
+        sources = {}
+        if self.transcoder is not None:
+            # Transcode each track once, however many targets get it.
+            sources = self._transcodeTracks(allTracks.values())[1]
+        
+        # Group the copies by source file: {source: [(dest, dupe, track)]}
+        bySource = {}
+        sizes = {}
+        for dest, tracks in plans:
+            for track in tracks:
+                if self.transcoder is not None and \
+                        self.transcoder.handles(track) and \
+                        id(track) not in sources:
+                    continue
+                source, size = sources.get(id(track), 
+                                           (track['Location'], None))
+                p = urlparse(source)
+                if p.scheme != "file":
+                    raise NotImplementedError("Unknown scheme for %r" % source)
+                sourceFile = os.path.abspath(url2pathname(p.path))
+                dupe = self.targetName(track, dest)
+                if self.resume and self.isSameFile(sourceFile, dupe):
+                    continue
+                bySource.setdefault(sourceFile, []).append((dest, dupe, track))
+                if size is None:
+                    size = max(track.get('Size', 0), 0)
+                sizes[(dest, id(track))] = size
+        
+        self.makeDirs(os.path.dirname(dupe) for copies in bySource.values()
+                      for dest, dupe, track in copies)
+        totalFiles = len(sizes)
+        self._notify('copyStarted', totalFiles, sum(sizes.values()))
+        
+        queues = dict((dest, Queue.Queue(self.copyQueueSize))
+                      for dest, tracks in plans)
+        done = Queue.Queue()
+        stop = threading.Event()
+        
+        def read():
+            try:
+                for sourceFile in sorted(bySource):
+                    if self.canceled or stop.is_set():
+                        break
+                    copies = bySource[sourceFile]
+                    with open(sourceFile, 'rb') as f:
+                        for dest, dupe, track in copies:
+                            queues[dest].put(('open', dupe, track))
+                        try:
+                            while True:
+                                data = f.read(self.copyBufferSize)
+                                if not data:
+                                    break
+                                for dest, dupe, track in copies:
+                                    queues[dest].put(('data', data, None))
+                        except Exception:
+                            for dest, dupe, track in copies:
+                                queues[dest].put(('abort', None, None))
+                            raise
+                    for dest, dupe, track in copies:
+                        queues[dest].put(('close', sourceFile, None))
+            except Exception:
+                done.put(('error', None, None, None, sys.exc_info()))
+            finally:
+                for q in queues.itervalues():
+                    q.put(None)
+        
+        def discard(f):
+            # Remove an incomplete copy, so it can't pass for a whole one.
+            if f is not None:
+                f.discard()
+        
+        def write(dest, q):
+            # Each file is written under a hidden temporary name, and only
+            # appears under the real one once complete.
+            backend = backends[dest]
+            f = dupe = track = None
+            while True:
+                msg = q.get()
+                if msg is None:
+                    break
+                kind, arg, item = msg
+                try:
+                    if kind == 'open':
+                        dupe, track = arg, item
+                        destPath, destName = os.path.split(dupe)
+                        partial = os.path.join(destPath, ".%s%s" % \
+                                               (destName, self.partialExt))
+                        started = time.time()
+                        f = backend.openFile(dupe, partial)
+                    elif f is None:
+                        # A previous error; skip the rest of this file.
+                        continue
+                    elif kind == 'data':
+                        f.write(arg)
+                    elif kind == 'close':
+                        size = f.close(arg)
+                        f = None
+                        done.put(('copied', dest, track, dupe,
+                                  (time.time() - started, size)))
+                    elif kind == 'abort':
+                        discard(f)
+                        f = None
+                except Exception:
+                    discard(f)
+                    f = None
+                    done.put(('error', dest, track, dupe, sys.exc_info()))
+            discard(f)
+            done.put(('finished', dest, None, None, None))
+        
+        threads = [threading.Thread(target=read)]
+        threads.extend(threading.Thread(target=write, args=(dest, q))
+                       for dest, q in queues.iteritems())
+        for t in threads:
+            t.daemon = True
+            t.start()
+        
+        manifests = {}
+        histories = {}
+        for dest, tracks in plans:
+            if self.useManifest:
+                manifests[dest] = self.getManifest(dest)
+            if self.useHistory:
+                histories[dest] = self.getHistory(dest)
+        error = None
+        running = len(queues)
+        c = 0
+        try:
+            with self._phase('copy'):
+                while running:
+                    kind, dest, track, dupe, info = done.get()
+                    if kind == 'finished':
+                        running -= 1
+                    elif kind == 'error':
+                        error = error or info
+                        stop.set()
+                    elif error is None:
+                        c += 1
+                        elapsed, size = info
+                        if dest in manifests:
+                            manifests[dest].add(dupe, size, 
+                                                track.get('Track ID'))
+                        if dest in histories:
+                            histories[dest].recordCopy(dupe, 
+                                                       track.get('Track ID'))
+                        self._notify('fileCopied', dupe, size, elapsed)
+                        self.copyCallback(c, totalFiles, track, dupe)
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
+            for manifest in manifests.itervalues():
+                manifest.save()
+            for history in histories.itervalues():
+                history.commit()
+        
+        if error is not None:
+            raise error[0], error[1], error[2]
+        if self.resume and not self.canceled:
+            for dest, tracks in plans:
+                os.remove(self._getPendingFile(dest))
+        self.postCopyTracks()
+
+
+    def _deleteFiles(self, files, index=None):
+        """ Delete files (last first), calling ``deleteCallback()`` after 
+            each. This is a generator, deleting one file per iteration and
+            yielding its size (if known to `index`), so deletions can be 
+            interleaved with other work. It stops if `canceled` is set.
+
+            @param files: A list of filenames.
+            @keyword index: A `DestinationIndex` containing the files' sizes.
+        """
+        total = len(files)
+        sizes = {}
+        if index is not None:
+            sizes = dict(zip(files, self._sizeFiles(files, index)))
+        todo = takewhile(lambda f: not self.canceled, reversed(files))
+        if self._isReplaced('deleteFile'):
+            deleted = (self.deleteFile(f) or f for f in todo)
+        else:
+            deleted = self.deleteFiles(todo)
+        with self._phase('delete'):
+            started = time.time()
+            for i, f in enumerate(deleted):
+                now = time.time()
+                size = sizes.get(f)
+                self._notify('fileDeleted', f, size, now - started)
+                self.deleteCallback(i, total, f)
+                started = now
+                yield size
+
+
+    def _freshenOverlapped(self, dest, toDelete, oldFiles, maxSize, minFree,
+                           playlist, newFilter, fill):
+        """ The delete and copy phases of ``freshenMusic()``, overlapped. 
+            New music is selected on another thread while the old files are
+            deleted, using the free space there will be once the deletions
+            are done. After that, the deletions continue between copies, 
+            and a `SpaceLedger` keeps each copy waiting until enough space
+            has been freed for it.
+        """
+        # Open the history here: SQLite connections can only be used on the
+        # thread that made them, and the deletions are recorded on this one.
+        history = self.getHistory(dest) if self.useHistory else None
+        self._sizeFiles(toDelete, oldFiles)
+        free, blockSize = self.getStats(dest)
+        ledger = SpaceLedger(free, blockSize)
+        freeLater = free + sum(ledger.roundUp(oldFiles.getSize(f))
+                               for f in toDelete)
+        
+        result = {}
+        def select():
+            started = time.time()
+            try:
+                result['music'] = self.getNewMusic(dest, maxSize, minFree,
+                    playlist, oldFiles=oldFiles, filterFunc=newFilter, 
+                    fill=fill, freeSpace=freeLater)
+            except Exception:
+                result['error'] = sys.exc_info()
+            result['elapsed'] = time.time() - started
+        
+        # Observers are only notified on this thread, so the selection
+        # phase is reported once the selection thread has finished.
+        self._notify('phaseStarted', 'select')
+        selector = threading.Thread(target=select)
+        selector.daemon = True
+        selector.start()
+        
+        deletes = self._deleteFiles(toDelete, oldFiles)
+        for size in deletes:
+            ledger.release(size)
+            if not selector.is_alive():
+                break
+        selector.join()
+        self._notify('phaseFinished', 'select', result['elapsed'])
+        if 'error' in result:
+            error = result['error']
+            raise error[0], error[1], error[2]
+        
+        def deleteMore():
+            for size in deletes:
+                ledger.release(size)
+                yield size
+        
+        self.copyTracks(result['music'][1], dest=dest, ledger=ledger,
+                        idle=deleteMore())
+        for size in deletes:
+            pass
+        if history is not None:
+            history.commit()
+
+
+    def updateMusic(self, dest=None, changes=None):
+        """ Bring the music on a target up to date with changes made to the
+            library since its last snapshot (see `iTunesLibrary.changes`),
+            touching only the files affected: files of tracks removed from
+            the library are deleted, files whose target name changed (the
+            track was moved or retagged) are renamed, and files whose source
+            was rewritten are copied again. Nothing else on the target is
+            read. New tracks are not added; that is left to 
+            ``freshenMusic()``.
+            
+            Applying the same changes again does nothing, so a target can
+            be updated any number of times between changes to the library.
+            Changes made to the library while a target isn't updated are
+            not seen, however; if in doubt, freshen it instead.
+            
+            @keyword dest: The destination path. Defaults to the 'target'
+                specified when constructing the MusicMover object.
+            @keyword changes: A `LibraryChanges`. Defaults to the library's
+                own `changes`.
+            @return: The numbers of files deleted, renamed and copied.
+        """
+        dest = self.target if dest is None else dest
+        backend = self.getBackend(dest)
+        changes = self.library.changes if changes is None else changes
+        if changes is None:
+            raise ValueError, "No previous snapshot of the library to "\
+                "compare with (is the library cache enabled?)"
+        
+        toDelete = []
+        for trackId in changes.removed:
+            old = self._getPreviousName(changes.previous[trackId], dest)
+            if backend.exists(old):
+                toDelete.append(old)
+        
+        toRename = []
+        toCopy = []
+        modified = set(changes.modified)
+        for trackId in changes.getChanged():
+            track = self.library.tracks[trackId]
+            old = self._getPreviousName(changes.previous[trackId], dest)
+            if not backend.exists(old):
+                continue
+            new = self.targetName(track, dest)
+            if old != new and trackId not in modified:
+                if backend.exists(new):
+                    toDelete.append(old)
+                else:
+                    toRename.append((old, new))
+                continue
+            source = url2pathname(urlparse(track.get('Location', '')).path)
+            if not os.path.exists(source):
+                continue
+            if old != new:
+                toDelete.append(old)
+                toCopy.append(track)
+            elif not self.isSameFile(source, old):
+                toCopy.append(track)
+        
+        manifest = self.getManifest(dest) if self.useManifest else None
+        history = self.getHistory(dest) if self.useHistory else None
+        renamed = 0
+        try:
+            deleted = sum(1 for size in self._deleteFiles(toDelete))
+            with self._phase('rename'):
+                for old, new in toRename:
+                    if self.canceled:
+                        break
+                    self.renameFile(old, new)
+                    renamed += 1
+                    self.renameCallback(renamed, len(toRename), old, new)
+        finally:
+            if manifest is not None:
+                manifest.save()
+            if history is not None:
+                history.commit()
+        
+        if toCopy and not self.canceled:
+            self.copyTracks(toCopy, dest=dest)
+        self.saveTargetNames()
+        return deleted, renamed, len(toCopy)
+
+
+    def _sizeFiles(self, files, index):
+        """ Add the sizes of files to a `DestinationIndex` that doesn't
+            have them yet.
+            
+            @return: The sizes of the files.
+        """
+        normalize = DestinationIndex.normalize
+        keys = [normalize(f) for f in files]
+        sizes = [index.files.get(k) for k in keys]
+        unsized = [i for i, size in enumerate(sizes) if size is None]
+        found = self._getSizes([files[i] for i in unsized])
+        for i, size in zip(unsized, found):
+            sizes[i] = index.files[keys[i]] = size
+        return sizes
+
+
+    def planFreshen(self, dest=None, playlist="Music", percent=33,
+                    maxSize=None, minFree=minFreeSpace, deleteFilter=None, 
+                    newFilter=None, fill=False, libraryOnly=False):
+        """ Work out what ``freshenMusic()`` would do, without changing the
+            target: the files it would delete, the tracks it would copy, 
+            and the space that would be left. New music is chosen for the
+            space there will be once the old music is deleted. Takes the
+            same arguments as ``freshenMusic()``.
+            
+            @return: A `SyncPlan`, which can be saved and later carried out
+                by ``executePlan()``.
+        """
+        dest = self.target if dest is None else dest
+        backend = self.getBackend(dest)
+        oldFiles, toDelete, maxSize = self._planRemoval(dest, percent, 
+            maxSize, deleteFilter, libraryOnly)
+        sizes = self._sizeFiles(toDelete, oldFiles)
+        free, blockSize = self.getStats(dest)
+        plan = SyncPlan(dest, free, blockSize)
+        for f, size in zip(toDelete, sizes):
+            plan.addDelete(f, size)
+        
+        with self._phase('select'):
+            tracks = self.getNewMusic(dest, maxSize, minFree, playlist,
+                oldFiles=oldFiles, filterFunc=newFilter, fill=fill,
+                freeSpace=free + plan.getDeleteSize(True))[1]
+        dirs = set()
+        for track in tracks:
+            dupe = self.targetName(track, dest)
+            plan.addCopy(track['Location'], dupe, track.get('Track ID'),
+                         self.getTrackSize(track))
+            dirs.add(os.path.dirname(dupe))
+        plan.newDirs = sum(1 for d in dirs if not backend.exists(d))
+        self.saveTargetNames()
+        return plan
+
+
+    def executePlan(self, plan, dest=None):
+        """ Carry out a `SyncPlan` made by ``planFreshen()``. Files are 
+            deleted a directory at a time, and copied in order of 
+            destination directory and then source, so the target (and 
+            source) are written and read with as little seeking as 
+            possible. Files the plan would delete that are already gone are
+            skipped, so (when copying resumably) an interrupted plan can 
+            simply be carried out again.
             
+            @param plan: The `SyncPlan`.
+            @keyword dest: The destination path, if the target is no 
+                longer where it was when the plan was made.
+        """
+        dest = plan.root if dest is None else dest
+        backend = self.getBackend(dest)
+        self.preCopyTracks()
+        manifest = self.getManifest(dest) if self.useManifest else None
+        history = self.getHistory(dest) if self.useHistory else None
+        toDelete = [f for f, size in plan.getDeletes(dest) 
+                    if backend.exists(f)]
+        try:
+            # _deleteFiles() works backwards.
+            for size in self._deleteFiles(toDelete[::-1]):
+                pass
+        finally:
+            if manifest is not None:
+                manifest.save()
+            if history is not None:
+                history.commit()
+        if self.canceled:
+            return
         
-        m = self.getNewMusic(dest, maxSize, minFree, playlist,
-                             oldFiles=oldFiles, filterFunc=newFilter)
-        self.copyTracks(m[1], dest=dest)
+        tracks = []
+        names = {}
+        for source, dupe, trackId, size in plan.getCopies(dest):
+            track = {'Track ID': trackId, 'Location': source, 'Size': size}
+            tracks.append(track)
+            names[id(track)] = dupe
+        sources = {}
+        if self.transcoder is not None:
+            tracks, sources = self._transcodeTracks(tracks)
+        jobs = []
+        sizes = []
+        for track in tracks:
+            source, size = sources.get(id(track), (track['Location'], 
+                                                   track['Size']))
+            jobs.append((source, names[id(track)], track))
+            sizes.append(size)
+        self._copyJobs(jobs, sizes, dest)
         self.postCopyTracks()
 
 
+    def _getPreviousName(self, track, dest):
+        """ Get the name a track had on the target, before it changed. Not
+            memoized, unlike ``targetName()``.
+        """
+        name = self._makeTargetName(track, dest)
+        if self.transcoder is not None and self.transcoder.handles(track):
+            return self.transcoder.getTargetName(name)
+        return name
+
+
     def partition(self, playlist="Music", maxSize=4300, dest=None,
-                  blockSize=2048, useDestBlocksize=False, filterFunc=None):
+                  blockSize=2048, useDestBlocksize=False, filterFunc=None,
+                  strategy="nextfit", timeLimit=10.0, trackIds=None):
         """ Produce a list of lists from the given playlist, each containing
             a specified amount of data. Intended for doing backups to DVD-R.
             
@@ -441,20 +3464,31 @@ class MusicMover(object):
                 specified when constructing the MusicMover object.
             @keyword blockSize: The block size on the target device. Defaults
                 to 2048, a standard size for DVD-ROM.
-            @returns: ``[[track, track, ...],[track, track, ...],..]``
+            @keyword useDestBlocksize: If `True`, use the block size of the
+                destination rather than `blockSize`.
+            @keyword strategy: How to divide the tracks: "nextfit" (fill
+                each partition in playlist order), "ffd" (first-fit 
+                decreasing), "bfd" (best-fit decreasing) or "exact" (search
+                for the fewest partitions, for up to `timeLimit` seconds).
+                See the `packing` module.
+            @keyword timeLimit: The maximum time (in seconds) to spend
+                searching in "exact" mode.
+            @keyword trackIds: The IDs of the tracks to partition, in order,
+                e.g. from ``TrackTable.select()``, used instead of the 
+                `playlist`. Any `filterFunc` is still applied.
+            @returns: ``[[track, track, ...],[track, track, ...],..]``, or
+                an empty list if there are no tracks. Every strategy fills
+                a partition up to exactly `maxSize` (see `packing`).
         """
         dest = self.target if dest is None else dest
 
-        targetFree, targetBlockSize = self.getStats(dest)
         if useDestBlocksize:
-            blocksize = targetBlockSize
+            blockSize = self.getBlockSize(dest)
         maxSizeBytes = maxSize * 1024 * 1024
 
-        total = 0
-        allTracks = [[]]
-        trackSet = allTracks[0]
-        
-        for track in self.library.getTracks(playlist, filterFunc=filterFunc):
+        tracks = []
+        sizes = []
+        for track in self._getTracks(playlist, filterFunc, trackIds):
             filesize = track.get('Size', 0)
             if filesize == 0:
                 continue
@@ -462,18 +3496,172 @@ class MusicMover(object):
             if filesize > maxSizeBytes:
                 raise Exception("Track is larger than the partition size: %s" \
                                 % filesize)
-            newTotal = total + filesize
-            if newTotal >= maxSizeBytes:
-                trackSet = []
-                allTracks.append(trackSet)
-                newTotal = filesize
-            trackSet.append(track)
-            total = newTotal
-            
-        return allTracks
+            tracks.append(track)
+            sizes.append(filesize)
+        
+        kwargs = {'timeLimit': timeLimit} if strategy == "exact" else {}
+        bins = packing.pack(sizes, maxSizeBytes, strategy, **kwargs)
+        return [[tracks[i] for i in sorted(b)] for b in bins]
 
 
-    def copyTracks(self, tracks, dest=None):
+    def getPartitionStats(self, partitions, maxSize=4300, blockSize=2048):
+        """ Summarize the results of ``partition()``.
+        
+            @param partitions: A list of lists of tracks, as returned by
+                ``partition()``.
+            @keyword maxSize: The size of each partition (MB).
+            @keyword blockSize: The block size of the partitions' device.
+            @return: A dictionary containing the number of partitions 
+                ('count'), the total bytes used ('used'), the total capacity
+                ('capacity'), and the fraction of the capacity used ('fill'),
+                overall and for each partition ('fills').
+        """
+        capacity = maxSize * 1024 * 1024
+        used = [self.roundUpTotal([t.get('Size', 0) for t in p], blockSize)
+                for p in partitions]
+        totalCapacity = capacity * len(partitions)
+        return {'count': len(partitions),
+                'used': sum(used),
+                'capacity': totalCapacity,
+                'fill': sum(used) / float(totalCapacity or 1),
+                'fills': [u / float(capacity) for u in used]}
+
+
+    def writeDiscImages(self, partitions, dest=None, maxSize=4300,
+                        volumeId="MUSIC", workers=None):
+        """ Write the results of ``partition()`` as ISO 9660 disc images
+            (see `discimage`), one per partition, named for their volumes
+            (e.g. "MUSIC_01.iso"). Tracks are laid out as they would be
+            copied to a device (see ``targetName()``), and transcoded first
+            if there is a `transcoder`.
+            
+            Each partition is transcoded and laid out in turn, and its 
+            image's size checked against `maxSize`. Tracks that don't fit
+            (partitions should leave room for the images' directories; see
+            `imageOverhead`) are moved to the next disc, adding one if 
+            necessary. Every image is laid out before any is written.
+        
+            @param partitions: A list of lists of tracks, as returned by
+                ``partition()``.
+            @keyword dest: The directory in which to write the images.
+                Defaults to the 'target' specified when constructing the
+                MusicMover object.
+            @keyword maxSize: The size of each disc (MB).
+            @keyword volumeId: The name of the discs. Each is numbered.
+            @keyword workers: The number of images to write at once (see
+                ``discimage.writeImages()``).
+            @return: A list of the images' filenames.
+        """
+        dest = self.target if dest is None else dest
+        capacity = maxSize * 1024 * 1024
+        sources = {}
+        jobs = []
+        overflow = []
+        num = 0
+        while num < len(partitions) or overflow:
+            tracks = overflow + list(partitions[num] if num < len(partitions)
+                                     else ())
+            num += 1
+            if self.transcoder is not None:
+                sources.update(self._transcodeTracks([t for t in tracks 
+                    if id(t) not in sources])[1])
+            if self.canceled:
+                return []
+            with self._phase('image'):
+                image, overflow = self._layoutImage("%s_%02d" % (volumeId, 
+                    num), tracks, sources, dest, capacity)
+            jobs.append((image, os.path.join(dest, image.volumeId + ".iso")))
+        
+        written = []
+        with self._phase('image'):
+            self._notify('copyStarted', len(jobs), 
+                         sum(image.getSize() for image, f in jobs))
+            results = discimage.writeImages(jobs, workers, 
+                                            lambda: self.canceled)
+            for filename, size, elapsed in results:
+                self._notify('fileCopied', filename, size, elapsed)
+                written.append(filename)
+        return written
+
+
+    def _layoutImage(self, volumeId, tracks, sources, dest, capacity):
+        """ Lay out a disc image of a set of tracks, leaving out as many of
+            the last tracks as necessary to make it fit. See 
+            ``writeDiscImages()``. Tracks that would have the same name in
+            the image (e.g. different tracks with the same title) are told
+            apart by a number, as in "Track 2.mp3".
+            
+            @param volumeId: The name of the image's volume.
+            @param tracks: A list of tracks.
+            @param sources: A dictionary of (<URL of transcoded file>, 
+                <size>) tuples, keyed by the ``id()`` of each transcoded
+                track.
+            @param dest: The directory in which the image will be written.
+            @param capacity: The maximum size of the image, in bytes.
+            @return: The `discimage.DiscImage`, and a list of the tracks
+                that didn't fit.
+        """
+        prefix = os.path.join(os.path.abspath(dest), '')
+        entries = []
+        names = set()
+        for track in tracks:
+            if id(track) in sources:
+                source = sources[id(track)][0]
+            elif self.transcoder is not None and \
+                    self.transcoder.handles(track):
+                # Not transcoded (canceled)
+                continue
+            else:
+                source = track['Location']
+            name = self._makeTargetName(track, dest)
+            if self.transcoder is not None and self.transcoder.handles(track):
+                name = self.transcoder.getTargetName(name)
+            if name.startswith(prefix):
+                name = name[len(prefix):]
+            else:
+                name = os.path.relpath(name, dest)
+            base, ext = os.path.splitext(name)
+            n = 1
+            while name in names:
+                n += 1
+                name = "%s %d%s" % (base, n, ext)
+            names.add(name)
+            source = self._getSourceFile(source)
+            entries.append((name, source, os.stat(source), track))
+        
+        def layout(count):
+            image = discimage.DiscImage(volumeId)
+            for name, source, st, track in entries[:count]:
+                if not image.addFile(name, source, st.st_size, st.st_mtime):
+                    raise discimage.DiscImageError(
+                        "%s has more than one file named %r" % \
+                        (volumeId, name))
+            return image
+        
+        image = layout(len(entries))
+        if image.getSize() <= capacity:
+            return image, []
+        
+        # The directories take space too, so find the most tracks that fit
+        # by laying out images of the first `count` tracks.
+        fits, low, high = None, 1, len(entries) - 1
+        while low <= high:
+            count = (low + high) // 2
+            image = layout(count)
+            if image.getSize() <= capacity:
+                fits = image, count
+                low = count + 1
+            else:
+                high = count - 1
+        if fits is None:
+            raise discimage.DiscImageError(
+                "%s needs %d bytes for one track, more than the %d allowed" \
+                % (volumeId, layout(1).getSize(), capacity))
+        image, count = fits
+        return image, [track for name, source, st, track in entries[count:]]
+
+
+    def copyTracks(self, tracks, dest=None, ledger=None, idle=None):
         """ Copy a set of tracks. Does not do any special handling, such as 
             checking free space, et cetera; standard exceptions will be raised
             if there's a problem along those lines.
@@ -481,21 +3669,98 @@ class MusicMover(object):
             @param tracks: A list of Track objects.
             @keyword dest: The destination path. Defaults to the 'target'
                 specified when constructing the MusicMover object.
+            @keyword ledger: A `SpaceLedger` for the destination. If 
+                supplied, each copy waits until there is room for it; tracks
+                that never fit are skipped. See ``_copyFiles()``.
+            @keyword idle: An iterator to advance while copies are running
+                or waiting for space. See ``_copyFiles()``.
         """
         dest = self.target if dest is None else dest
-        totalFiles = len(tracks)
-        c = 1
+        self.getBackend(dest)
         self.preCopyTracks()
+        if self.resume:
+            self._writePending(tracks, dest)
+        sources = {}
+        if self.transcoder is not None:
+            tracks, sources = self._transcodeTracks(tracks)
+        totalFiles = len(tracks)
+        jobs = []
+        sizes = []
         for track in tracks:
-            if self.canceled:
-                break
-            dupe = self.targetName(track, dest)
-            self.copyFile(track['Location'], dupe)
-            self.copyCallback(c, totalFiles, track, dupe)
-            c+=1
+            source, size = sources.get(id(track), (track['Location'], None))
+            if size is None:
+                size = max(track.get('Size', 0), 0)
+            jobs.append((source, self.targetName(track, dest), track))
+            sizes.append(size)
+        self._copyJobs(jobs, sizes, dest, ledger, idle)
+        if self.resume and not self.canceled:
+            os.remove(self._getPendingFile(dest))
         self.postCopyTracks()
 
 
+    def _copyJobs(self, jobs, sizes, dest, ledger=None, idle=None):
+        """ Copy tracks to a target, keeping its manifest and history (if
+            any) up to date and notifying the observers and 
+            ``copyCallback()``. See ``copyTracks()``.
+            
+            @param jobs: A list of (<source URL>, <destination>, <track>)
+                tuples.
+            @param sizes: The size of each file to be copied.
+            @param dest: The destination path.
+        """
+        totalFiles = len(jobs)
+        dirs = set(os.path.dirname(dupe) for source, dupe, track in jobs)
+        if ledger is not None:
+            # Roughly one block for each new directory
+            backend = self.getBackend(dest)
+            ledger.take(ledger.blockSize * 
+                        sum(1 for d in dirs if not backend.exists(d)))
+        self.makeDirs(dirs)
+        manifest = self.getManifest(dest) if self.useManifest else None
+        history = self.getHistory(dest) if self.useHistory else None
+        self._notify('copyStarted', totalFiles, sum(sizes))
+        try:
+            with self._phase('copy'):
+                copies = self._copyFiles(jobs, ledger, sizes, idle)
+                for c, (track, dupe, elapsed, size) in enumerate(copies, 1):
+                    if manifest is not None:
+                        manifest.add(dupe, size, track.get('Track ID'))
+                    if history is not None:
+                        history.recordCopy(dupe, track.get('Track ID'))
+                    self._notify('fileCopied', dupe, size, elapsed)
+                    self.copyCallback(c, totalFiles, track, dupe)
+        finally:
+            if manifest is not None:
+                manifest.save()
+            if history is not None:
+                history.commit()
+
+
+    def _transcodeTracks(self, tracks):
+        """ Transcode the tracks the `transcoder` handles (see
+            ``copyTracks()``). If canceled, tracks that haven't been 
+            transcoded yet are dropped.
+            
+            @param tracks: A list of tracks.
+            @return: A list of the tracks to copy, and a dictionary of 
+                (<URL of transcoded file>, <size>) tuples, keyed by the
+                ``id()`` of each transcoded track.
+        """
+        toTranscode = [t for t in tracks if self.transcoder.handles(t)]
+        sources = {}
+        if not toTranscode:
+            return tracks, sources
+        with self._phase('transcode'):
+            results = self.transcoder.transcode(toTranscode, 
+                                                lambda: self.canceled)
+            for track, url in results:
+                sources[id(track)] = (url, 
+                    os.path.getsize(url2pathname(urlparse(url).path)))
+        tracks = [t for t in tracks 
+                  if id(t) in sources or not self.transcoder.handles(t)]
+        return tracks, sources
+
+
 #===============================================================================
 # 
 #===============================================================================
@@ -512,27 +3777,152 @@ if __name__ == "__main__":
         default="~/Music/iTunes/iTunes Music Library.xml")
     parser.add_argument("--gui", "-g", action="store_true",
         help="Use the GUI version.")
+    parser.add_argument("--streaming", "-s", action="store_true",
+        help="Load the library incrementally, keeping only the track data "\
+            "required for copying. Faster and smaller for large libraries.")
+    parser.add_argument("--cache", "-c", nargs="?", const=True, default=None,
+        help="Keep a snapshot of the parsed library, used until the XML "\
+            "changes. Optionally takes the directory in which to keep it; "\
+            "by default, it is kept next to the library XML.")
     parser.add_argument("--minfree", "-f", type=int, default=None,
         help="The minimum amount of space (MB) to leave on the target device.")
     parser.add_argument("--maxsize", "-m", type=int, default=None,
         help="The maximum size (in MB) of the target's music directory.")
+    parser.add_argument("--manifest", "-M", action="store_true",
+        help="Keep a manifest of the target's music files on the target, "\
+            "to avoid re-reading all of its directories every run.")
+    parser.add_argument("--history", "-H", nargs="?", const=True, 
+        default=False,
+        help="Keep a history of the music copied to and removed from the "\
+            "target, and avoid restoring recently removed music. Optionally"\
+            " takes the name of the history database; by default, it is "\
+            "kept on the target.")
+    parser.add_argument("--workers", "-w", type=int, 
+        default=MusicMover.copyWorkers,
+        help="The number of files to copy simultaneously.")
     parser.add_argument("--playlist", "-p", default="Music",
         help="The name of the iTunes playlist from which to copy.")
     parser.add_argument("--percent", "-t", type=int, default=33,
         help="The percentage of music to 'freshen' (delete and replace on " \
             "the device).")
-    parser.add_argument("target", 
+    parser.add_argument("--fill", action="store_true",
+        help="Pack new music to use as much of the available space as "\
+            "possible, rather than stopping at the first track that "\
+            "doesn't fit.")
+    parser.add_argument("--library-only", "-L", action="store_true",
+        dest="libraryOnly",
+        help="Only remove music copied from the iTunes library, leaving "\
+            "anything put on the target by other means.")
+    parser.add_argument("--overlap", "-o", action="store_true",
+        help="Start copying new music while old music is still being "\
+            "deleted, as space becomes available.")
+    parser.add_argument("--resume", "-r", action="store_true",
+        help="Copy resumably: skip files already on the target, and finish "\
+            "an interrupted copy before doing anything else.")
+    parser.add_argument("--weights", metavar="SPEC",
+        help="Favor some tracks when adding music, and the others when "\
+            "removing it: a comma-separated list of 'rating', 'plays' and "\
+            "'added' (recently), each optionally with a strength, e.g. "\
+            "'rating=2,plays'.")
+    parser.add_argument("--transcode", metavar="BITRATE", type=int, 
+        nargs="?", const=256, default=None,
+        help="Convert lossless (AIFF and WAV) tracks to AAC as they are "\
+            "copied, optionally at the given bitrate (kbps; default 256).")
+    parser.add_argument("--update", "-u", action="store_true",
+        help="Don't freshen; only update the music on the target affected "\
+            "by changes to the library since it was last loaded (renaming, "\
+            "removing or recopying files). Requires --cache.")
+    parser.add_argument("--plan", metavar="FILENAME",
+        help="Don't change the target; work out what freshening it would "\
+            "do, save the plan to a file, and print a summary.")
+    parser.add_argument("--execute", metavar="FILENAME",
+        help="Carry out a plan saved by --plan, instead of freshening.")
+    parser.add_argument("--images", "-i", action="store_true",
+        help="Write the playlist to ISO 9660 disc images in the target "\
+            "directory, split to fit discs of --maxsize MB (default 4300), "\
+            "instead of freshening.")
+    parser.add_argument("--seed", type=int, default=None,
+        help="A seed for the random choice of music, to make runs "\
+            "repeatable.")
+    parser.add_argument("--stats", metavar="FILENAME",
+        help="Write timings, throughput and progress to a file, as lines "\
+            "of JSON. Use '-' for standard output.")
+    parser.add_argument("target", nargs="+",
         help="The target root directory (e.g. /Volumes/PHONE/Music). "\
-            "This directory must exist.")
+            "This directory must exist. If several are given, they are all "\
+            "freshened at once, and each source file is read only once.")
     
     args = parser.parse_args()
+    if (args.plan or args.execute or args.images) and len(args.target) > 1:
+        parser.error("--plan, --execute and --images take only one target")
+    if args.overlap and len(args.target) > 1:
+        parser.error("--overlap takes only one target")
    
     MM = MusicMover
     if args.gui:
         MM = TkMusicMover
     
-    mover = MM(libraryFile=args.library, target=args.target)
+    weights = None
+    if args.weights:
+        weights = sampling.TrackWeights.fromString(args.weights)
+    
+    transcoder = None
+    if args.transcode:
+        from transcode import Transcoder
+        transcoder = Transcoder(bitrate=args.transcode)
+    
+    observers = []
+    statsFile = None
+    if args.stats:
+        from instrumentation import JsonLogger
+        statsFile = sys.stdout if args.stats == '-' else open(args.stats, 'w')
+        observers.append(JsonLogger(statsFile))
+    
+    mover = MM(libraryFile=args.library, target=args.target[0],
+               streaming=args.streaming, cache=args.cache,
+               manifest=args.manifest, history=args.history,
+               resume=args.resume, observers=observers,
+               weights=weights, seed=args.seed, transcoder=transcoder)
+    mover.copyWorkers = args.workers
+    
+    if args.images:
+        discSize = args.maxsize or 4300
+        parts = mover.partition(playlist=args.playlist, 
+                                maxSize=discSize - mover.imageOverhead)
+        for filename in mover.writeDiscImages(parts, maxSize=discSize):
+            print "%s (%.1f MB)" % (filename, 
+                                    os.path.getsize(filename) / 1048576.0)
+    elif args.plan:
+        plan = mover.planFreshen(playlist=args.playlist, 
+                                 percent=args.percent, minFree=args.minfree,
+                                 maxSize=args.maxsize, fill=args.fill,
+                                 libraryOnly=args.libraryOnly)
+        plan.save(args.plan)
+        summary = plan.getSummary()
+        print "delete %d files (%.1f MB), copy %d files (%.1f MB)" % \
+            (summary['deletes'], summary['deleteBytes'] / 1048576.0,
+             summary['copies'], summary['copyBytes'] / 1048576.0)
+        print "free space: %.1f MB before, %.1f MB after" % \
+            (summary['freeBefore'] / 1048576.0, 
+             summary['freeAfter'] / 1048576.0)
+    elif args.execute:
+        mover.executePlan(SyncPlan.load(args.execute), args.target[0])
+    elif args.update:
+        for target in args.target:
+            mover.updateMusic(target)
+    elif len(args.target) > 1:
+        mover.freshenDevices(args.target, playlist=args.playlist,
+                             percent=args.percent, minFree=args.minfree,
+                             maxSize=args.maxsize, fill=args.fill,
+                             libraryOnly=args.libraryOnly)
+    else:
+        mover.freshenMusic(playlist=args.playlist, percent=args.percent,
+                           minFree=args.minfree, maxSize=args.maxsize,
+                           fill=args.fill, overlap=args.overlap,
+                           libraryOnly=args.libraryOnly)
     
-    mover.freshenMusic(playlist=args.playlist, percent=args.percent,
-                       minFree=args.minfree, maxSize=args.maxsize)
+    for observer in observers:
+        observer.writeSummary()
+    if statsFile is not None and statsFile is not sys.stdout:
+        statsFile.close()
     
@@ -0,0 +1,248 @@
+"""
+Bin packing algorithms, used by ``MusicMover.partition()`` to split a set of
+tracks into as few discs as possible.
+
+Each function takes a list of item sizes and the capacity of a bin, and
+returns a list of bins, each a list of indices into the list of sizes. An
+item fits in a bin if the bin's total, including the item, doesn't exceed
+the capacity. Items larger than the capacity raise a `ValueError`.
+"""
+
+import time
+from bisect import bisect_left, insort
+
+#===============================================================================
+#
+#===============================================================================
+
+def _checkSizes(sizes, capacity):
+    """ Make sure no item is too big to fit into an empty bin.
+    """
+    for s in sizes:
+        if s > capacity:
+            raise ValueError("Item is larger than the bin capacity: %s" % s)
+
+
+def _decreasing(sizes):
+    """ Get the indices of items, largest first.
+    """
+    return sorted(xrange(len(sizes)), key=sizes.__getitem__, reverse=True)
+
+
+def lowerBound(sizes, capacity):
+    """ Get the minimum possible number of bins: the total size divided by
+        the capacity, rounded up.
+    """
+    total = sum(sizes)
+    return total // capacity + (1 if total % capacity else 0)
+
+
+def nextFit(sizes, capacity):
+    """ Fill one bin at a time, in the original order, starting a new bin
+        whenever an item doesn't fit in the current one. Fast, and keeps
+        items in order, but wasteful.
+    """
+    _checkSizes(sizes, capacity)
+    bins = []
+    current = None
+    total = 0
+    for i, s in enumerate(sizes):
+        if current is None or total + s > capacity:
+            current = []
+            bins.append(current)
+            total = 0
+        current.append(i)
+        total += s
+    return bins
+
+
+class FreeSpaceTree(object):
+    """ A segment tree holding the free space of a fixed number of bins,
+        for finding the first bin with room for an item in O(log n) time.
+        Bins that haven't been used yet simply have all their space free.
+    """
+
+    def __init__(self, numBins, capacity):
+        size = 1
+        while size < numBins:
+            size *= 2
+        self.size = size
+        self.tree = [0] * (2 * size)
+        for i in xrange(numBins):
+            self.tree[size + i] = capacity
+        for i in xrange(size - 1, 0, -1):
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+
+
+    def firstFit(self, itemSize):
+        """ Get the index of the first bin with at least `itemSize` free, or
+            -1 if there isn't one.
+        """
+        tree = self.tree
+        if tree[1] < itemSize:
+            return -1
+        i = 1
+        while i < self.size:
+            i *= 2
+            if tree[i] < itemSize:
+                i += 1
+        return i - self.size
+
+
+    def take(self, binIndex, itemSize):
+        """ Remove `itemSize` from a bin's free space.
+        """
+        tree = self.tree
+        i = binIndex + self.size
+        tree[i] -= itemSize
+        i //= 2
+        while i:
+            tree[i] = max(tree[2 * i], tree[2 * i + 1])
+            i //= 2
+
+
+def firstFitDecreasing(sizes, capacity):
+    """ Place items largest first, each in the first bin with room for it.
+        Uses at most 11/9 of the optimal number of bins (plus one).
+    """
+    _checkSizes(sizes, capacity)
+    tree = FreeSpaceTree(len(sizes), capacity)
+    bins = []
+    for i in _decreasing(sizes):
+        b = tree.firstFit(sizes[i])
+        tree.take(b, sizes[i])
+        if b == len(bins):
+            bins.append([])
+        bins[b].append(i)
+    return bins
+
+
+def bestFitDecreasing(sizes, capacity):
+    """ Place items largest first, each in the bin it fills most (the one
+        with the least free space that still has room). The bins' free
+        space is kept in a sorted list, searched by bisection.
+    """
+    _checkSizes(sizes, capacity)
+    free = []
+    bins = []
+    for i in _decreasing(sizes):
+        s = sizes[i]
+        idx = bisect_left(free, (s, -1))
+        if idx == len(free):
+            b = len(bins)
+            bins.append([])
+            space = capacity
+        else:
+            space, b = free.pop(idx)
+        bins[b].append(i)
+        if space - s > 0:
+            insort(free, (space - s, b))
+    return bins
+
+
+class _OutOfTime(Exception):
+    pass
+
+
+def branchAndBound(sizes, capacity, timeLimit=10.0):
+    """ Search for an optimal packing, starting from the best of first-fit
+        and best-fit decreasing. Items are placed largest first; bins with
+        the same free space are treated as interchangeable, and a branch is
+        abandoned once it can't beat the best packing found so far. If the
+        time limit is reached, the best packing found so far is returned.
+        The search recurses once per item, so for more items than the 
+        recursion limit allows, the heuristic packing is returned.
+
+        @param sizes: A list of item sizes.
+        @param capacity: The size of each bin.
+        @keyword timeLimit: The maximum time to spend searching (seconds).
+    """
+    best = min(firstFitDecreasing(sizes, capacity),
+               bestFitDecreasing(sizes, capacity), key=len)
+    bound = lowerBound(sizes, capacity)
+    if len(best) <= bound:
+        return best
+
+    order = _decreasing(sizes)
+    ordered = [sizes[i] for i in order]
+    # The total size of all items after each position
+    remaining = [0] * (len(ordered) + 1)
+    for n in xrange(len(ordered) - 1, -1, -1):
+        remaining[n] = remaining[n + 1] + ordered[n]
+
+    deadline = time.time() + timeLimit
+    assignment = [0] * len(ordered)
+    free = []
+    state = {'best': best, 'nodes': 0}
+
+    def search(n):
+        state['nodes'] += 1
+        if state['nodes'] % 4096 == 0 and time.time() > deadline:
+            raise _OutOfTime
+        if n == len(ordered):
+            bins = [[] for _ in free]
+            for k, b in enumerate(assignment):
+                bins[b].append(order[k])
+            state['best'] = bins
+            return len(bins) <= bound
+        # Items still to place, less the space available in the open bins.
+        needed = remaining[n] - sum(free)
+        newBins = 0
+        if needed > 0:
+            newBins = needed // capacity + (1 if needed % capacity else 0)
+        if len(free) + newBins >= len(state['best']):
+            return False
+        s = ordered[n]
+        tried = set()
+        for b in xrange(len(free)):
+            if free[b] >= s and free[b] not in tried:
+                tried.add(free[b])
+                free[b] -= s
+                assignment[n] = b
+                found = search(n + 1)
+                free[b] += s
+                if found:
+                    return True
+        if len(free) + 1 < len(state['best']):
+            free.append(capacity - s)
+            assignment[n] = len(free) - 1
+            found = search(n + 1)
+            free.pop()
+            if found:
+                return True
+        return False
+
+    try:
+        search(0)
+    except (_OutOfTime, RuntimeError):
+        # Out of time, or the item list was too long to recurse through.
+        pass
+    return state['best']
+
+
+#===============================================================================
+#
+#===============================================================================
+
+STRATEGIES = {
+    'nextfit': nextFit,
+    'ffd': firstFitDecreasing,
+    'bfd': bestFitDecreasing,
+    'exact': branchAndBound,
+}
+
+
+def pack(sizes, capacity, strategy='ffd', **kwargs):
+    """ Pack items into bins using a named strategy.
+
+        @param sizes: A list of item sizes.
+        @param capacity: The size of each bin.
+        @keyword strategy: One of 'nextfit', 'ffd' (first-fit decreasing),
+            'bfd' (best-fit decreasing) or 'exact' (branch and bound).
+        @return: A list of bins, each a list of indices into `sizes`.
+    """
+    try:
+        packer = STRATEGIES[strategy]
+    except KeyError:
+        raise ValueError("Unknown packing strategy: %r" % strategy)
+    return packer(sizes, capacity, **kwargs)
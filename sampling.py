@@ -0,0 +1,192 @@
+"""
+Random sampling, used by `MusicMover` to choose the tracks to add to a
+device and the files to remove from it.
+
+Sampling may be weighted, so some items are more likely to be chosen than
+others, and is always without replacement. Nothing here shuffles an entire
+list. ``randomOrder()`` and ``weightedOrder()`` produce items one at a time,
+doing only as much work as the items actually taken. ``sample()`` makes a
+single pass over its input and keeps only the items chosen.
+
+Every function takes a `rand` argument, a `random.Random` (or the `random`
+module itself); give it a seeded one for repeatable results.
+"""
+
+import heapq
+import math
+import random
+import time
+from datetime import datetime
+from itertools import islice
+
+#===============================================================================
+#
+#===============================================================================
+
+def _key(u, weight):
+    """ The Efraimidis-Spirakis sort key for an item: the items with the
+        largest keys form a weighted sample without replacement. Uses
+        ``log(u) / weight`` rather than ``u ** (1 / weight)`` to avoid
+        underflow. Items with no weight get the lowest possible key.
+    """
+    if weight <= 0:
+        return float('-inf')
+    return math.log(u or 1e-300) / weight
+
+
+def randomOrder(items, rand=random):
+    """ Produce items in a uniformly random order, shuffling only as far as
+        the items actually taken (an incremental Fisher-Yates shuffle).
+
+        @param items: A sequence of items. It is copied, not changed.
+        @keyword rand: The source of random numbers.
+        @return: A generator of items.
+    """
+    items = list(items)
+    randrange = rand.randrange
+    n = len(items)
+    for i in xrange(n):
+        j = randrange(i, n)
+        items[i], items[j] = items[j], items[i]
+        yield items[i]
+
+
+def weightedOrder(items, weights, rand=random):
+    """ Produce items in a weighted random order: each item is taken with a
+        probability proportional to its weight among the items not yet
+        taken. Items with no weight come last, in random order. The keys
+        are put into a heap, so taking `k` of `n` items costs
+        O(n + k log n).
+
+        @param items: A sequence of items.
+        @param weights: The weight of each item (non-negative numbers).
+        @keyword rand: The source of random numbers.
+        @return: A generator of items.
+    """
+    r = rand.random
+    heap = [(-_key(r(), w), r(), i) for i, w in enumerate(weights)]
+    heapq.heapify(heap)
+    while heap:
+        yield items[heapq.heappop(heap)[2]]
+
+
+def sample(items, k, weights=None, rand=random):
+    """ Choose `k` items without replacement in a single pass over an
+        iterable, keeping only the chosen items in memory ("reservoir
+        sampling"). Uniform samples use Li's Algorithm L, which skips over
+        runs of items without generating random numbers for them; weighted
+        samples use Efraimidis and Spirakis's Algorithm A-Res.
+
+        @param items: An iterable of items.
+        @param k: The number of items to choose.
+        @keyword weights: A function returning an item's weight. Defaults
+            to equal weights.
+        @keyword rand: The source of random numbers.
+        @return: A list of up to `k` items, in no particular order.
+    """
+    if k <= 0:
+        return []
+    items = iter(items)
+    r = rand.random
+
+    if weights is not None:
+        heap = []
+        for item in items:
+            key = (_key(r(), weights(item)), r())
+            if len(heap) < k:
+                heapq.heappush(heap, (key, item))
+            elif key > heap[0][0]:
+                heapq.heapreplace(heap, (key, item))
+        return [item for key, item in heap]
+
+    reservoir = list(islice(items, k))
+    if len(reservoir) < k:
+        return reservoir
+    w = math.exp(math.log(r() or 1e-300) / k)
+    while w < 1:
+        skip = int(math.log(r() or 1e-300) / math.log(1 - w))
+        for item in islice(items, skip, skip + 1):
+            reservoir[rand.randrange(k)] = item
+            break
+        else:
+            break
+        w *= math.exp(math.log(r() or 1e-300) / k)
+    return reservoir
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class TrackWeights(object):
+    """ A weight function for tracks, favoring those that are highly rated,
+        often played, or recently added. A track's weight is the product of
+        one factor for each::
+
+            (1 + rating * Rating / 100)
+            * (1 + plays * log(1 + Play Count))
+            * (1 + added * 0.5 ** (days since Date Added / halfLife))
+
+        so a strength of 0 ignores that field, and a track without any of
+        them has a weight of 1.
+
+        @cvar fields: The track fields used. Include them when loading a
+            library in streaming mode (see `iTunesLibrary`).
+    """
+
+    fields = ('Rating', 'Play Count', 'Date Added')
+
+    def __init__(self, rating=0, plays=0, added=0, halfLife=365, now=None):
+        """ Constructor.
+            @keyword rating: How strongly to favor highly rated tracks.
+            @keyword plays: How strongly to favor often-played tracks.
+            @keyword added: How strongly to favor recently added tracks.
+            @keyword halfLife: The age (in days) at which a track's
+                'recently added' bonus is halved.
+            @keyword now: The current time, as a `datetime` (UTC). Defaults
+                to the time the object was created.
+        """
+        self.rating = rating
+        self.plays = plays
+        self.added = added
+        self.halfLife = halfLife
+        self.now = datetime.utcfromtimestamp(time.time()) if now is None \
+            else now
+
+
+    def __repr__(self):
+        return "%s(rating=%r, plays=%r, added=%r, halfLife=%r)" % \
+            (self.__class__.__name__, self.rating, self.plays, self.added,
+             self.halfLife)
+
+
+    def __call__(self, track):
+        """ Get a track's weight.
+        """
+        weight = 1.0
+        if self.rating:
+            weight *= 1 + self.rating * track.get('Rating', 0) / 100.0
+        if self.plays:
+            weight *= 1 + self.plays * math.log1p(track.get('Play Count', 0))
+        if self.added:
+            added = track.get('Date Added')
+            if added is not None:
+                age = self.now - added
+                days = max(age.days + age.seconds / 86400.0, 0)
+                weight *= 1 + self.added * 0.5 ** (days / self.halfLife)
+        return weight
+
+
+    @classmethod
+    def fromString(cls, spec):
+        """ Create weights from a string like "rating=1,plays=0.5", as
+            given on the command line.
+        """
+        kwargs = {}
+        for part in spec.split(','):
+            name, _, value = part.partition('=')
+            name = name.strip()
+            if name not in ('rating', 'plays', 'added', 'halfLife'):
+                raise ValueError("Unknown weight: %r" % name)
+            kwargs[name] = float(value) if value else 1.0
+        return cls(**kwargs)
@@ -0,0 +1,663 @@
+"""
+Target backends: the operations `MusicMover` performs on a target device.
+A device that isn't a locally mounted filesystem (e.g. a phone connected by
+MTP, or storage reached over SSH) can be supported by writing a backend,
+rather than by replacing `MusicMover` methods one at a time.
+
+Operations work on many files at once. Listing gets every file along with
+its size. Directories are created, and files deleted and written, in
+batches of up to `TargetBackend.batchSize`, so a device on which every
+request has a long round trip pays for it once per batch rather than once
+per file. `MusicMover` runs several batches at once (see
+`MusicMover.copyWorkers`), so requests are also pipelined.
+
+Files can also be written a block at a time, as the data arrives (see
+``TargetBackend.openFile()``), e.g. when one source file is read once and
+written to several targets.
+
+Two backends are included: `LocalBackend`, for a directory on a mounted
+filesystem (the default), and `SimulatedBackend`, a `LocalBackend` with
+simulated request latency, bandwidth and capacity, for testing.
+
+A few things are still read and written directly, so need a backend whose
+`root` is a local path:
+
+  - A target's metadata: its `DeviceManifest`, `CopyHistory`, and the list
+    of tracks pending when copying resumably.
+  - Resumable copies (``MusicMover.copyFile()`` in resume mode), which
+    append to and rename a partial file in place.
+  - Comparing a file on the target with its source by content, which
+    ``MusicMover.isSameFile()`` does when their modification times differ.
+"""
+
+import os
+import Queue
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+from itertools import islice
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
+
+#===============================================================================
+#
+#===============================================================================
+
+def _batches(items, size):
+    """ Split an iterable into lists of up to `size` items. Items are only
+        taken from the iterable as each batch is needed.
+    """
+    items = iter(items)
+    while True:
+        batch = list(islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class FileWriter(object):
+    """ A file being written to a target a block at a time (see
+        ``TargetBackend.openFile()``). This one collects the data in a local
+        temporary file, which is handed to the backend's ``putFiles()`` 
+        once complete, so it works with any backend.
+
+        @ivar dest: The file's name on the target.
+    """
+
+    def __init__(self, backend, dest):
+        """ Constructor.
+            @param backend: The `TargetBackend` to which the file is 
+                written.
+            @param dest: The file's name on the target.
+        """
+        self.backend = backend
+        self.dest = dest
+        fd, self.temp = tempfile.mkstemp(suffix=os.path.splitext(dest)[1])
+        self.file = os.fdopen(fd, 'wb')
+
+
+    def write(self, data):
+        """ Write the next block of the file.
+        """
+        self.file.write(data)
+
+
+    def close(self, source=None):
+        """ Finish writing the file, which only then appears on the target
+            under its real name.
+
+            @keyword source: A file whose modification time the new file
+                gets, if any.
+            @return: The size of the file written.
+        """
+        self.file.close()
+        try:
+            if source is not None:
+                shutil.copystat(source, self.temp)
+            for dest, size in self.backend.putFiles([(self.temp, self.dest)]):
+                pass
+        finally:
+            os.remove(self.temp)
+        return size
+
+
+    def discard(self):
+        """ Abandon an incomplete file.
+        """
+        self.file.close()
+        if os.path.exists(self.temp):
+            os.remove(self.temp)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class TargetBackend(object):
+    """ The interface to a target device. Filenames are full paths within
+        `root`, like those built by ``MusicMover.targetName()``. Methods
+        that take several files accept any iterable; the files are taken
+        from it a batch at a time.
+
+        Subclasses must implement ``getStats()``, ``listDir()``,
+        ``stat()``, ``getSize()``, ``rename()``, ``_makeDirs()``, 
+        ``_deleteBatch()`` and ``_putBatch()``. The other methods are built on those, and can
+        be replaced by versions using a device's own bulk operations.
+
+        @cvar batchSize: The maximum number of files per request.
+        @ivar root: The root directory of the target.
+    """
+
+    batchSize = 64
+
+    def __init__(self, root):
+        """ Constructor.
+            @param root: The root directory of the target.
+        """
+        self.root = os.path.abspath(root)
+
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.root)
+
+
+    def getStats(self):
+        """ Get the space free on the target and its block size.
+
+            @return: A tuple containing (<bytes free>, <block size>)
+        """
+        raise NotImplementedError
+
+
+    def listDir(self, path, filterFunc=None):
+        """ Read one directory.
+
+            @param path: The full path of the directory.
+            @keyword filterFunc: A function that determines, from its name,
+                whether a file is included. Defaults to all files.
+            @return: A tuple containing ([<subdirectory>, ...],
+                [(<filename>, <size>), ...])
+        """
+        raise NotImplementedError
+
+
+    def stat(self, filename):
+        """ Get information about a file or directory, like ``os.stat()``.
+
+            @return: An object with (at least) `st_mode`, `st_size` and
+                `st_mtime` attributes.
+            @raise OSError: If the file doesn't exist.
+        """
+        raise NotImplementedError
+
+
+    def exists(self, filename):
+        """ Determine if a file or directory exists.
+        """
+        try:
+            self.stat(filename)
+        except OSError:
+            return False
+        return True
+
+
+    def getSize(self, filename):
+        """ Get the size of a file, in bytes.
+        """
+        raise NotImplementedError
+
+
+    def rename(self, source, dest):
+        """ Rename (move) a file. The destination's directory must exist.
+        """
+        raise NotImplementedError
+
+
+    def _makeDirs(self, dirs):
+        """ Create one batch of directories. See ``makeDirs()``.
+        """
+        raise NotImplementedError
+
+
+    def _deleteBatch(self, files):
+        """ Delete one batch of files.
+        """
+        raise NotImplementedError
+
+
+    def _putBatch(self, jobs, bufferSize):
+        """ Write one batch of files. See ``putFiles()``.
+
+            @return: A generator, yielding a tuple of (<destination 
+                filename>, <size written>) as each file is written.
+        """
+        raise NotImplementedError
+
+
+    def listFiles(self, path=None, filterFunc=None, workers=1):
+        """ Recursively list the files in a directory, with their sizes.
+            Directories are read in parallel by a pool of threads, each
+            calling ``listDir()``.
+
+            @keyword path: The full path of the directory. Defaults to the
+                `root`.
+            @keyword filterFunc: A function that determines, from its name,
+                whether a file is included. Defaults to all files.
+            @keyword workers: The number of directories to read at once.
+            @return: A generator of (<filename>, <size>) tuples.
+        """
+        path = self.root if path is None else path
+        if workers <= 1:
+            dirs = [path]
+            while dirs:
+                subdirs, files = self.listDir(dirs.pop(), filterFunc)
+                dirs.extend(subdirs)
+                for f in files:
+                    yield f
+            return
+
+        todo = Queue.Queue()
+        done = Queue.Queue()
+
+        def work():
+            while True:
+                d = todo.get()
+                if d is None:
+                    return
+                try:
+                    done.put((self.listDir(d, filterFunc), None))
+                except Exception:
+                    done.put((None, sys.exc_info()))
+
+        threads = [threading.Thread(target=work) for _ in xrange(workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        todo.put(path)
+        pending = 1
+        try:
+            while pending:
+                result, exc = done.get()
+                pending -= 1
+                if exc is not None:
+                    raise exc[0], exc[1], exc[2]
+                subdirs, files = result
+                for d in subdirs:
+                    todo.put(d)
+                pending += len(subdirs)
+                for f in files:
+                    yield f
+        finally:
+            # Drop directories not yet read (if stopping early).
+            try:
+                while True:
+                    todo.get_nowait()
+            except Queue.Empty:
+                pass
+            for t in threads:
+                todo.put(None)
+            for t in threads:
+                t.join()
+
+
+    def getSizes(self, files, workers=1):
+        """ Get the sizes of several files, using a pool of threads.
+
+            @param files: A list of filenames.
+            @keyword workers: The number of files to size at once.
+            @return: A list of sizes, in the same order as `files`.
+        """
+        workers = min(workers, len(files) / 64 + 1)
+        if workers <= 1:
+            return map(self.getSize, files)
+
+        sizes = [None] * len(files)
+        errors = []
+        def work(start):
+            try:
+                for i in xrange(start, len(files), workers):
+                    sizes[i] = self.getSize(files[i])
+            except Exception:
+                errors.append(sys.exc_info())
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in xrange(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return sizes
+
+
+    def makeDirs(self, dirs):
+        """ Create directories (and any missing parents), if they don't
+            already exist.
+
+            @param dirs: An iterable of full paths.
+        """
+        for batch in _batches(dirs, self.batchSize):
+            self._makeDirs(batch)
+
+
+    def deleteFiles(self, files):
+        """ Delete files, a batch at a time.
+
+            @param files: An iterable of filenames. Each batch is taken from
+                it only once the previous batch has been deleted, so it can
+                be stopped early (e.g. if an operation is canceled).
+            @return: A generator, yielding each filename once deleted.
+        """
+        for batch in _batches(files, self.batchSize):
+            self._deleteBatch(batch)
+            for f in batch:
+                yield f
+
+
+    def putFiles(self, jobs, bufferSize=1048576):
+        """ Write local files to the target, a batch at a time. The
+            destination directories must already exist (see
+            ``makeDirs()``).
+
+            @param jobs: An iterable of (<source filename>, <destination
+                filename>) tuples, taken a batch at a time.
+            @keyword bufferSize: The size of the buffer used when copying.
+            @return: A generator, yielding a tuple of (<destination 
+                filename>, <size written>) as each file is written.
+        """
+        for batch in _batches(jobs, self.batchSize):
+            for result in self._putBatch(batch, bufferSize):
+                yield result
+
+
+    def openFile(self, dest, partial):
+        """ Start writing a file whose data arrives a block at a time. It
+            isn't written as `dest` until it is complete, so an abandoned
+            copy never leaves a truncated file behind. The destination
+            directory must already exist (see ``makeDirs()``).
+
+            @param dest: The file's name on the target.
+            @param partial: A name on the target for the incomplete file,
+                if the backend writes it there as the data arrives.
+            @return: A `FileWriter`.
+        """
+        return FileWriter(self, dest)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class LocalBackend(TargetBackend):
+    """ A target that is a directory on a mounted filesystem. There are no
+        round trips to save, so files are handled one at a time.
+    """
+
+    batchSize = 1
+
+    def getStats(self):
+        s = os.statvfs(self.root)
+        return (s.f_frsize * s.f_bavail, s.f_frsize)
+
+
+    def listDir(self, path, filterFunc=None):
+        """ Read one directory. Uses ``scandir()`` where available, so
+            listing and sizing take one pass. See
+            ``TargetBackend.listDir()``.
+        """
+        dirs = []
+        files = []
+        if scandir is not None:
+            for entry in scandir(path):
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                elif filterFunc is None or filterFunc(entry.name):
+                    files.append((entry.path, entry.stat().st_size))
+            return dirs, files
+
+        for name in os.listdir(path):
+            filename = os.path.join(path, name)
+            st = os.lstat(filename)
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append(filename)
+            elif filterFunc is None or filterFunc(name):
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(filename)
+                files.append((filename, st.st_size))
+        return dirs, files
+
+
+    def stat(self, filename):
+        return os.stat(filename)
+
+
+    def exists(self, filename):
+        return os.path.exists(filename)
+
+
+    def getSize(self, filename):
+        return os.path.getsize(filename)
+
+
+    def rename(self, source, dest):
+        os.rename(source, dest)
+
+
+    def _makeDirs(self, dirs):
+        for d in dirs:
+            if not os.path.isdir(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # Possibly created by another copy thread.
+                    if not os.path.isdir(d):
+                        raise
+
+
+    def _deleteBatch(self, files):
+        for f in files:
+            os.remove(f)
+
+
+    def _putBatch(self, jobs, bufferSize):
+        for source, dest in jobs:
+            yield dest, self._putFile(source, dest, bufferSize)
+
+
+    def _putFile(self, source, dest, bufferSize):
+        """ Copy one file.
+
+            @return: The number of bytes written.
+        """
+        with open(source, 'rb') as fsrc:
+            with open(dest, 'wb') as fdst:
+                shutil.copyfileobj(fsrc, fdst, bufferSize)
+                size = fdst.tell()
+        shutil.copystat(source, dest)
+        return size
+
+
+    def openFile(self, dest, partial):
+        """ Start writing a file, directly to `partial`, which is renamed 
+            once the file is complete. See ``TargetBackend.openFile()``.
+        """
+        return LocalWriter(self, dest, partial)
+
+
+class LocalWriter(FileWriter):
+    """ A file being written to a `LocalBackend` a block at a time, under a
+        temporary name.
+
+        @ivar partial: The name of the incomplete file.
+    """
+
+    def __init__(self, backend, dest, partial):
+        """ Constructor.
+            @param backend: The `LocalBackend` to which the file is written.
+            @param dest: The file's name on the target.
+            @param partial: The name of the incomplete file.
+        """
+        self.backend = backend
+        self.dest = dest
+        self.partial = partial
+        self.file = open(partial, 'wb')
+
+
+    def close(self, source=None):
+        size = self.file.tell()
+        self.file.close()
+        if source is not None:
+            shutil.copystat(source, self.partial)
+        os.rename(self.partial, self.dest)
+        return size
+
+
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.partial):
+            os.remove(self.partial)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class SimulatedBackend(LocalBackend):
+    """ A `LocalBackend` that behaves like a slow device, for testing. Every
+        request (reading a directory, sizing a file, or handling a batch of
+        files) waits `latency` seconds, and files are written at no more
+        than `bandwidth`. Requests made by different threads wait at the
+        same time, as they would on a device that pipelines them.
+
+        It can also simulate a device of a given `capacity`; the space used
+        is then counted from the files written and deleted through the
+        backend.
+
+        @ivar requests: The number of requests made.
+        @ivar filesWritten: The number of files written.
+        @ivar bytesWritten: The total size of the files written.
+        @ivar filesDeleted: The number of files deleted.
+        @ivar used: The space used (bytes), if simulating a `capacity`.
+    """
+
+    batchSize = 64
+
+    def __init__(self, root, latency=0.01, bandwidth=None, capacity=None,
+                 blockSize=32768, used=0):
+        """ Constructor.
+            @param root: The root directory of the target.
+            @keyword latency: The time each request takes (seconds).
+            @keyword bandwidth: The rate at which files are written
+                (bytes/second), or `None` for no limit.
+            @keyword capacity: The size of the simulated device, in bytes,
+                or `None` to report the real filesystem's free space.
+            @keyword blockSize: The simulated device's block size, if
+                simulating a `capacity`.
+            @keyword used: The space already used on the simulated device.
+        """
+        LocalBackend.__init__(self, root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capacity = capacity
+        self.blockSize = blockSize
+        self.used = used
+        self.requests = 0
+        self.filesWritten = 0
+        self.bytesWritten = 0
+        self.filesDeleted = 0
+        self._lock = threading.Lock()
+
+
+    def _request(self):
+        """ Wait for one request's round trip.
+        """
+        with self._lock:
+            self.requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+
+    def _roundUp(self, size):
+        return -(-size // self.blockSize) * self.blockSize
+
+
+    def _getSourceSize(self, source):
+        """ Get the size of a file to be written.
+        """
+        return os.path.getsize(source)
+
+
+    def getStats(self):
+        self._request()
+        if self.capacity is None:
+            return LocalBackend.getStats(self)
+        return (self.capacity - self.used, self.blockSize)
+
+
+    def listDir(self, path, filterFunc=None):
+        self._request()
+        return LocalBackend.listDir(self, path, filterFunc)
+
+
+    def stat(self, filename):
+        self._request()
+        return LocalBackend.stat(self, filename)
+
+
+    def exists(self, filename):
+        self._request()
+        return LocalBackend.exists(self, filename)
+
+
+    def getSize(self, filename):
+        self._request()
+        return LocalBackend.getSize(self, filename)
+
+
+    def rename(self, source, dest):
+        self._request()
+        LocalBackend.rename(self, source, dest)
+
+
+    def _makeDirs(self, dirs):
+        self._request()
+        LocalBackend._makeDirs(self, dirs)
+
+
+    def _deleteBatch(self, files):
+        self._request()
+        freed = sum(self._roundUp(os.path.getsize(f)) for f in files)
+        LocalBackend._deleteBatch(self, files)
+        with self._lock:
+            self.used -= freed
+            self.filesDeleted += len(files)
+
+
+    def _putBatch(self, jobs, bufferSize):
+        self._request()
+        for source, dest in jobs:
+            size = self._getSourceSize(source)
+            if self.bandwidth:
+                time.sleep(size / float(self.bandwidth))
+            size = self._putFile(source, dest, bufferSize)
+            self._written(size)
+            yield dest, size
+
+
+    def _written(self, size):
+        """ Count a file written to the simulated device.
+        """
+        with self._lock:
+            self.used += self._roundUp(size)
+            self.filesWritten += 1
+            self.bytesWritten += size
+
+
+    def openFile(self, dest, partial):
+        return SimulatedWriter(self, dest, partial)
+
+
+class SimulatedWriter(LocalWriter):
+    """ A file being written to a `SimulatedBackend` a block at a time.
+        Finishing it takes one request, and counts as writing the file.
+    """
+
+    def close(self, source=None):
+        self.backend._request()
+        if self.backend.bandwidth:
+            time.sleep(self.file.tell() / float(self.backend.bandwidth))
+        size = LocalWriter.close(self, source)
+        self.backend._written(size)
+        return size
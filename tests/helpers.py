@@ -0,0 +1,90 @@
+"""
+Things shared by the tests: small iTunes libraries whose tracks' files
+really exist, in a temporary directory.
+"""
+
+import os
+import plistlib
+import shutil
+import tempfile
+import unittest
+from urllib import pathname2url
+
+from musicmover import MusicMover
+
+#===============================================================================
+#
+#===============================================================================
+
+def makeLibrary(directory, sizes, ext=".mp3", playlist="Music"):
+    """ Write an iTunes library XML file, and a file for each of its tracks
+        (filled with arbitrary data). Tracks are spread over a few artists
+        and albums.
+
+        @param directory: The directory in which to write the library (as
+            "library.xml") and the tracks' files (in "source").
+        @param sizes: The size of each track's file, in bytes.
+        @keyword ext: The extension of the tracks' files.
+        @keyword playlist: The name of the playlist containing every track.
+        @return: The name of the library XML file.
+    """
+    source = os.path.join(directory, "source")
+    if not os.path.exists(source):
+        os.makedirs(source)
+    tracks = {}
+    for n, size in enumerate(sizes):
+        trackId = n + 1
+        filename = os.path.join(source, "track %d%s" % (trackId, ext))
+        with open(filename, 'wb') as f:
+            f.write((chr(trackId % 256) * size))
+        tracks[str(trackId)] = {'Track ID': trackId,
+                                'Name': "Track %d" % trackId,
+                                'Artist': "Artist %d" % (n % 3),
+                                'Album': "Album %d" % (n % 5),
+                                'Size': size,
+                                'Location': "file://" + pathname2url(filename)}
+    items = [{'Track ID': int(k)} for k in sorted(tracks, key=int)]
+    libraryFile = os.path.join(directory, "library.xml")
+    plistlib.writePlist({'Major Version': 1, 'Minor Version': 1,
+                         'Tracks': tracks,
+                         'Playlists': [{'Name': playlist, 'Playlist ID': 1,
+                                        'Playlist Items': items}]},
+                        libraryFile)
+    return libraryFile
+
+
+class QuietMover(MusicMover):
+    """ A `MusicMover` that doesn't print anything.
+    """
+
+    def copyCallback(self, num, total, orig, dupe):
+        pass
+
+
+    def deleteCallback(self, num, total, filename):
+        pass
+
+
+    def renameCallback(self, num, total, source, dest):
+        pass
+
+
+class TempDirTestCase(unittest.TestCase):
+    """ A test case with a temporary directory, `tempDir`, removed after
+        each test.
+    """
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix="musicmover-test-")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir, True)
+
+
+    def makeDir(self, name):
+        """ Create a directory within `tempDir`.
+        """
+        path = os.path.join(self.tempDir, name)
+        os.makedirs(path)
+        return path
@@ -0,0 +1,64 @@
+"""
+Tests for `discimage`, and ``MusicMover.writeDiscImages()``.
+"""
+
+import os
+import shutil
+import unittest
+from urllib import pathname2url
+
+import discimage
+
+from helpers import makeLibrary, QuietMover, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+class DiscImageTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        library = makeLibrary(self.tempDir, [4096] * 20)
+        self.target = self.makeDir("images")
+        self.mover = QuietMover(libraryFile=library, target=self.target)
+        self.tracks = sorted(self.mover.library.getTracks(),
+                             key=lambda t: t['Track ID'])
+
+
+    def testDuplicateNames(self):
+        # Tracks 1 and 16 share an artist and album; give them files with
+        # the same name, too.
+        other = self.makeDir("other")
+        first, second = self.tracks[0], self.tracks[15]
+        filename = os.path.join(other, "track 1.mp3")
+        shutil.copy(self.mover._getSourceFile(second['Location']), filename)
+        second['Location'] = "file://" + pathname2url(filename)
+
+        image, overflow = self.mover._layoutImage("MUSIC", [first, second],
+                                                  {}, self.target, 2**30)
+        self.assertEqual(overflow, [])
+        sources = dict((f.name, f.source) for f in image.files)
+        self.assertEqual(sorted(sources), [u"track 1 2.mp3", u"track 1.mp3"])
+        self.assertEqual(sources[u"track 1 2.mp3"], filename)
+
+
+    def testAddFileTwice(self):
+        image = discimage.DiscImage("MUSIC")
+        source = self.mover._getSourceFile(self.tracks[0]['Location'])
+        self.assertTrue(image.addFile("a/b.mp3", source))
+        self.assertFalse(image.addFile("a/b.mp3", source))
+        self.assertEqual(len(image.files), 1)
+
+
+    def testWriteDiscImages(self):
+        images = self.mover.writeDiscImages([self.tracks[:10],
+                                             self.tracks[10:]], maxSize=1)
+        self.assertEqual([os.path.basename(f) for f in images],
+                         ["MUSIC_01.iso", "MUSIC_02.iso"])
+        for f in images:
+            self.assertEqual(os.path.getsize(f) % discimage.SECTOR_SIZE, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Tests for ``MusicMover.freshenMusic()``.
+"""
+
+import os
+import unittest
+
+from helpers import makeLibrary, QuietMover, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+class FreshenTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.library = makeLibrary(self.tempDir, [64 * 1024] * 60)
+        self.target = self.makeDir("target")
+
+
+    def getFiles(self):
+        return set(os.path.relpath(f, self.target) for f in 
+                   QuietMover(libraryFile=self.library).getMusicFiles(
+                       self.target))
+
+
+    def freshen(self, **kwargs):
+        """ Freshen the target with a new `QuietMover` (so nothing is 
+            carried over from the last run but what is on the target).
+        """
+        mover = QuietMover(libraryFile=self.library, target=self.target,
+                           history=True)
+        mover.freshenMusic(maxSize=1, minFree=None, **kwargs)
+        return mover
+
+
+    def checkHistory(self, overlap):
+        self.freshen()
+        before = self.getFiles()
+        self.assertTrue(before)
+        mover = self.freshen(percent=50, overlap=overlap)
+        after = self.getFiles()
+        deleted = before - after
+        self.assertTrue(deleted)
+        self.assertTrue(after - before)
+        
+        history = mover.getHistory(self.target)
+        recorded = set(path for path, in history.db.execute(
+            "SELECT path FROM events WHERE action='delete'"))
+        self.assertEqual(recorded, deleted)
+        copied = set(path for path, in history.db.execute(
+            "SELECT path FROM events WHERE action='copy'"))
+        self.assertEqual(copied, before | after)
+
+
+    def testHistory(self):
+        self.checkHistory(overlap=False)
+
+
+    def testOverlappedHistory(self):
+        self.checkHistory(overlap=True)
+
+
+    def testReplacedCopyFile(self):
+        # A replacement that doesn't write anything, as for a dry run
+        mover = QuietMover(libraryFile=self.library, target=self.target)
+        copied = []
+        mover.copyFile = lambda source, dest: copied.append(dest)
+        mover.freshenMusic(maxSize=1, minFree=None)
+        self.assertTrue(copied)
+        self.assertEqual(self.getFiles(), set())
+
+
+if __name__ == "__main__":
+    unittest.main()
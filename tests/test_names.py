@@ -0,0 +1,48 @@
+"""
+Tests for the names given to tracks on a target.
+"""
+
+import os
+import unittest
+
+from musicmover import MusicMover
+
+from helpers import makeLibrary, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+class TargetNameTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.target = self.makeDir("target")
+        self.mover = MusicMover(libraryFile=makeLibrary(self.tempDir, 
+                                                        [1000] * 5))
+
+
+    def testNames(self):
+        track = self.mover.library.getTrackById(1)
+        self.assertEqual(self.mover.targetName(track, self.target),
+                         os.path.join(self.target, "Artist 0", "Album 0",
+                                      "track 1.mp3"))
+
+
+    def testSpellingsOfTarget(self):
+        # The same target, however it is written, is indexed once.
+        spellings = [self.target, self.target + os.sep, 
+                     os.path.join(self.target, os.curdir)]
+        indexes = [self.mover.getLibraryIndex(t) for t in spellings]
+        for index in indexes:
+            self.assertTrue(index is indexes[0])
+        self.assertEqual(len(self.mover.library.extras['libraryIndexes']), 1)
+        
+        track = self.mover.library.getTrackById(2)
+        names = set(self.mover.targetName(track, t) for t in spellings)
+        self.assertEqual(len(names), 1)
+        self.assertEqual(len(self.mover.library.extras['targetNames']), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Tests for `packing`, and ``MusicMover.partition()``.
+"""
+
+import unittest
+
+import packing
+from musicmover import MusicMover
+
+from helpers import makeLibrary, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+class PackingTest(unittest.TestCase):
+
+    def testEveryStrategyFillsBinsExactly(self):
+        for strategy in packing.STRATEGIES:
+            bins = packing.pack([5, 5, 10, 3, 7], 10, strategy)
+            self.assertEqual(sorted(i for b in bins for i in b), range(5),
+                             strategy)
+            self.assertEqual(len(bins), 3, strategy)
+
+
+    def testNoItems(self):
+        for strategy in packing.STRATEGIES:
+            self.assertEqual(packing.pack([], 10, strategy), [], strategy)
+
+
+    def testItemTooBig(self):
+        for strategy in packing.STRATEGIES:
+            self.assertRaises(ValueError, packing.pack, [11], 10, strategy)
+
+
+class PartitionTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        # Four tracks of half a megabyte each
+        library = makeLibrary(self.tempDir, [512 * 1024] * 4)
+        self.mover = MusicMover(libraryFile=library,
+                                target=self.makeDir("target"))
+
+
+    def testFullPartitions(self):
+        for strategy in packing.STRATEGIES:
+            partitions = self.mover.partition(maxSize=1, strategy=strategy)
+            self.assertEqual([len(p) for p in partitions], [2, 2], strategy)
+
+
+    def testNoTracks(self):
+        for strategy in packing.STRATEGIES:
+            partitions = self.mover.partition(maxSize=1, strategy=strategy,
+                                              filterFunc=lambda t: False)
+            self.assertEqual(partitions, [], strategy)
+
+
+if __name__ == "__main__":
+    unittest.main()
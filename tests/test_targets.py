@@ -0,0 +1,141 @@
+"""
+Tests for `targets`, and freshening targets through a backend.
+"""
+
+import os
+import unittest
+from functools import partial
+
+import targets
+
+from helpers import makeLibrary, QuietMover, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+class FileWriterTest(TempDirTestCase):
+
+    def checkWriter(self, openFile):
+        backend = targets.SimulatedBackend(self.tempDir, latency=0,
+                                           capacity=1024 * 1024)
+        dest = os.path.join(self.tempDir, "track.mp3")
+        partial = os.path.join(self.tempDir, ".track.mp3.part")
+        f = openFile(backend, dest, partial)
+        f.write("x" * 1000)
+        self.assertFalse(os.path.exists(dest))
+        self.assertEqual(f.close(), 1000)
+        self.assertEqual(os.path.getsize(dest), 1000)
+        self.assertEqual(os.listdir(self.tempDir), ["track.mp3"])
+        self.assertEqual((backend.filesWritten, backend.used), (1, 32768))
+
+        f = openFile(backend, os.path.join(self.tempDir, "other.mp3"),
+                     partial)
+        f.write("x" * 1000)
+        f.discard()
+        self.assertEqual(os.listdir(self.tempDir), ["track.mp3"])
+        self.assertEqual(backend.filesWritten, 1)
+
+
+    def testWriter(self):
+        # Written through putFiles(), as for any backend
+        self.checkWriter(targets.TargetBackend.openFile)
+
+
+    def testLocalWriter(self):
+        self.checkWriter(targets.SimulatedBackend.openFile)
+
+
+class SimulatedDeviceTest(TempDirTestCase):
+    """ Freshening simulated devices, whose space is counted from what is
+        written and deleted through the backend.
+    """
+
+    capacity = 8 * 1024 * 1024
+    blockSize = 4096
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.library = makeLibrary(self.tempDir, [64 * 1024] * 60)
+        self.targets = [self.makeDir("target%d" % n) for n in range(2)]
+
+
+    def getMover(self, **kwargs):
+        backend = partial(targets.SimulatedBackend, latency=0,
+                          capacity=self.capacity, blockSize=self.blockSize)
+        return QuietMover(libraryFile=self.library, backend=backend,
+                          **kwargs)
+
+
+    def getUsed(self, path):
+        """ Get the space taken by the files actually on a target.
+        """
+        return sum(-(-os.path.getsize(f) // self.blockSize) * self.blockSize
+                   for f in QuietMover(libraryFile=self.library)
+                   .getMusicFiles(path))
+
+
+    def testFreshenMusic(self):
+        dest = self.targets[0]
+        mover = self.getMover(target=dest)
+        mover.freshenMusic(maxSize=1, minFree=None)
+        backend = mover.getBackend(dest)
+        self.assertTrue(backend.filesWritten)
+        self.assertEqual(backend.used, self.getUsed(dest))
+        
+        mover.freshenMusic(percent=50, maxSize=1, minFree=None)
+        self.assertTrue(backend.filesDeleted)
+        self.assertEqual(backend.used, self.getUsed(dest))
+
+
+    def testFreshenDevices(self):
+        mover = self.getMover()
+        finished = []
+        mover.postCopyTracks = lambda: finished.append(True)
+        mover.freshenDevices(self.targets, maxSize=1, minFree=None)
+        self.assertEqual(len(finished), 1)
+        for dest in self.targets:
+            backend = mover.getBackend(dest)
+            self.assertTrue(backend.filesWritten)
+            self.assertEqual(backend.used, self.getUsed(dest))
+            self.assertFalse([f for f in os.listdir(dest)
+                              if f.startswith(".")])
+
+
+class UnknownTargetTest(TempDirTestCase):
+    """ Files outside any target the `MusicMover` knows of are handled as
+        local files.
+    """
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        library = makeLibrary(self.tempDir, [1000] * 2)
+        self.mover = QuietMover(libraryFile=library)
+        self.tracks = list(self.mover.library.getTracks())
+        self.dest = self.makeDir("elsewhere")
+
+
+    def testCopyAndDelete(self):
+        track = self.tracks[0]
+        dupe = os.path.join(self.dest, "sub", "copy.mp3")
+        self.mover.copyFile(track['Location'], dupe)
+        self.assertEqual(os.path.getsize(dupe), 1000)
+        self.assertEqual(self.mover.getMusicSize([dupe], roundUp=False), 
+                         1000)
+        self.mover.deleteFile(dupe)
+        self.assertFalse(os.path.exists(dupe))
+        self.assertEqual(self.mover.backends, {})
+
+
+    def testCopyMusic(self):
+        files = [(t['Location'], os.path.join(self.dest, "%s.mp3" % t['Name']))
+                 for t in self.tracks]
+        self.mover.copyMusic(2000, files)
+        self.assertEqual(self.mover.getMusicSize([f for s, f in files],
+                                                 path=self.dest), 
+                         2 * self.mover.getBlockSize(self.dest))
+        self.assertEqual(self.mover.backends.keys(), [self.dest])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+"""
+Tests for `transcode`, using a stand-in for the encoder that just copies
+its input.
+"""
+
+import os
+import sys
+import unittest
+from urllib import url2pathname
+from urlparse import urlparse
+
+from transcode import Transcoder, TranscodeError
+
+from helpers import makeLibrary, QuietMover, TempDirTestCase
+
+#===============================================================================
+#
+#===============================================================================
+
+COPY = [sys.executable, "-c",
+        "import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])",
+        "{input}", "{output}"]
+
+FAIL = [sys.executable, "-c", "import sys; sys.exit(3)",
+        "{input}", "{output}"]
+
+
+class TranscoderTest(TempDirTestCase):
+
+    def setUp(self):
+        TempDirTestCase.setUp(self)
+        self.library = makeLibrary(self.tempDir, [4096] * 3, ext=".wav")
+        self.mover = QuietMover(libraryFile=self.library)
+        self.tracks = list(self.mover.library.getTracks())
+        self.transcoder = Transcoder(os.path.join(self.tempDir, "cache"),
+                                     command=COPY, workers=2)
+
+
+    def getFile(self, url):
+        return url2pathname(urlparse(url).path)
+
+
+    def testTranscode(self):
+        results = list(self.transcoder.transcode(self.tracks))
+        self.assertEqual(len(results), len(self.tracks))
+        for track, url in results:
+            output = self.getFile(url)
+            self.assertEqual(os.path.splitext(output)[1], ".m4a")
+            self.assertEqual(self.transcoder.getCached(track), output)
+            with open(self.transcoder._getSourceFile(track), 'rb') as f:
+                with open(output, 'rb') as g:
+                    self.assertEqual(f.read(), g.read())
+        self.assertFalse([f for f in os.listdir(self.transcoder.cacheDir)
+                          if f.endswith(".tmp.m4a")])
+
+
+    def testCached(self):
+        track = self.tracks[0]
+        output = self.getFile(list(self.transcoder.transcode([track]))[0][1])
+        with open(output, 'wb') as f:
+            f.write("cached")
+        list(self.transcoder.transcode([track]))
+        with open(output, 'rb') as f:
+            self.assertEqual(f.read(), "cached")
+
+
+    def testSourceChanged(self):
+        source = self.transcoder._getSourceFile(self.tracks[0])
+        before = self.transcoder.getCacheName(source)
+        st = os.stat(source)
+        os.utime(source, (st.st_atime, st.st_mtime + 10))
+        self.assertNotEqual(self.transcoder.getCacheName(source), before)
+
+
+    def testEncoderFails(self):
+        self.transcoder.command = FAIL
+        self.assertRaises(TranscodeError, list,
+                          self.transcoder.transcode(self.tracks))
+        self.assertEqual(os.listdir(self.transcoder.cacheDir), [])
+
+
+    def testCopyTracks(self):
+        target = self.makeDir("target")
+        mover = QuietMover(libraryFile=self.library, target=target,
+                           transcoder=self.transcoder)
+        mover.copyTracks(self.tracks)
+        copied = list(mover.getMusicFiles(target))
+        self.assertEqual(len(copied), len(self.tracks))
+        self.assertTrue(all(f.endswith(".m4a") for f in copied))
+
+
+if __name__ == "__main__":
+    unittest.main()
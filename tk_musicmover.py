@@ -1,18 +1,49 @@
 from musicmover import MusicMover
+from instrumentation import ThroughputMonitor
 
+import Queue
+import sys
+import threading
 import time
 import Tkinter as tk
 import ttk
 import tkMessageBox, tkFileDialog
 
 
+class _Progress(ThroughputMonitor):
+    """ A `ThroughputMonitor` that also keeps track of the current phase.
+    """
+
+    def reset(self):
+        ThroughputMonitor.reset(self)
+        self.phase = None
+
+
+    def phaseStarted(self, name):
+        self.phase = name
+
+
 class TkMusicMover(MusicMover):
-    """ A version of MusicMover with a minimal UI.
+    """ A version of MusicMover with a minimal UI. The work is done on a
+        background thread, which reports its progress through a queue; the
+        UI checks the queue and redraws at most `frameRate` times a second,
+        so it stays responsive without slowing the copying down.
+
+        @cvar frameRate: The maximum number of UI updates per second.
     """
 
+    frameRate = 20
+
+    phaseNames = {'walk': "Scanning the target...",
+                  'delete': "Deleting...",
+                  'select': "Choosing new music...",
+                  'transcode': "Transcoding..."}
+
     def _closeWindowHandler(self):
         if tkMessageBox.askokcancel("Quit", "Do you really wish to cancel?"):
             self.canceled = True
+            self.cancelButton.config(state=tk.DISABLED)
+            self.label1.config(text="Canceling...")
 
 
     def _createUi(self):
@@ -25,51 +56,163 @@ class TkMusicMover(MusicMover):
         self.label1 = ttk.Label(frame, text="")
         self.label2 = ttk.Label(frame, text="")
         self.pb = ttk.Progressbar(frame, length=dialogWidth)
+        self.cancelButton = ttk.Button(frame, text="Cancel",
+                                       command=self._closeWindowHandler)
         self.label1.pack(fill=tk.X, anchor="w")
         self.label2.pack(fill=tk.X, anchor="w")
         self.pb.pack(anchor='sw')
+        self.cancelButton.pack(anchor='e')
         frame.pack(side=tk.TOP)
+        self.monitor = _Progress()
+        self.observers.append(self.monitor)
 
 
     def _destroyUi(self):
+        self.observers.remove(self.monitor)
         self.root.destroy()
 
 
-    def deleteCallback(*args, **kwargs):
-        # Just suppress the printing done by the default version.
-        pass
+    def deleteCallback(self, num, total, filename):
+        """ Called (on the worker thread) after each file is deleted.
+        """
+        self._events.put(('delete', (num + 1, total, filename)))
 
 
     def copyCallback(self, num, total, orig, dupe):
-        """ Called after each track is duplicated.
+        """ Called (on the worker thread) after each track is duplicated.
+        """
+        self._events.put(('copy', (num, total, dupe)))
+
+
+    def renameCallback(self, num, total, source, dest):
+        """ Called (on the worker thread) after each file is renamed.
         """
-        self.label1.config(text="Copying file %d of %d:" % (num, total))
-        self.label2.config(text=dupe)
-        self.label1.update()
-        self.label2.update()
-        self.pb.step()
-        self.pb.update()
+        self._events.put(('rename', (num, total, dest)))
 
 
-    def copyTracks(self, tracks, dest=None):
-        """ Copy iTunes tracks, updating the GUI.
+    def _work(self, method, args, kwargs):
+        """ The body of the worker thread.
         """
-        self.pb.config(maximum=len(tracks))
-        return MusicMover.copyTracks(self, tracks, dest)
+        try:
+            self._result = method(self, *args, **kwargs)
+        except Exception:
+            self._events.put(('error', sys.exc_info()))
+        finally:
+            self._events.put(('done', None))
 
 
-    def freshenMusic(self, **kwargs):
-        """ Called before tracks are copied. Prompts the user to select a
-            target directory if none was supplied to ``__init__()``.
+    def _refresh(self):
+        """ Apply the progress reported by the worker to the UI. Reports
+            are coalesced; only the latest of each kind is shown.
+        """
+        latest = {}
+        try:
+            while True:
+                kind, data = self._events.get_nowait()
+                latest[kind] = data
+        except Queue.Empty:
+            pass
+
+        if 'error' in latest:
+            self._error = latest['error']
+        if 'done' in latest:
+            self.root.quit()
+            return
+
+        if self.canceled:
+            text, detail = "Canceling...", ""
+        elif 'copy' in latest:
+            num, total, dupe = latest['copy']
+            text = "Copying file %d of %d" % (num, total)
+            rate = self.monitor.getRate()
+            eta = self.monitor.getEta()
+            if rate is not None:
+                text += " (%.1f MB/s" % (rate / 1048576)
+                if eta is not None:
+                    text += ", %d:%02d remaining" % divmod(int(eta + .5), 60)
+                text += ")"
+            text, detail = text + ":", dupe
+        elif 'delete' in latest:
+            num, total, filename = latest['delete']
+            text, detail = "Deleting file %d of %d:" % (num, total), filename
+        elif 'rename' in latest:
+            num, total, filename = latest['rename']
+            text, detail = "Renaming file %d of %d:" % (num, total), filename
+        elif self.monitor.phase in self.phaseNames:
+            text, detail = self.phaseNames[self.monitor.phase], ""
+        else:
+            text = detail = None
+
+        if text is not None and (text, detail) != self._shown:
+            self.label1.config(text=text)
+            self.label2.config(text=detail)
+            self._shown = (text, detail)
+        self.pb.config(maximum=max(1, self.monitor.totalBytes),
+                       value=self.monitor.bytesCopied)
+        self.root.after(1000 // self.frameRate, self._refresh)
+
+
+    def _runWithUi(self, method, *args, **kwargs):
+        """ Run one of `MusicMover`'s operations on a worker thread while
+            the UI runs. Prompts the user to select a target directory if
+            none was supplied to ``__init__()``.
+
+            @param method: The unbound `MusicMover` method to run.
+            @return: Whatever the method returns, or `None` if the directory
+                chooser was cancelled.
         """
         self._createUi()
         if not self.target:
             self.target = tkFileDialog.askdirectory(parent=self.root,
                 initialdir="/Volumes/", title='Please select a directory')
+        self._error = None
+        self._result = None
         if self.target != '':
             # Should only occur if the directory chooser was cancelled.
-            MusicMover.freshenMusic(self, **kwargs)
+            self._events = Queue.Queue()
+            self._shown = None
+            worker = threading.Thread(target=self._work, 
+                                      args=(method, args, kwargs))
+            worker.daemon = True
+            worker.start()
+            self.root.after(0, self._refresh)
+            self.root.mainloop()
+            worker.join()
+        if self._error is not None:
+            tkMessageBox.showerror("MusicMover", str(self._error[1]),
+                                   parent=self.root)
         self._destroyUi()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+
+    def freshenMusic(self, *args, **kwargs):
+        """ Freshen the music on a worker thread while the UI runs. See
+            ``MusicMover.freshenMusic()``.
+        """
+        return self._runWithUi(MusicMover.freshenMusic, *args, **kwargs)
+
+
+    def freshenDevices(self, *args, **kwargs):
+        """ Freshen several targets on a worker thread while the UI runs.
+            See ``MusicMover.freshenDevices()``.
+        """
+        return self._runWithUi(MusicMover.freshenDevices, *args, **kwargs)
+
+
+    def updateMusic(self, *args, **kwargs):
+        """ Update the target on a worker thread while the UI runs. See
+            ``MusicMover.updateMusic()``.
+        """
+        return self._runWithUi(MusicMover.updateMusic, *args, **kwargs)
+
+
+    def executePlan(self, *args, **kwargs):
+        """ Carry out a plan on a worker thread while the UI runs. See
+            ``MusicMover.executePlan()``.
+        """
+        return self._runWithUi(MusicMover.executePlan, *args, **kwargs)
 
 
 #===============================================================================
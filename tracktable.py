@@ -0,0 +1,345 @@
+"""
+A columnar copy of an `iTunesLibrary`'s tracks, for quickly filtering large
+libraries. Requires NumPy.
+
+Each field is stored as one array with an entry for every track. Numbers,
+dates and booleans are kept as typed arrays. Strings are dictionary-encoded:
+an array of integer codes, plus a list of the distinct values. Comparing a
+column to a value produces an array of booleans. These can be combined with
+``&``, ``|`` and ``~``, then passed to ``TrackTable.select()`` to get the
+IDs of the matching tracks. Both ``MusicMover.getNewMusic()`` and
+``MusicMover.partition()`` accept those IDs directly::
+
+    table = TrackTable(library)
+    mask = (table['Size'] < 20 * 1048576) & (table['Play Count'] > 3) \\
+        & table['Genre'].isin(['Rock', 'Jazz'])
+    ids = table.select(mask, playlist="Music")
+    mover.getNewMusic(maxSize=1000, trackIds=ids)
+
+A track that doesn't have a field never matches a comparison on it.
+"""
+
+import calendar
+import operator
+from collections import Mapping
+from datetime import datetime
+
+import numpy
+
+#===============================================================================
+#
+#===============================================================================
+
+class Column(object):
+    """ One field of every track in a `TrackTable`.
+
+        @ivar name: The name of the field.
+        @ivar values: An array of the field's values, one per track. For
+            strings, these are indices into `categories` (-1 if missing).
+        @ivar present: An array of booleans, `True` for each track that has
+            the field.
+        @ivar categories: For strings, a list of the distinct values. `None`
+            for other types.
+        @ivar isDate: `True` if the values are dates, stored as seconds
+            since the epoch (UTC).
+    """
+
+    def __init__(self, name, values, present, categories=None, isDate=False):
+        self.name = name
+        self.values = values
+        self.present = present
+        self.categories = categories
+        self.isDate = isDate
+        if categories is not None:
+            self._codes = dict((v, i) for i, v in enumerate(categories))
+
+
+    def __repr__(self):
+        return "<%s %r: %d values>" % (self.__class__.__name__, self.name,
+                                       len(self.values))
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __getitem__(self, row):
+        """ Get the value for one track, as a normal Python object (`None`
+            if the track doesn't have the field).
+        """
+        if not self.present[row]:
+            return None
+        v = self.values[row]
+        if self.categories is not None:
+            return self.categories[v]
+        if self.isDate:
+            return datetime.utcfromtimestamp(v)
+        return v.item()
+
+
+    def _convert(self, value):
+        if isinstance(value, datetime):
+            return calendar.timegm(value.utctimetuple())
+        return value
+
+
+    def _compare(self, op, value):
+        if self.categories is None:
+            return op(self.values, self._convert(value)) & self.present
+        if op is operator.eq or op is operator.ne:
+            return op(self.values, self._codes.get(value, -2)) & self.present
+        # Compare each distinct string once, then look up the results. The
+        # extra False at the end is for missing values (code -1).
+        matches = [op(c, value) for c in self.categories] + [False]
+        return numpy.array(matches, dtype=bool)[self.values]
+
+
+    def __lt__(self, value):
+        return self._compare(operator.lt, value)
+
+    def __le__(self, value):
+        return self._compare(operator.le, value)
+
+    def __gt__(self, value):
+        return self._compare(operator.gt, value)
+
+    def __ge__(self, value):
+        return self._compare(operator.ge, value)
+
+    def __eq__(self, value):
+        return self._compare(operator.eq, value)
+
+    def __ne__(self, value):
+        return self._compare(operator.ne, value)
+
+
+    def isin(self, values):
+        """ Find the tracks whose value is one of several.
+
+            @param values: An iterable of values.
+            @return: An array of booleans, one per track.
+        """
+        if self.categories is not None:
+            codes = [self._codes[v] for v in values if v in self._codes]
+            return numpy.in1d(self.values, codes) & self.present
+        values = [self._convert(v) for v in values]
+        return numpy.in1d(self.values, values) & self.present
+
+
+    def contains(self, text, ignoreCase=True):
+        """ Find the tracks whose (string) value contains some text.
+
+            @param text: The text to find.
+            @keyword ignoreCase: If `True`, ignore the case of the text.
+            @return: An array of booleans, one per track.
+        """
+        if self.categories is None:
+            raise TypeError("Column %r does not contain strings" % self.name)
+        if ignoreCase:
+            text = text.lower()
+            matches = [text in c.lower() for c in self.categories]
+        else:
+            matches = [text in c for c in self.categories]
+        return numpy.array(matches + [False], dtype=bool)[self.values]
+
+
+    def isMissing(self):
+        """ Find the tracks that don't have the field.
+        """
+        return ~self.present
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class TrackRow(Mapping):
+    """ One track of a `TrackTable`, behaving like a read-only version of
+        the track's dictionary in the `iTunesLibrary`.
+    """
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+
+    def __repr__(self):
+        return "<%s %d>" % (self.__class__.__name__, self.table.ids[self.row])
+
+
+    def __getitem__(self, name):
+        column = self.table.columns.get(name)
+        if column is None or not column.present[self.row]:
+            raise KeyError(name)
+        return column[self.row]
+
+
+    def __iter__(self):
+        row = self.row
+        for name, column in self.table.columns.iteritems():
+            if column.present[row]:
+                yield name
+
+
+    def __len__(self):
+        return sum(1 for name in self)
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class TrackTable(object):
+    """ The tracks of an `iTunesLibrary`, stored as columns. Tracks are kept
+        in order of Track ID. Fields that can't be stored in a column (e.g.
+        binary data) are left out.
+
+        @cvar defaults: Values for fields iTunes omits when they are zero.
+        @ivar ids: An array of the Track IDs, in row order.
+        @ivar columns: A dictionary of `Column` objects, keyed by field name.
+    """
+
+    defaults = {'Play Count': 0,
+                'Skip Count': 0,
+                'Rating': 0}
+
+
+    def __init__(self, library, fields=None):
+        """ Constructor.
+            @param library: The `iTunesLibrary` to convert.
+            @keyword fields: The names of the fields to include. Defaults to
+                all the fields used by any track.
+        """
+        tracks = library.tracks
+        ids = sorted(int(k) for k in tracks)
+        rows = [tracks[str(i)] for i in ids]
+        self.ids = numpy.array(ids, dtype=numpy.int64)
+        self._playlistIds = library.playlistIds
+
+        if fields is None:
+            fields = set()
+            for track in rows:
+                fields.update(track)
+        self.columns = {}
+        for name in fields:
+            default = self.defaults.get(name)
+            column = self._makeColumn(name,
+                                      [t.get(name, default) for t in rows])
+            if column is not None:
+                self.columns[name] = column
+
+
+    def __repr__(self):
+        return "<%s: %d tracks, %d fields>" % (self.__class__.__name__,
+                                               len(self.ids), len(self.columns))
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __getitem__(self, name):
+        """ Get a column by field name.
+        """
+        return self.columns[name]
+
+
+    @classmethod
+    def _makeColumn(cls, name, values):
+        """ Build a column from a list of values (`None` where missing). The
+            type is taken from the first value present.
+        """
+        present = numpy.array([v is not None for v in values], dtype=bool)
+        first = next((v for v in values if v is not None), None)
+        if isinstance(first, basestring):
+            codes = {}
+            encoded = numpy.empty(len(values), dtype=numpy.int32)
+            for i, v in enumerate(values):
+                encoded[i] = -1 if v is None else codes.setdefault(v, len(codes))
+            categories = [None] * len(codes)
+            for v, code in codes.iteritems():
+                categories[code] = v
+            return Column(name, encoded, present, categories)
+
+        if isinstance(first, bool):
+            dtype, isDate, blank = bool, False, False
+        elif isinstance(first, (int, long)):
+            dtype, isDate, blank = numpy.int64, False, 0
+        elif isinstance(first, float):
+            dtype, isDate, blank = numpy.float64, False, 0.0
+        elif isinstance(first, datetime):
+            dtype, isDate, blank = numpy.int64, True, 0
+            values = [None if v is None else calendar.timegm(v.utctimetuple())
+                      for v in values]
+        else:
+            return None
+        try:
+            array = numpy.array([blank if v is None else v for v in values],
+                                dtype=dtype)
+        except (TypeError, ValueError):
+            # Mixed types; leave the field out.
+            return None
+        return Column(name, array, present, isDate=isDate)
+
+
+    def getRow(self, trackId):
+        """ Get the row number of a track.
+
+            @param trackId: The track's ID.
+            @return: The row, or `None` if there is no such track.
+        """
+        row = numpy.searchsorted(self.ids, int(trackId))
+        if row < len(self.ids) and self.ids[row] == int(trackId):
+            return int(row)
+        return None
+
+
+    def getTrackById(self, trackId):
+        """ Get a single track by its ID, as a dictionary-like `TrackRow`.
+        """
+        row = self.getRow(trackId)
+        return None if row is None else TrackRow(self, row)
+
+
+    def getRows(self, playlist=None):
+        """ Get the row numbers of the tracks in a playlist, in playlist
+            order.
+
+            @keyword playlist: The name of the playlist. Defaults to all
+                tracks, in order of Track ID.
+            @return: An array of row numbers.
+        """
+        if playlist is None:
+            return numpy.arange(len(self.ids))
+        wanted = numpy.array(self._playlistIds[playlist], dtype=numpy.int64)
+        rows = numpy.searchsorted(self.ids, wanted)
+        found = rows < len(self.ids)
+        found[found] = self.ids[rows[found]] == wanted[found]
+        return rows[found]
+
+
+    def select(self, mask=None, playlist=None):
+        """ Get the IDs of the tracks matching a query.
+
+            @keyword mask: An array of booleans, one per track, e.g. the
+                result of comparing columns. Defaults to all tracks.
+            @keyword playlist: The name of a playlist to which to limit the
+                results. The IDs are returned in playlist order. Defaults to
+                all tracks, in order of Track ID.
+            @return: An array of Track IDs.
+        """
+        rows = self.getRows(playlist)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        return self.ids[rows]
+
+
+    def getTracks(self, playlist="Music", mask=None):
+        """ Get tracks matching a query, as dictionary-like `TrackRow`
+            objects. See ``select()``.
+        """
+        rows = self.getRows(playlist)
+        if mask is not None:
+            rows = rows[mask[rows]]
+        for row in rows:
+            yield TrackRow(self, int(row))
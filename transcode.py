@@ -0,0 +1,240 @@
+"""
+Transcoding of lossless tracks (AIFF, WAV) to a smaller format before they
+are copied to a device, using an external encoder (``ffmpeg`` or, on Mac OS
+X, ``afconvert``) run by a pool of processes.
+
+Transcoded files are kept in a cache, named for a hash of the source file's
+size, modification time, first and last 64KB, and the encoder settings, so
+tracks aren't re-encoded every time they are copied.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import subprocess
+from distutils.spawn import find_executable
+from urllib import pathname2url, url2pathname
+from urlparse import urlparse
+
+#===============================================================================
+#
+#===============================================================================
+
+def quickHash(filename, size=None, chunk=65536):
+    """ Get an MD5 hash of a file's first and last blocks (64KB by 
+        default), for cheaply checking whether two files are the same.
+
+        @param filename: The name of the file.
+        @keyword size: The size of the file, if already known.
+        @keyword chunk: The amount to read from each end of the file.
+        @return: The hash, as a string of 16 bytes.
+    """
+    size = os.path.getsize(filename) if size is None else size
+    h = hashlib.md5()
+    with open(filename, 'rb') as f:
+        h.update(f.read(chunk))
+        if size > chunk:
+            f.seek(max(chunk, size - chunk))
+            h.update(f.read())
+    return h.digest()
+
+
+class TranscodeError(Exception):
+    """ Raised when the encoder fails.
+    """
+    pass
+
+
+def _encode(job):
+    """ Run the encoder on one file. Module-level so the process pool can
+        call it. The output is written to a temporary file and renamed, so
+        an interrupted encode never leaves a partial file in the cache.
+
+        @param job: A tuple of (<command>, <source>, <output>).
+        @return: A tuple of (<source>, <output>, <error message or None>).
+    """
+    command, source, output = job
+    temp = "%s.%d.tmp%s" % (output, os.getpid(), os.path.splitext(output)[1])
+    args = [a.format(input=source, output=temp) for a in command]
+    try:
+        p = subprocess.Popen(args, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        message = p.communicate()[0]
+        if p.returncode != 0 or not os.path.exists(temp):
+            return source, output, "%s exited with %s: %s" % \
+                (args[0], p.returncode, message.strip())
+        os.rename(temp, output)
+    except (OSError, IOError) as err:
+        return source, output, str(err)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+    return source, output, None
+
+
+#===============================================================================
+#
+#===============================================================================
+
+class Transcoder(object):
+    """ Converts tracks in lossless formats to a smaller one.
+
+        @cvar sourceExts: The extensions of the files to transcode.
+        @cvar fields: Track fields used for estimating the size of the
+            output. Include them when loading a library in streaming mode.
+        @cvar overhead: The estimated size of a transcoded file's headers,
+            in bytes.
+        @cvar margin: Extra space allowed for each transcoded file, as a
+            fraction of its estimated size, in case the estimate is low.
+        @ivar command: The encoder command line, a list of arguments. The
+            strings "{input}" and "{output}" are replaced by the file names.
+    """
+
+    sourceExts = ('.aif', '.aiff', '.wav')
+    fields = ('Total Time',)
+    overhead = 65536
+    margin = 0.05
+
+    # Encoder command lines, tried in order. Bitrate is in kbps.
+    encoders = (
+        ('ffmpeg', ['ffmpeg', '-nostdin', '-y', '-loglevel', 'error',
+                    '-i', '{input}', '-vn', '-b:a', '%(bitrate)dk',
+                    '{output}']),
+        ('afconvert', ['afconvert', '-f', 'm4af', '-d', 'aac',
+                       '-b', '%(bitrate)d000', '{input}', '{output}']),
+    )
+
+    def __init__(self, cacheDir="~/.musicmover/transcoded", ext=".m4a",
+                 bitrate=256, command=None, workers=None):
+        """ Constructor.
+            @keyword cacheDir: The directory in which to keep transcoded
+                files.
+            @keyword ext: The extension of the transcoded files, which
+                determines their format.
+            @keyword bitrate: The bitrate of the transcoded files, in kbps.
+            @keyword command: The encoder command line, a list of
+                arguments; "{input}" and "{output}" are replaced by the file
+                names. Defaults to the first encoder in `encoders` that is
+                installed.
+            @keyword workers: The number of files to encode at once.
+                Defaults to the number of CPU cores.
+        """
+        self.cacheDir = os.path.realpath(os.path.expanduser(cacheDir))
+        self.ext = ext
+        self.bitrate = bitrate
+        if command is None:
+            for name, args in self.encoders:
+                if find_executable(name):
+                    command = [a % {'bitrate': bitrate} for a in args]
+                    break
+            else:
+                raise TranscodeError("No encoder found (tried %s)" % \
+                    ", ".join(name for name, args in self.encoders))
+        self.command = list(command)
+        self.workers = workers or multiprocessing.cpu_count()
+
+
+    def __repr__(self):
+        return "<%s: %s, %dkbps>" % (self.__class__.__name__, self.ext,
+                                     self.bitrate)
+
+
+    def _getSourceFile(self, track):
+        return url2pathname(urlparse(track.get('Location', '')).path)
+
+
+    def handles(self, track):
+        """ Determine if a track will be transcoded.
+        """
+        location = track.get('Location', '')
+        return os.path.splitext(location)[-1].lower() in self.sourceExts
+
+
+    def getTargetName(self, filename):
+        """ Change the extension of a file's name on the target to that of
+            transcoded files.
+        """
+        return os.path.splitext(filename)[0] + self.ext
+
+
+    def estimateSize(self, track):
+        """ Estimate the size of a track once transcoded, from its duration
+            (or, failing that, its size relative to CD audio), plus a
+            safety `margin`.
+
+            @param track: The track to be transcoded.
+            @return: The estimated size, in bytes.
+        """
+        seconds = track.get('Total Time', 0) / 1000.0
+        if seconds > 0:
+            size = self.bitrate * 125 * seconds
+        else:
+            # CD audio is 1411kbps.
+            size = track.get('Size', 0) * self.bitrate / 1411.0
+        return int(size * (1 + self.margin)) + self.overhead
+
+
+    def getCacheName(self, source):
+        """ Get the name of the cache file for a source file: a hash of the
+            source's size, modification time, first and last 64KB, and the
+            encoder settings. Only part of the source is read, so an edit
+            to the middle of the file (e.g. re-ripping it) is noticed by its
+            modification time changing.
+        """
+        st = os.stat(source)
+        h = hashlib.md5(quickHash(source, st.st_size))
+        h.update("%d:%d" % (st.st_size, int(st.st_mtime)))
+        h.update("\0".join(self.command))
+        return os.path.join(self.cacheDir, h.hexdigest() + self.ext)
+
+
+    def getCached(self, track):
+        """ Get the name of a track's transcoded file, if it is in the
+            cache.
+            @return: A filename, or `None` if it hasn't been transcoded.
+        """
+        output = self.getCacheName(self._getSourceFile(track))
+        return output if os.path.exists(output) else None
+
+
+    def transcode(self, tracks, canceled=None):
+        """ Transcode tracks not already in the cache, using a pool of
+            `workers` processes.
+
+            @param tracks: A list of tracks to transcode.
+            @keyword canceled: A function returning `True` if the work
+                should stop; checked as each file is finished.
+            @return: A generator of (<track>, <URL of transcoded file>)
+                tuples, in the order the files are finished. Tracks already
+                in the cache come first.
+        """
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        todo = {}
+        for track in tracks:
+            source = self._getSourceFile(track)
+            output = self.getCacheName(source)
+            if os.path.exists(output):
+                yield track, "file://" + pathname2url(output)
+            else:
+                todo.setdefault(source, (output, []))[1].append(track)
+        if not todo:
+            return
+
+        jobs = [(self.command, source, output)
+                for source, (output, t) in todo.iteritems()]
+        pool = multiprocessing.Pool(min(self.workers, len(jobs)))
+        try:
+            for source, output, error in pool.imap_unordered(_encode, jobs):
+                if error is not None:
+                    raise TranscodeError("Could not transcode %s: %s" % \
+                                         (source, error))
+                url = "file://" + pathname2url(output)
+                for track in todo[source][1]:
+                    yield track, url
+                if canceled is not None and canceled():
+                    break
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()